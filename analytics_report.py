@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline analytics report for the bot database
+Streams the analytics table in id-ordered chunks into columnar arrays (interned chat ids,
+action codes mapped to kinds via action_kinds), and computes per-action histograms, a weekday x hour heatmap, events-per-hour
+percentiles and per-chat daily series. NumPy is used when installed, the stdlib otherwise.
+
+Usage: python analytics_report.py [--db bot_data.db] [--chat -100...] [--days 30]
+                                  [--format json|csv] [--out report.json]
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import sqlite3
+import argparse
+from array import array
+from collections import Counter
+
+try:
+    import numpy as np
+except ImportError:  # Optional: pure Python fallback
+    np = None
+
+DB_PATH = os.getenv("DB_PATH", "bot_data.db")
+CHUNK_ROWS = 200000  # Rows per fetched chunk (bounds memory)
+PERCENTILES = (50, 90, 99)
+
+# ---------- Interning ----------
+class Interner:
+    "Map strings to small consecutive ints (and back)"
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+def load_action_names(conn):
+    "{action code: kind name} from the action_kinds table (empty for databases from before action codes)"
+    try:
+        return dict(conn.execute("SELECT code, name FROM action_kinds").fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+def action_kind(action, names):
+    "Kind of an analytics action: name of an action code, or the text before the first ':' of an old string"
+    if isinstance(action, int):
+        return names.get(action, 'other')
+    return action.split(':', 1)[0] if action else ''
+
+# ---------- Streaming ----------
+def stream_chunks(conn, chat_id=None, since=0, chats=None, kinds=None, chunk_rows=CHUNK_ROWS):
+    """
+    Yield (at, chat, kind) column arrays per chunk, reading by id keyset (no OFFSET, no sqlite3.Row).
+    at: array('q') unix seconds; chat/kind: array('I') codes from the chats/kinds Interners.
+    """
+    chats = chats if chats is not None else Interner()
+    kinds = kinds if kinds is not None else Interner()
+    where = "id > ? AND at >= ?"
+    params = [since]
+    if chat_id is not None:
+        where += " AND chat_id = ?"
+        params.append(str(chat_id))
+    names = load_action_names(conn)
+    action_codes = {}  # Stored action value -> kind code
+    last_id = 0
+    while True:
+        rows = conn.execute(f"SELECT id, chat_id, action, at FROM analytics WHERE {where} ORDER BY id LIMIT ?",
+                            [last_id] + params + [chunk_rows]).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        chat_code = chats.code
+        kind_codes = array('I')
+        for row in rows:
+            code = action_codes.get(row[2])
+            if code is None:
+                code = action_codes[row[2]] = kinds.code(action_kind(row[2], names))
+            kind_codes.append(code)
+        yield (array('q', [row[3] or 0 for row in rows]),
+               array('I', [chat_code(row[1]) for row in rows]),
+               kind_codes)
+        if len(rows) < chunk_rows:
+            return
+
+# ---------- Aggregation ----------
+class Report:
+    "Incremental aggregates; memory depends on chats x hours, not on the number of rows"
+    def __init__(self):
+        self.rows = 0
+        self.kind_counts = Counter()  # kind code -> count
+        self.heatmap = [0] * (7 * 24)  # weekday (Mon=0) * 24 + hour, UTC
+        self.hourly = Counter()  # (chat code, hour index) -> count
+
+    def add(self, at, chat, kind):
+        self.rows += len(at)
+        if np is not None:
+            self._add_numpy(at, chat, kind)
+        else:
+            self._add_python(at, chat, kind)
+
+    def _add_numpy(self, at, chat, kind):
+        at = np.frombuffer(at, dtype=np.int64)
+        chat = np.frombuffer(chat, dtype=np.uint32).astype(np.int64)
+        kind = np.frombuffer(kind, dtype=np.uint32)
+        hour = at // 3600
+        # 1970-01-01 was a Thursday: weekday = (days + 3) % 7 with Monday = 0
+        slot = ((hour // 24 + 3) % 7) * 24 + hour % 24
+        for code, count in enumerate(np.bincount(kind).tolist()):
+            if count:
+                self.kind_counts[code] += count
+        for i, count in enumerate(np.bincount(slot, minlength=7 * 24).tolist()):
+            self.heatmap[i] += count
+        keys, counts = np.unique((chat << 32) | hour, return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.hourly[(key >> 32, key & 0xFFFFFFFF)] += count
+
+    def _add_python(self, at, chat, kind):
+        self.kind_counts.update(kind)
+        heatmap, hourly = self.heatmap, self.hourly
+        for ts, chat_code in zip(at, chat):
+            hour = ts // 3600
+            heatmap[((hour // 24 + 3) % 7) * 24 + hour % 24] += 1
+            hourly[(chat_code, hour)] += 1
+
+    def hourly_percentiles(self):
+        "{chat code: {'p50': .., 'p90': .., 'p99': .., 'max': ..}} of events per active hour"
+        per_chat = {}
+        for (chat_code, _hour), count in self.hourly.items():
+            per_chat.setdefault(chat_code, []).append(count)
+        result = {}
+        for chat_code, counts in per_chat.items():
+            if np is not None:
+                values = np.percentile(np.array(counts), PERCENTILES).tolist()
+            else:
+                counts.sort()
+                values = [counts[min(len(counts) - 1, int(round(p / 100 * (len(counts) - 1))))] for p in PERCENTILES]
+            stats = {f"p{p}": round(v, 2) for p, v in zip(PERCENTILES, values)}
+            stats['max'] = max(counts)
+            result[chat_code] = stats
+        return result
+
+    def daily(self):
+        "{chat code: {'YYYY-MM-DD': count}}"
+        series = {}
+        for (chat_code, hour), count in self.hourly.items():
+            day = time.strftime('%Y-%m-%d', time.gmtime(hour * 3600))
+            days = series.setdefault(chat_code, {})
+            days[day] = days.get(day, 0) + count
+        return {chat: dict(sorted(days.items())) for chat, days in series.items()}
+
+def build_report(db_path, chat_id=None, days=None):
+    "Stream the analytics table of db_path and return the report as a dict"
+    since = int(time.time()) - days * 86400 if days else 0
+    chats, kinds = Interner(), Interner()
+    report = Report()
+    conn = sqlite3.connect(db_path)
+    try:
+        for at, chat, kind in stream_chunks(conn, chat_id, since, chats, kinds):
+            report.add(at, chat, kind)
+    finally:
+        conn.close()
+    return {
+        'rows': report.rows,
+        'since': since,
+        'actions': {kinds.values[code]: count for code, count in report.kind_counts.most_common()},
+        'heatmap_utc': [report.heatmap[day * 24:(day + 1) * 24] for day in range(7)],
+        'events_per_hour': {chats.values[code]: stats for code, stats in report.hourly_percentiles().items()},
+        'daily': {chats.values[code]: series for code, series in report.daily().items()},
+    }
+
+# ---------- Output ----------
+def write_json(report, out):
+    json.dump(report, out, ensure_ascii=False, indent=1)
+
+def write_csv(report, out):
+    "Per-chat daily time series: chat_id,day,events"
+    writer = csv.writer(out)
+    writer.writerow(['chat_id', 'day', 'events'])
+    for chat_id, series in report['daily'].items():
+        for day, count in series.items():
+            writer.writerow([chat_id, day, count])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analytics report (histograms, heatmap, percentiles, daily series)")
+    parser.add_argument('--db', default=DB_PATH, help="SQLite database (default: $DB_PATH or bot_data.db)")
+    parser.add_argument('--chat', help="Only this chat id")
+    parser.add_argument('--days', type=int, help="Only the last N days")
+    parser.add_argument('--format', choices=['json', 'csv'], default='json', help="csv writes the daily series only")
+    parser.add_argument('--out', help="Output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    report = build_report(args.db, args.chat, args.days)
+    out = open(args.out, 'w', encoding='utf-8', newline='') if args.out else sys.stdout
+    try:
+        (write_csv if args.format == 'csv' else write_json)(report, out)
+    finally:
+        if args.out:
+            out.close()
+    print(f"{report['rows']} rows in {time.time() - started:.2f}s ({'numpy' if np is not None else 'python'})", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
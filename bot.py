@@ -14,11 +14,23 @@ import sqlite3
 import time
 import json
 import re
+import unicodedata
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit, unquote
 from threading import Thread, Lock
-from collections import defaultdict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
 import random
 import html
+import hmac
+import hashlib
+import base64
+import io
+import csv
+import tempfile
+import multiprocessing
+import signal
 
 try:
     import telebot
@@ -42,19 +54,483 @@ if not BOT_TOKEN:
 
 bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
 BOT_USERNAME = ""  # Will be fetched in main()
+BOT_INFO = None  # Cached get_me() result, fetched once in main()
 
 # ---------- Database Path ----------
 DB_PATH = os.getenv("DB_PATH", "bot_data.db")
 
+# ---------- Concurrency-Safe State Store ----------
+STATE_STRIPES = int(os.getenv("STATE_STRIPES", "64"))  # Lock stripes per state map
+STATE_TTL = int(os.getenv("STATE_TTL", "1800"))  # Abandoned multi-step flows expire after this (seconds)
+CAPTCHA_TIMEOUT = 300  # Pending captcha expiry (seconds)
+
+class ShardedState:
+    """
+    Dict-like store split into lock stripes by chat_id.
+    
+    Keys are either a chat_id or a tuple whose first element is the chat_id, so all
+    state of one chat lives in one stripe. compute() gives atomic check-and-update.
+    With ttl, entries expire after ttl seconds from their last write; with namespace,
+    entries are written through to the kv_state table and lazily loaded per chat.
+    Writes are queued per stripe under its lock and flushed after it is released,
+    so SQLite I/O never blocks readers of the same stripe.
+    """
+    def __init__(self, stripes=STATE_STRIPES, ttl=None, namespace=None):
+        self._locks = [Lock() for _ in range(stripes)]
+        self._maps = [{} for _ in range(stripes)]  # {key: (expires_at, value)}, expires_at 0 = never
+        self._loaded = [set() for _ in range(stripes)]  # chat ids already loaded from SQLite
+        self._dirty = [{} for _ in range(stripes)]  # {key: entry or None} waiting to be written
+        self._io_locks = [Lock() for _ in range(stripes)]  # Serialize flushes so the latest write lands last
+        self._ttl = ttl
+        self._namespace = namespace
+
+    @staticmethod
+    def _chat_of(key):
+        return str(key[0] if isinstance(key, tuple) else key)
+
+    def _stripe(self, key):
+        return hash(self._chat_of(key)) % len(self._maps)
+
+    def _expiry(self):
+        return now_ts() + self._ttl if self._ttl else 0
+
+    @staticmethod
+    def _alive(entry, now):
+        return entry is not None and (entry[0] == 0 or entry[0] > now)
+
+    def _load(self, i, key):
+        "Lazily load persisted entries of key's chat into stripe i (caller holds the lock)"
+        chat = self._chat_of(key)
+        if self._namespace is None or chat in self._loaded[i]:
+            return
+        self._loaded[i].add(chat)
+        conn = db()
+        rows = conn.execute("SELECT key, value_json, expires_at FROM kv_state \n                             WHERE namespace=? AND chat_id=? AND (expires_at=0 OR expires_at>?)",
+                            (self._namespace, chat, now_ts())).fetchall()
+        conn.close()
+        for row in rows:
+            stored_key = jload(row['key'], None)
+            stored_key = tuple(stored_key) if isinstance(stored_key, list) else stored_key
+            self._maps[i].setdefault(stored_key, (row['expires_at'], jload(row['value_json'], None)))
+
+    def _persist(self, i, key, entry):
+        "Queue a write-through of a single entry, None deletes (caller holds the lock of stripe i)"
+        if self._namespace is not None:
+            self._dirty[i][key] = entry
+
+    def _flush(self, stripes):
+        "Write queued entries of the given stripes to SQLite without holding their stripe locks"
+        if self._namespace is None:
+            return
+        stripes = sorted(set(stripes))
+        for i in stripes:  # Sorted acquisition keeps concurrent multi-stripe flushes deadlock-free
+            self._io_locks[i].acquire()
+        try:
+            dirty = {}
+            for i in stripes:
+                with self._locks[i]:
+                    dirty.update(self._dirty[i])
+                    self._dirty[i] = {}
+            if not dirty:
+                return
+            deletes = [(self._namespace, jdump(key)) for key, entry in dirty.items() if entry is None]
+            upserts = [(self._namespace, jdump(key), self._chat_of(key),
+                        json.dumps(entry[1], ensure_ascii=False, separators=(',', ':')), entry[0])
+                       for key, entry in dirty.items() if entry is not None]
+            conn = db()
+            if deletes:
+                conn.executemany("DELETE FROM kv_state WHERE namespace=? AND key=?", deletes)
+            if upserts:
+                conn.executemany("INSERT OR REPLACE INTO kv_state (namespace, key, chat_id, value_json, expires_at) VALUES (?,?,?,?,?)", upserts)
+            conn.commit()
+            conn.close()
+        finally:
+            for i in reversed(stripes):
+                self._io_locks[i].release()
+
+    def get(self, key, default=None):
+        i = self._stripe(key)
+        with self._locks[i]:
+            self._load(i, key)
+            entry = self._maps[i].get(key)
+            return entry[1] if self._alive(entry, now_ts()) else default
+
+    def pop(self, key, default=None):
+        i = self._stripe(key)
+        with self._locks[i]:
+            self._load(i, key)
+            entry = self._maps[i].pop(key, None)
+            if entry is not None:
+                self._persist(i, key, None)
+        self._flush([i])
+        return entry[1] if self._alive(entry, now_ts()) else default
+
+    def compute(self, key, fn):
+        """
+        Atomically run fn(current_value_or_None) -> (new_value, result).
+        new_value None deletes the key; result is returned to the caller.
+        Returning the same object leaves the entry (and its expiry) untouched.
+        """
+        i = self._stripe(key)
+        with self._locks[i]:
+            self._load(i, key)
+            entry = self._maps[i].get(key)
+            current = entry[1] if self._alive(entry, now_ts()) else None
+            new_value, result = fn(current)
+            if new_value is None:
+                if entry is not None:
+                    del self._maps[i][key]
+                    self._persist(i, key, None)
+            elif new_value is not current:
+                entry = (self._expiry(), new_value)
+                self._maps[i][key] = entry
+                self._persist(i, key, entry)
+        self._flush([i])
+        return result
+
+    def set_many(self, items):
+        "Store many (key, value) pairs, persisting them in a single transaction"
+        touched = []
+        for key, value in items:
+            i = self._stripe(key)
+            entry = (self._expiry(), value)
+            with self._locks[i]:
+                self._load(i, key)
+                self._maps[i][key] = entry
+                self._persist(i, key, entry)
+            touched.append(i)
+        self._flush(touched)
+
+    def pop_where(self, predicate):
+        "Remove and return [(key, value)] for which predicate(key, value) is true"
+        removed = []
+        touched = []
+        for i, (lock, data) in enumerate(zip(self._locks, self._maps)):
+            with lock:
+                keys = [k for k, entry in data.items() if predicate(k, entry[1])]
+                for k in keys:
+                    removed.append((k, data.pop(k)[1]))
+                    self._persist(i, k, None)
+                if keys:
+                    touched.append(i)
+        self._flush(touched)
+        return removed
+
+    def pop_expired(self):
+        "Evict expired entries (memory and SQLite) and return them as [(key, value)]"
+        now = now_ts()
+        expired = {}
+        for lock, data in zip(self._locks, self._maps):
+            with lock:
+                keys = [k for k, entry in data.items() if not self._alive(entry, now)]
+                for k in keys:
+                    expired[k] = data.pop(k)[1]
+        if self._namespace is not None:
+            # Entries of chats not loaded since restart are only on disk
+            conn = db()
+            rows = conn.execute("SELECT key, value_json FROM kv_state WHERE namespace=? AND expires_at>0 AND expires_at<=?",
+                                (self._namespace, now)).fetchall()
+            conn.execute("DELETE FROM kv_state WHERE namespace=? AND expires_at>0 AND expires_at<=?", (self._namespace, now))
+            conn.commit()
+            conn.close()
+            for row in rows:
+                stored_key = jload(row['key'], None)
+                stored_key = tuple(stored_key) if isinstance(stored_key, list) else stored_key
+                expired.setdefault(stored_key, jload(row['value_json'], None))
+        return list(expired.items())
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.compute(key, lambda _old: (value, None))
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __len__(self):
+        return sum(len(data) for data in self._maps)
+
 # ---------- Global State & Locks ----------
-STATE = {}  # For multi-step conversations: {(chat_id, key): data}
-user_messages = defaultdict(list)  # Flood tracking: {(chat_id, user_id): [timestamps]}
-pending_captcha = {}  # {(chat_id, user_id): {'answer': int, 'created_at': ts}}
-rejoin_tracker = defaultdict(set)  # {chat_id: {user_id}}
+STATE = ShardedState(ttl=STATE_TTL, namespace='state')  # For multi-step conversations: {(chat_id, key): data}
+user_messages = ShardedState()  # Flood tracking: {(chat_id, user_id): [timestamps]}
+pending_captcha = ShardedState(ttl=CAPTCHA_TIMEOUT, namespace='captcha')  # {(chat_id, user_id): {'answer': int, 'created_at': ts, 'q1', 'q2', 'attempts'}}
 AUTO_CLEAN_QUEUE = []  # [(chat_id, msg_id, delete_at_ts), ...]
 AUTO_CLEAN_LOCK = Lock()
-CAPTCHA_LOCK = Lock()
-FLOOD_LOCK = Lock()
+
+# ---------- Rejoin Tracker (known members) ----------
+REJOIN_RETENTION_DAYS = int(os.getenv("REJOIN_RETENTION_DAYS", "90"))  # Forget members not seen for this long
+REJOIN_CACHE_SIZE = int(os.getenv("REJOIN_CACHE_SIZE", "100000"))  # In-memory LRU front of known_members
+REJOIN_TOUCH_INTERVAL = int(os.getenv("REJOIN_TOUCH_INTERVAL", "3600"))  # Min gap between last_seen writes per cached member
+REJOIN_CACHE = OrderedDict()  # {(chat_id, user_id): [last_seen as written to SQLite, last join]}
+REJOIN_CACHE_LOCK = Lock()
+
+# ---------- API Rate Limiting ----------
+class RateLimiter:
+    """
+    Token-bucket limiter for Bot API calls: one global bucket plus one bucket per chat
+    (Telegram allows ~30 calls/s overall and ~20 messages/min into one group).
+    acquire() blocks until a token is available.
+    """
+    def __init__(self, global_rate, chat_rate, chat_burst):
+        self._lock = Lock()
+        self._global_rate = global_rate
+        self._global = [float(global_rate), time.monotonic()]  # [tokens, last refill]
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = {}  # {chat_id: [tokens, last refill]}
+
+    @staticmethod
+    def _refill(bucket, rate, cap, now):
+        bucket[0] = min(cap, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+    def acquire(self, chat_id=None):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(self._global, self._global_rate, self._global_rate, now)
+                chat_bucket = None
+                if chat_id is not None:
+                    chat_bucket = self._chats.setdefault(str(chat_id), [float(self._chat_burst), now])
+                    self._refill(chat_bucket, self._chat_rate, self._chat_burst, now)
+                if self._global[0] >= 1 and (chat_bucket is None or chat_bucket[0] >= 1):
+                    self._global[0] -= 1
+                    if chat_bucket is not None:
+                        chat_bucket[0] -= 1
+                    return
+                wait = (1 - self._global[0]) / self._global_rate if self._global[0] < 1 else 0
+                if chat_bucket is not None and chat_bucket[0] < 1:
+                    wait = max(wait, (1 - chat_bucket[0]) / self._chat_rate)
+            time.sleep(wait)
+
+    def prune(self, idle_sec=120):
+        "Forget per-chat buckets idle long enough to be full again"
+        cutoff = time.monotonic() - idle_sec
+        with self._lock:
+            for chat_id in [cid for cid, bucket in self._chats.items() if bucket[1] < cutoff]:
+                del self._chats[chat_id]
+
+API_LIMITER = RateLimiter(
+    global_rate=int(os.getenv("API_RATE_PER_SEC", "25")),
+    chat_rate=20 / 60.0,  # 20 messages per minute per group
+    chat_burst=5
+)
+
+# ---------- Raid Mode (join bursts) ----------
+RAID_WINDOW = int(os.getenv("RAID_WINDOW", "10"))  # Seconds over which join rate is measured
+RAID_THRESHOLD = int(os.getenv("RAID_THRESHOLD", "15"))  # Joins within RAID_WINDOW that start raid mode
+RAID_COOLDOWN = int(os.getenv("RAID_COOLDOWN", "120"))  # Raid mode ends after this many quiet seconds
+RAID_FLUSH_INTERVAL = 5  # Seconds between batched join flushes
+RAID_WORKERS = 8  # Parallel restrict calls per flush
+RAID_MAX_MENTIONS = 30  # Mentions shown in one aggregated welcome message
+join_rates = ShardedState()  # {chat_id: [join timestamps]}
+raid_state = ShardedState()  # {chat_id: {'until': ts, 'started_at': ts}}
+raid_queue = ShardedState()  # {chat_id: [{'id': user_id, 'name': first_name}, ...]}
+
+# ---------- Button Captcha & Scheduler ----------
+CAPTCHA_SECRET = (os.getenv("CAPTCHA_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()).encode()
+CAPTCHA_OPTIONS = 4  # Buttons per button-captcha
+CAPTCHA_MAX_ATTEMPTS = int(os.getenv("CAPTCHA_MAX_ATTEMPTS", "3"))  # Wrong typed answers before the user is kicked
+# Button captchas kick on the first wrong click: with CAPTCHA_OPTIONS choices, more tries would make blind guessing pay off
+SCHEDULER_INTERVAL = 5  # Seconds between scheduled job polls
+SCHEDULER_BATCH = 500  # Max due jobs handled per poll
+
+# ---------- Compact Callback Data ----------
+CB_MAX_BYTES = 64  # Telegram limit for callback_data
+CB_PAYLOAD_TTL = int(os.getenv("CB_PAYLOAD_TTL", str(7 * 86400)))  # Server-side payloads of long callbacks
+
+# ---------- List Menus (notes/triggers/blacklist) ----------
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "10"))  # Default items per page (menu_json lists.page_size overrides)
+LIST_PAGE_MIN = 5
+LIST_PAGE_MAX = 30
+
+# ---------- Config Import / Export ----------
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))  # Largest accepted import file
+
+# ---------- Analytics Rollups & Retention ----------
+ANALYTICS_ROLLUP_INTERVAL = int(os.getenv("ANALYTICS_ROLLUP_INTERVAL", "60"))  # seconds between rollups / stats flushes
+ANALYTICS_ROLLUP_BATCH = 50000  # Raw rows aggregated per rollup transaction
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "30"))  # Raw analytics rows (already rolled up)
+ANALYTICS_HOURLY_RETENTION_DAYS = int(os.getenv("ANALYTICS_HOURLY_RETENTION_DAYS", "90"))  # Hourly rollups; daily kept
+ANALYTICS_DELETE_CHUNK = 5000  # Rows deleted per retention transaction
+ANALYTICS_MAINTENANCE_INTERVAL = 3600  # seconds between retention/vacuum passes
+VACUUM_PAGES = 2000  # Free pages returned to the OS per incremental_vacuum
+
+# ---------- Group Statistics ----------
+STATS_COUNTS = {}  # {(chat_id, hour_ts, kind): count} - 'message', 'join', 'left'; flushed into the rollups
+STATS_USER_COUNTS = {}  # {(chat_id, day_ts, user_id): [messages, name]}
+STATS_LOCK = Lock()
+STATS_PERIODS = {'today': 1, '7d': 7, '30d': 30}  # period -> calendar days (UTC) including today
+STATS_PUNISHMENT_KINDS = ('warned', 'muted', 'banned', 'kicked', 'auto_mute')
+STATS_TOP_USERS = 5
+
+# ---------- Punishment Ledger ----------
+WARN_LIMIT = 3  # Active warns (or blacklist violations) that escalate to a ban
+WARN_EXPIRY_DAYS = int(os.getenv("WARN_EXPIRY_DAYS", "30"))  # A warn stops counting after this (0 = never)
+COUNTED_PUNISHMENTS = ('warn', 'blacklist')  # Types with a punishment_counters row
+MUTE_TELEGRAM_MIN = 30  # Telegram treats restrictions shorter than this...
+MUTE_TELEGRAM_MAX = 366 * 86400  # ...or longer than this as permanent, so the bot lifts those itself
+
+# ---------- Mass Moderation ----------
+MASS_MOD_WORKERS = int(os.getenv("MASS_MOD_WORKERS", "8"))  # Parallel ban/restrict calls (all through API_LIMITER)
+MASS_MOD_MAX_TARGETS = int(os.getenv("MASS_MOD_MAX_TARGETS", "10000"))  # Largest target list per command
+MASS_PROGRESS_INTERVAL = 3  # Seconds between status message edits
+MASS_ACTIONS = {'massban': 'ban', 'massmute': 'mute', 'masskick': 'kick', 'massunban': 'unban'}
+MASS_ID_RE = re.compile(r"\b\d{5,15}\b")  # User ids in command args / replied text / files
+mass_jobs = ShardedState()  # {chat_id: {'action': ..., 'started_at': ts}} - one running mass job per group
+
+# ---------- Federations (shared ban lists) ----------
+FED_LOCK = Lock()
+FED_BANS = {}  # {fed_id: set(user_id ints)} - loaded at startup, kept in sync by fed_ban / fed_unban
+FED_OF_CHAT = {}  # {chat_id str: fed_id} - a group subscribes to at most one federation
+fed_enforcing = ShardedState()  # {(chat_id, user_id): True} while an on-sight fed ban is in progress
+
+# ---------- Duplicate Content Detection ----------
+DUPE_WINDOW = int(os.getenv("DUPE_WINDOW", "600"))  # Seconds in which repeats of one content are counted
+DUPE_LIMIT = int(os.getenv("DUPE_LIMIT", "3"))  # Copies within DUPE_WINDOW in one group that count as spam
+DUPE_CROSS_LIMIT = int(os.getenv("DUPE_CROSS_LIMIT", "5"))  # Copies across all groups (0 = per-group only)
+DUPE_MIN_CHARS = 20  # Shorter normalized texts ("ok", "thanks") are never fingerprinted
+DUPE_CHAT_ENTRIES = 2000  # Fingerprints kept per group (LRU)
+DUPE_GLOBAL_ENTRIES = 100000  # Fingerprints kept across groups (LRU)
+DUPE_MUTE_SEC = 300
+
+def _combining_mark_class():
+    "Regex class body of the combining marks (Mn/Mc/Me) that \\W matches: Indic vowel signs, virama, ..."
+    ranges, start, prev = [], None, None
+    for cp in range(sys.maxunicode + 1):
+        char = chr(cp)
+        if unicodedata.category(char) in ('Mn', 'Mc', 'Me') and not char.isalnum():
+            if prev is not None and cp == prev + 1:
+                prev = cp
+                continue
+            if start is not None:
+                ranges.append((start, prev))
+            start = prev = cp
+    if start is not None:
+        ranges.append((start, prev))
+    return ''.join(f"\\U{a:08x}" if a == b else f"\\U{a:08x}-\\U{b:08x}" for a, b in ranges)
+
+# Punctuation, emoji, whitespace and '_' of canonical text; combining marks are kept so
+# "नमस्ते" and "नमसत" stay different fingerprints
+DUPE_STRIP_RE = re.compile(f"(?:[^\\w{_combining_mark_class()}]|_)+")
+
+# ---------- Text Canonicalization ----------
+# Invisible characters spammers put inside words: zero-width, bidi controls, variation selectors, fillers
+CANON_INVISIBLE_RE = re.compile("[\u00ad\u034f\u061c\u115f\u1160\u17b4\u17b5\u180b-\u180f\u200b-\u200f"
+                                "\u202a-\u202e\u2060-\u206f\u3164\ufe00-\ufe0f\ufeff\uffa0]")
+# Lowercase Cyrillic / Greek / IPA letters that look like Latin ones
+CANON_CONFUSABLES = {
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p', 'с': 'c',
+    'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ї': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w',
+    'ӏ': 'l', 'ɡ': 'g', 'ɩ': 'i', 'ο': 'o', 'α': 'a', 'β': 'b', 'ε': 'e', 'ι': 'i', 'κ': 'k', 'ν': 'v',
+    'ρ': 'p', 'τ': 't', 'υ': 'u', 'χ': 'x', 'γ': 'y', 'η': 'n', 'ω': 'w',
+}
+CANON_LEET = {'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b', '@': 'a', '$': 's', '|': 'i'}
+CANON_DIGITS = {chr(0x966 + d): str(d) for d in range(10)}  # Devanagari digits
+CANON_TABLE = str.maketrans({**{char: CANON_LEET.get(latin, latin) for char, latin in {**CANON_CONFUSABLES, **CANON_DIGITS}.items()},
+                             **CANON_LEET})
+CANON_ASCII_TABLE = str.maketrans(CANON_LEET)
+# ---------- Regex Triggers (sandboxed) ----------
+REGEX_MAX_LEN = 200  # Longest accepted regex trigger pattern
+REGEX_TIMEOUT = float(os.getenv("REGEX_TIMEOUT", "0.05"))  # CPU seconds one pattern may run before it is disabled
+REGEX_MESSAGE_BUDGET = float(os.getenv("REGEX_MESSAGE_BUDGET", "0.2"))  # Seconds for all regex triggers of one message
+REGEX_WORKERS = int(os.getenv("REGEX_WORKERS", "2"))  # Sandbox processes
+REGEX_NESTED_QUANTIFIER_RE = re.compile(r"\((?:[^()\\]|\\.)*[*+}]\)[*+{]")  # (a+)+, (\w*)*: catastrophic backtracking
+REGEX_BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=")
+
+LINK_HINT_RE = re.compile(r"https?:|www\.|\bt\.me/|telegram\.(?:me|dog)/")  # Links Telegram did not mark (on canonical text)
+
+# ---------- Link Policy (URL lock) ----------
+LINK_RULES_MAX = 200  # Domains per allow / deny list (locks_json url_allow / url_deny)
+
+# ---------- Analytics Action Codes ----------
+class Action(IntEnum):
+    "analytics.action codes; the lowercase name is the rollup kind (and the old string prefix)"
+    OTHER = 0
+    WARNED = 1
+    MUTED = 2
+    BANNED = 3
+    KICKED = 4
+    UNDO = 5
+    AUTO_MUTE = 6
+    UNBANNED = 7
+    CAPTCHA_PASSED = 10
+    CAPTCHA_FAILED = 11
+    WELCOME_CAPTCHA = 12
+    WELCOME_REJOIN = 13
+    LEAVE = 14
+    RAID_START = 15
+    RAID_END = 16
+    TRIGGER_MATCH = 20
+    LOCK_VIOLATION = 21
+    DUPLICATE_SPAM = 22
+    TOGGLE = 30
+    LANG_CHANGE = 31
+    XP_COOLDOWN = 32
+    NOTE_ADD = 40
+    NOTE_DELETE = 41
+    TRIGGER_ADD = 42
+    TRIGGER_DELETE = 43
+    BLACKLIST_ADD = 44
+    BLACKLIST_DELETE = 45
+    POLL_CREATE = 46
+    CONFIG_EXPORT = 50
+    CONFIG_IMPORT = 51
+    TEMPLATE_SAVE = 52
+    TEMPLATE_APPLY = 53
+
+ANALYTICS_SCHEMA_VERSION = 1  # PRAGMA user_version after the action-code migration
+STRING_CACHE_SIZE = 10000  # Interned strings kept in memory (LRU)
+STRING_MAX_LEN = 256  # Longer payload strings are truncated
+STRING_IDS = OrderedDict()  # {text: strings.id}
+STRING_LOCK = Lock()
+
+# ---------- Chat Config Cache & Feature Bitmap ----------
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", "300"))  # seconds
+CONFIG_CACHE = {}  # {chat_id: {'settings', 'blacklist', 'triggers', 'features', 'loaded_at'}}
+CONFIG_GENERATION = {}  # {chat_id: int} bumped by every invalidation, so in-flight loads don't store stale configs
+CONFIG_LOCK = Lock()
+FEAT_FLOOD = 1
+FEAT_BLACKLIST = 2
+FEAT_LOCK_URLS = 4
+FEAT_LOCK_MEDIA = 8
+FEAT_XP = 16
+FEAT_TRIGGERS = 32
+FEAT_DUPES = 64
+MEDIA_LOCK_KEYS = ('photos', 'videos', 'stickers', 'forwards', 'documents')
+FAST_PATH_STATS = {'messages': 0, 'fast_path': 0}  # Messages that skipped blacklist/locks/triggers
+FAST_PATH_LOCK = Lock()
+
+# ---------- Chat Metadata Cache ----------
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "900"))  # seconds
+CHAT_CACHE = {}  # {chat_id: {'title', 'type', 'fetched_at', 'permissions', 'perms_at'}}
+CHAT_CACHE_LOCK = Lock()
+
+# ---------- Managed Groups Index ----------
+ADMIN_INDEX_TTL = int(os.getenv("ADMIN_INDEX_TTL", "21600"))  # Full re-scan interval per user (seconds)
+ADMIN_SCAN_WORKERS = int(os.getenv("ADMIN_SCAN_WORKERS", "8"))  # Parallel get_chat_member probes
+ADMIN_REFRESHING = set()  # user ids with a background re-scan in flight
+ADMIN_REFRESH_LOCK = Lock()
+
+# ---------- Member Status Cache (admin/creator checks) ----------
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", "60"))  # seconds
+MEMBER_CACHE_SIZE = 50000
+MEMBER_CACHE = {}  # {(chat_id, user_id): (status, fetched_at)}
+MEMBER_CACHE_LOCK = Lock()
+
+# ---------- Chat Tracking ----------
+CHAT_ACTIVITY_INTERVAL = 300  # Min seconds between last_activity writes per chat
+CHAT_ACTIVITY_SEEN = {}  # {chat_id: last written activity ts}
+CHAT_ACTIVITY_LOCK = Lock()
+DEAD_CHAT_ERRORS = ('chat not found', 'bot was kicked', 'bot is not a member', 'not a member of the chat',
+                    'group chat was upgraded', 'chat was deleted')
 
 # ---------- Language Dictionary (Hindi Default) ----------
 # Added new keys for UX overhaul
@@ -70,10 +546,13 @@ LANG = {
         'user_banned': '🚫 {user} को ban कर दिया',
         'user_kicked': '👢 {user} को kick कर दिया',
         'flood_detected': '⚠️ Spam मत करो! ({count}/{limit})',
+        'dupe_detected': '♻️ एक ही content बार-बार भेजा जा रहा है ({count}x), हटाया गया।',
         'blacklist_violation': '❌ Blacklist word detect हुआ! Violation: {count}/3',
         'captcha_verify': '🔐 कृपया captcha solve करें:\n{q1} + {q2} = ?',
         'captcha_success': '✅ Captcha verified! Welcome {name}',
         'captcha_failed': '❌ Captcha गलत है।',
+        'captcha_kicked': '🚫 {name} ने {attempts} बार गलत captcha दिया, उन्हें ग्रुप से निकाल दिया गया।',
+        'captcha_kicked_button': '🚫 {name} ने गलत captcha बटन दबाया, उन्हें ग्रुप से निकाल दिया गया।',
         'welcome_message': '👋 Welcome {name}!',
         'goodbye_message': '👋 {name} left the group.',
         'usage': '📖 Usage: {usage}',
@@ -89,6 +568,8 @@ LANG = {
         'note_added': '✅ Note "{key}" add हो गया।',
         'note_deleted': '✅ Note "{key}" delete हो गया।',
         'trigger_added': '✅ Trigger add हो गया।',
+        'regex_invalid': '❌ Regex नहीं चलेगा: {error}\nठीक करके दोबारा भेजें।',
+        'regex_trigger_disabled': '⚠️ <b>{title}</b>: regex trigger <code>{pattern}</code> {ms} ms से ज़्यादा चला, इसलिए बंद कर दिया गया। Pattern ठीक करके trigger फिर से add करें।',
         'poll_created': '📊 Poll बन गया।',
         'xp_gained': '🎯 +{points} XP!',
         'rank_display': '🏆 {name}: Rank #{rank}, XP: {xp}',
@@ -103,6 +584,9 @@ LANG = {
         'moderation_desc': 'ग्रुप मॉडरेशन टूल्स। किसी यूजर को /warn, /mute, /ban, /kick करने के लिए उसके मैसेज को रिप्लाई करें।',
         'locks': '🔐 Locks',
         'locks_desc': 'कंट्रोल करें कि कौन से मीडिया प्रकारों की अनुमति है।',
+        'links_hint': '🔗 URL lock के साथ भी अपने domains allow करें: <code>/links allow example.com</code>',
+        'links_policy': '🔗 <b>Link policy</b> (URL lock: {state})\n✅ Allow: {allow}\n⛔ Deny: {deny}',
+        'links_too_many': '❌ हर लिस्ट में ज़्यादा से ज़्यादा {max} domains।',
         'notes': '📝 Notes',
         'notes_desc': 'पुन: प्रयोज्य टेक्स्ट सेव करें।',
         'triggers': '🤖 Triggers',
@@ -141,6 +625,8 @@ LANG = {
         'lock_forwards_desc': 'ग्रुप में किसी भी फॉरवर्ड किए गए संदेश को ब्लॉक करें।',
         'lock_documents': '📎 Documents',
         'lock_documents_desc': 'ग्रुप में फ़ाइलें/दस्तावेजों को ब्लॉक करें।',
+        'lock_duplicates': '♻️ Duplicates',
+        'lock_duplicates_desc': 'कुछ मिनट में बार-बार भेजे गए एक ही text/मीडिया (अलग-अलग users या ग्रुप्स से भी) को हटाएँ।',
         'add_word': '➕ शब्द जोड़ें',
         'list_words': '📋 शब्द लिस्ट करें',
         'add_note': '➕ Note जोड़ें',
@@ -156,6 +642,54 @@ LANG = {
         'menu_in_private_prompt': '⚙️ ग्रुप सेटिंग्स जटिल हो सकती हैं। आप उन्हें सुरक्षित रूप से हमारे प्राइवेट चैट में मैनेज कर सकते हैं।',
         'menu_in_private_button': '🔐 प्राइवेट में सेटिंग्स खोलें',
         'menu_in_private_opened': '⚙️ ग्रुप के लिए सेटिंग्स मैनेज की जा रही हैं: <b>{title}</b>\n\n{desc}',
+        'raid_detected': '🚨 Raid detect हुआ ({count} joins / {window}s)। नए members को batch में handle किया जाएगा।',
+        'raid_more': 'और {count} लोग',
+        'captcha_button_verify': '🔐 नीचे सही जवाब वाला बटन दबाएँ: {q1} + {q2} = ?',
+        'captcha_expired': '⌛ Captcha expire हो गया।',
+        'captcha_not_for_you': '❌ यह captcha आपके लिए नहीं है।',
+        'captcha_button_mode': '🔘 Button Captcha',
+        'captcha_button_mode_desc': 'Math answer टाइप करने की जगह नए users बटन दबाकर captcha solve करेंगे।',
+        'menu_expired': '⌛ यह मेनू पुराना हो गया है, फिर से खोलें।',
+        'list_search': '🔎 खोजें',
+        'list_search_prompt': '🔎 जिस शुरुआत (prefix) से खोजना है वो भेजें।',
+        'list_page_size': '{size} / पेज',
+        'import_button': '📥 Import (फ़ाइल)',
+        'import_prompt': '📥 फ़ाइल भेजें: हर लाइन में एक entry, CSV या JSON (/export वाला format भी चलेगा)।',
+        'import_done': '✅ Import पूरा: {summary}',
+        'import_failed': '❌ Import नहीं हो सका: {error}',
+        'import_too_large': '❌ फ़ाइल बहुत बड़ी है (max {size} KB)।',
+        'export_caption': '📤 <b>{title}</b> का config export',
+        'export_sent_private': '📤 Export आपको private में भेज दिया गया है।',
+        'template_saved': '✅ Template "{name}" save हो गया।',
+        'template_applied': '✅ Template "{name}" {count} ग्रुप्स पर लागू हुआ।',
+        'template_skipped': '⚠️ इन ग्रुप्स के आप क्रिएटर नहीं हैं: {chats}',
+        'template_not_found': '❌ Template "{name}" नहीं मिला।',
+        'template_deleted': '🗑️ Template "{name}" delete हो गया।',
+        'template_list': '📦 आपके templates:\n{items}',
+        'stats': '📈 Stats',
+        'stats_title': '📈 <b>Group Stats</b> ({period})',
+        'stats_body': '💬 Messages: <b>{messages}</b>\n➕ Joins: <b>{joins}</b>\n➖ Leaves: <b>{leaves}</b>\n🔨 Punishments: <b>{punishments}</b>',
+        'stats_top': '🏆 <b>Top users</b>',
+        'stats_period_today': 'आज',
+        'stats_period_7d': '7 दिन',
+        'stats_period_30d': '30 दिन',
+        'mass_progress': '⏳ <b>{action}</b>: {done}/{total} (✅ {ok}, ❌ {failed})',
+        'mass_done': '✅ <b>{action}</b> पूरा: {ok}/{total} सफल, {failed} fail, {skipped} admins/bot छोड़ दिए गए।',
+        'mass_no_targets': '❌ कोई user id नहीं मिली।',
+        'mass_too_many': '❌ एक बार में ज़्यादा से ज़्यादा {max} users।',
+        'mass_busy': '⏳ इस ग्रुप में एक mass कार्रवाई पहले से चल रही है।',
+        'fed_created': '✅ Federation "{name}" बन गई। ID: <code>{fed_id}</code>\nग्रुप जोड़ने के लिए (क्रिएटर): /fed join {fed_id}',
+        'fed_joined': '✅ यह ग्रुप federation "{name}" से जुड़ गया ({bans} bans लागू)।',
+        'fed_left': '✅ यह ग्रुप federation से हट गया।',
+        'fed_not_found': '❌ Federation नहीं मिली।',
+        'fed_none': '❌ यह ग्रुप किसी federation में नहीं है।',
+        'fed_info': '🌐 <b>{name}</b> (<code>{fed_id}</code>)\n👥 Groups: {chats}\n🚫 Bans: {bans}',
+        'fed_not_admin': '❌ यह सिर्फ़ federation owner/admins कर सकते हैं।',
+        'fed_banned': '🌐🚫 {user} federation "{name}" के {chats} ग्रुप्स से ban किया जा रहा है।',
+        'fed_unbanned': '🌐✅ {user} का federation ban हटा दिया गया।',
+        'fed_not_banned': '❌ यह user federation में banned नहीं है।',
+        'fed_target_admin': '❌ यह user federation के {chats} ग्रुप्स में admin है, इसे fban नहीं किया जा सकता।',
+        'fed_admins_updated': '✅ Federation admins: {admins}',
     },
     'en': {
         'admin_only': '❌ This command is admin-only.',
@@ -168,10 +702,13 @@ LANG = {
         'user_banned': '🚫 {user} banned',
         'user_kicked': '👢 {user} kicked',
         'flood_detected': '⚠️ Stop spamming! ({count}/{limit})',
+        'dupe_detected': '♻️ The same content is being posted repeatedly ({count}x), removed.',
         'blacklist_violation': '❌ Blacklist word detected! Violation: {count}/3',
         'captcha_verify': '🔐 Please solve captcha: {q1} + {q2} = ?',
         'captcha_success': '✅ Captcha verified! Welcome {name}',
         'captcha_failed': '❌ Wrong captcha.',
+        'captcha_kicked': '🚫 {name} failed the captcha {attempts} times and was removed from the group.',
+        'captcha_kicked_button': '🚫 {name} picked a wrong captcha button and was removed from the group.',
         'welcome_message': '👋 Welcome {name}!',
         'goodbye_message': '👋 {name} left the group.',
         'usage': '📖 Usage: {usage}',
@@ -187,6 +724,8 @@ LANG = {
         'note_added': '✅ Note "{key}" added.',
         'note_deleted': '✅ Note "{key}" deleted.',
         'trigger_added': '✅ Trigger added.',
+        'regex_invalid': '❌ Regex not accepted: {error}\nFix it and send again.',
+        'regex_trigger_disabled': '⚠️ <b>{title}</b>: regex trigger <code>{pattern}</code> ran longer than {ms} ms and was disabled. Fix the pattern and add the trigger again.',
         'poll_created': '📊 Poll created.',
         'xp_gained': '🎯 +{points} XP!',
         'rank_display': '🏆 {name}: Rank #{rank}, XP: {xp}',
@@ -201,6 +740,9 @@ LANG = {
         'moderation_desc': 'Tools for group moderation. Use commands like /warn, /mute, /ban by replying to a user.',
         'locks': '🔐 Locks',
         'locks_desc': 'Control which media types are allowed.',
+        'links_hint': '🔗 Allow your own domains even with the URL lock on: <code>/links allow example.com</code>',
+        'links_policy': '🔗 <b>Link policy</b> (URL lock: {state})\n✅ Allow: {allow}\n⛔ Deny: {deny}',
+        'links_too_many': '❌ At most {max} domains per list.',
         'notes': '📝 Notes',
         'notes_desc': 'Save reusable texts for the group.',
         'triggers': '🤖 Triggers',
@@ -239,6 +781,8 @@ LANG = {
         'lock_forwards_desc': 'Block any forwarded messages in the group.',
         'lock_documents': '📎 Documents',
         'lock_documents_desc': 'Block files/documents in the group.',
+        'lock_duplicates': '♻️ Duplicates',
+        'lock_duplicates_desc': 'Remove the same text/media posted again and again within minutes (also by different users or in other groups).',
         'add_word': '➕ Add Word',
         'list_words': '📋 List Words',
         'add_note': '➕ Add Note',
@@ -254,15 +798,63 @@ LANG = {
         'menu_in_private_prompt': '⚙️ Group settings can be complex. You can manage them securely in our private chat.',
         'menu_in_private_button': '🔐 Open Settings in Private',
         'menu_in_private_opened': '⚙️ Managing settings for group: <b>{title}</b>\n\n{desc}',
+        'raid_detected': '🚨 Raid detected ({count} joins / {window}s). New members will be handled in batches.',
+        'raid_more': 'and {count} more',
+        'captcha_button_verify': '🔐 Tap the button with the right answer: {q1} + {q2} = ?',
+        'captcha_expired': '⌛ This captcha has expired.',
+        'captcha_not_for_you': '❌ This captcha is not for you.',
+        'captcha_button_mode': '🔘 Button Captcha',
+        'captcha_button_mode_desc': 'New users solve the captcha by tapping a button instead of typing the answer.',
+        'menu_expired': '⌛ This menu has expired, please open it again.',
+        'list_search': '🔎 Search',
+        'list_search_prompt': '🔎 Send the prefix to search for.',
+        'list_page_size': '{size} / page',
+        'import_button': '📥 Import (file)',
+        'import_prompt': '📥 Send a file: one entry per line, CSV or JSON (the /export format works too).',
+        'import_done': '✅ Import finished: {summary}',
+        'import_failed': '❌ Import failed: {error}',
+        'import_too_large': '❌ File is too large (max {size} KB).',
+        'export_caption': '📤 Config export of <b>{title}</b>',
+        'export_sent_private': '📤 The export has been sent to you in private.',
+        'template_saved': '✅ Template "{name}" saved.',
+        'template_applied': '✅ Template "{name}" applied to {count} groups.',
+        'template_skipped': '⚠️ You are not the creator of these groups: {chats}',
+        'template_not_found': '❌ Template "{name}" not found.',
+        'template_deleted': '🗑️ Template "{name}" deleted.',
+        'template_list': '📦 Your templates:\n{items}',
+        'stats': '📈 Stats',
+        'stats_title': '📈 <b>Group Stats</b> ({period})',
+        'stats_body': '💬 Messages: <b>{messages}</b>\n➕ Joins: <b>{joins}</b>\n➖ Leaves: <b>{leaves}</b>\n🔨 Punishments: <b>{punishments}</b>',
+        'stats_top': '🏆 <b>Top users</b>',
+        'stats_period_today': 'Today',
+        'stats_period_7d': '7 days',
+        'stats_period_30d': '30 days',
+        'mass_progress': '⏳ <b>{action}</b>: {done}/{total} (✅ {ok}, ❌ {failed})',
+        'mass_done': '✅ <b>{action}</b> finished: {ok}/{total} succeeded, {failed} failed, {skipped} admins/bot skipped.',
+        'mass_no_targets': '❌ No user ids found.',
+        'mass_too_many': '❌ At most {max} users at a time.',
+        'mass_busy': '⏳ A mass action is already running in this group.',
+        'fed_created': '✅ Federation "{name}" created. ID: <code>{fed_id}</code>\nTo add a group (creator): /fed join {fed_id}',
+        'fed_joined': '✅ This group joined federation "{name}" ({bans} bans apply).',
+        'fed_left': '✅ This group left its federation.',
+        'fed_not_found': '❌ Federation not found.',
+        'fed_none': '❌ This group is not in a federation.',
+        'fed_info': '🌐 <b>{name}</b> (<code>{fed_id}</code>)\n👥 Groups: {chats}\n🚫 Bans: {bans}',
+        'fed_not_admin': '❌ Only the federation owner/admins can do this.',
+        'fed_banned': '🌐🚫 {user} is being banned from the {chats} groups of federation "{name}".',
+        'fed_unbanned': '🌐✅ Federation ban of {user} removed.',
+        'fed_not_banned': '❌ This user is not banned in the federation.',
+        'fed_target_admin': '❌ This user is an admin in {chats} groups of the federation and can\'t be fbanned.',
+        'fed_admins_updated': '✅ Federation admins: {admins}',
     }
 }
 
 
-def _(chat_id, key, **kwargs):
+def _(chat_id, lang_key, **kwargs):
     "Get translated text"
     row = get_settings(str(chat_id))
     lang = row.get('lang', 'hi')
-    text = LANG.get(lang, LANG['hi']).get(key, key)
+    text = LANG.get(lang, LANG['hi']).get(lang_key, lang_key)
     return text.format(**kwargs) if kwargs else text
 
 # ---------- Utility Functions (No change to core logic) ----------
@@ -301,7 +893,10 @@ def init_db():
     c.execute("CREATE TABLE IF NOT EXISTS settings (\n        chat_id TEXT PRIMARY KEY,\n        lang TEXT DEFAULT 'hi',\n        welcome_enabled INTEGER DEFAULT 1,\n        leave_enabled INTEGER DEFAULT 1,\n        flood_window INTEGER DEFAULT 15,\n        flood_limit INTEGER DEFAULT 7,\n        blacklist_enabled INTEGER DEFAULT 1,\n        locks_json TEXT DEFAULT '{}',\n        roles_json TEXT DEFAULT '{}',\n        rss_json TEXT DEFAULT '[]',\n        plugins_json TEXT DEFAULT '[]',\n        subscriptions_json TEXT DEFAULT '[]',\n        menu_json TEXT DEFAULT '{}'\n    )")
     
     # Triggers table (existing)
-    c.execute("CREATE TABLE IF NOT EXISTS triggers (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id TEXT,\n        pattern TEXT,\n        reply TEXT,\n        is_regex INTEGER DEFAULT 0\n    )")
+    c.execute("CREATE TABLE IF NOT EXISTS triggers (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id TEXT,\n        pattern TEXT,\n        reply TEXT,\n        is_regex INTEGER DEFAULT 0,\n        enabled INTEGER DEFAULT 1\n    )")
+    # enabled=0: regex trigger switched off after exceeding its time budget (older databases lack the column)
+    if 'enabled' not in [row['name'] for row in c.execute("PRAGMA table_info(triggers)").fetchall()]:
+        c.execute("ALTER TABLE triggers ADD COLUMN enabled INTEGER DEFAULT 1")
     
     # Notes table (existing)
     c.execute("CREATE TABLE IF NOT EXISTS notes (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id TEXT,\n        key TEXT,\n        content TEXT,\n        created_at INTEGER,\n        expires_at INTEGER DEFAULT 0\n    )")
@@ -322,15 +917,203 @@ def init_db():
     c.execute("CREATE TABLE IF NOT EXISTS dumps (\n        chat_id TEXT PRIMARY KEY,\n        enabled INTEGER DEFAULT 0,\n        forward_to TEXT\n    )")
     
     # Analytics table (existing)
-    c.execute("CREATE TABLE IF NOT EXISTS analytics (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id TEXT,\n        user_id TEXT,\n        action TEXT,\n        at INTEGER\n    )")
+    c.execute("CREATE TABLE IF NOT EXISTS analytics (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id INTEGER,\n        user_id INTEGER,\n        action INTEGER,\n        arg INTEGER,\n        value INTEGER,\n        at INTEGER\n    )")
+    
+    # Interned payload strings (reasons, patterns, keys) referenced by analytics.arg
+    c.execute("CREATE TABLE IF NOT EXISTS strings (\n        id INTEGER PRIMARY KEY,\n        text TEXT UNIQUE\n    )")
+    # Action code -> kind name (used by the rollups)
+    c.execute("CREATE TABLE IF NOT EXISTS action_kinds (\n        code INTEGER PRIMARY KEY,\n        name TEXT\n    )")
+    c.executemany("INSERT OR REPLACE INTO action_kinds (code, name) VALUES (?,?)",
+                  [(int(action), action.name.lower()) for action in Action])
     
     # Punishments table (existing)
-    c.execute("CREATE TABLE IF NOT EXISTS punishments (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id TEXT,\n        user_id TEXT,\n        type TEXT,\n        until_ts INTEGER\n    )")
+    c.execute("CREATE TABLE IF NOT EXISTS punishments (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id TEXT,\n        user_id TEXT,\n        type TEXT,\n        until_ts INTEGER,\n        created_at INTEGER,\n        active INTEGER DEFAULT 1,\n        reason TEXT\n    )")
+    # Active entries per (chat, user, type) for warn/blacklist escalation (kept equal to the active ledger rows)
+    c.execute("CREATE TABLE IF NOT EXISTS punishment_counters (\n        chat_id TEXT,\n        user_id TEXT,\n        type TEXT,\n        count INTEGER DEFAULT 0,\n        updated_at INTEGER,\n        PRIMARY KEY (chat_id, user_id, type)\n    )")
+    
+    # Federations: groups sharing one ban list (admins_json = user ids allowed to /fban besides the owner)
+    c.execute("CREATE TABLE IF NOT EXISTS federations (\n        fed_id TEXT PRIMARY KEY,\n        name TEXT,\n        owner_id TEXT,\n        admins_json TEXT DEFAULT '[]',\n        created_at INTEGER\n    )")
+    c.execute("CREATE TABLE IF NOT EXISTS federation_chats (\n        chat_id TEXT PRIMARY KEY,\n        fed_id TEXT\n    )")
+    c.execute("CREATE TABLE IF NOT EXISTS federation_bans (\n        fed_id TEXT,\n        user_id TEXT,\n        reason TEXT,\n        banned_by TEXT,\n        at INTEGER,\n        PRIMARY KEY (fed_id, user_id)\n    )")
+
+    # Admin index: user_id -> groups where user is creator/admin (maintained from chat_member updates)
+    c.execute("CREATE TABLE IF NOT EXISTS admin_index (\n        user_id TEXT,\n        chat_id TEXT,\n        status TEXT,\n        updated_at INTEGER,\n        PRIMARY KEY (user_id, chat_id)\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_admin_index_chat ON admin_index (chat_id)")
+    c.execute("CREATE TABLE IF NOT EXISTS admin_index_scans (\n        user_id TEXT PRIMARY KEY,\n        scanned_at INTEGER\n    )")
+    
+    # Chats table: bot membership state per group (updated from my_chat_member & API errors)
+    c.execute("CREATE TABLE IF NOT EXISTS chats (\n        chat_id TEXT PRIMARY KEY,\n        type TEXT,\n        title TEXT,\n        status TEXT DEFAULT 'unknown',\n        is_active INTEGER DEFAULT 1,\n        last_activity INTEGER DEFAULT 0,\n        bot_perms_json TEXT DEFAULT '{}',\n        updated_at INTEGER\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chats_active ON chats (is_active)")
+    
+    # Key-value state: persisted STATE flows and pending captchas (see ShardedState)
+    c.execute("CREATE TABLE IF NOT EXISTS kv_state (\n        namespace TEXT,\n        key TEXT,\n        chat_id TEXT,\n        value_json TEXT,\n        expires_at INTEGER DEFAULT 0,\n        PRIMARY KEY (namespace, key)\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_kv_state_chat ON kv_state (namespace, chat_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_kv_state_expiry ON kv_state (namespace, expires_at)")
+    
+    # Known members: rejoin tracker (users seen joining a chat), pruned after REJOIN_RETENTION_DAYS
+    c.execute("CREATE TABLE IF NOT EXISTS known_members (\n        chat_id TEXT,\n        user_id TEXT,\n        first_seen INTEGER,\n        last_seen INTEGER,\n        PRIMARY KEY (chat_id, user_id)\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_known_members_seen ON known_members (chat_id, last_seen)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_known_members_last_seen ON known_members (last_seen)")
+    
+    # Scheduled jobs (e.g., button captcha expiry), processed in batches by scheduler_thread
+    c.execute("CREATE TABLE IF NOT EXISTS scheduled_jobs (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        run_at INTEGER,\n        kind TEXT,\n        ref TEXT,\n        payload_json TEXT\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_run_at ON scheduled_jobs (run_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_ref ON scheduled_jobs (kind, ref)")
+    
+    # Config templates (snapshot of a group's config, applied to many groups)
+    c.execute("CREATE TABLE IF NOT EXISTS config_templates (\n        owner_id TEXT,\n        name TEXT,\n        source_chat_id TEXT,\n        config_json TEXT,\n        created_at INTEGER,\n        PRIMARY KEY (owner_id, name)\n    )")
+    
+    # Per-chat indexes for keyset-paginated list menus: (chat_id) walks id order,
+    # (chat_id, key) serves prefix searches
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notes_chat ON notes (chat_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_triggers_chat ON triggers (chat_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_blacklist_chat ON blacklist (chat_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notes_chat_key ON notes (chat_id, key)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_triggers_chat_pattern ON triggers (chat_id, pattern)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_blacklist_chat_word ON blacklist (chat_id, word)")
+    
+    # Analytics rollups per (chat, period, action kind); kind = action text before the first ':'
+    c.execute("CREATE TABLE IF NOT EXISTS analytics_hourly (\n        chat_id TEXT,\n        hour_ts INTEGER,\n        kind TEXT,\n        count INTEGER DEFAULT 0,\n        PRIMARY KEY (chat_id, hour_ts, kind)\n    )")
+    c.execute("CREATE TABLE IF NOT EXISTS analytics_daily (\n        chat_id TEXT,\n        day_ts INTEGER,\n        kind TEXT,\n        count INTEGER DEFAULT 0,\n        PRIMARY KEY (chat_id, day_ts, kind)\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_analytics_hourly_ts ON analytics_hourly (hour_ts)")
+    
+    # Per-user daily message counts for /stats top users (flushed from in-memory counters)
+    c.execute("CREATE TABLE IF NOT EXISTS stats_user_daily (\n        chat_id TEXT,\n        day_ts INTEGER,\n        user_id TEXT,\n        name TEXT,\n        messages INTEGER DEFAULT 0,\n        PRIMARY KEY (chat_id, day_ts, user_id)\n    )")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stats_user_daily_ts ON stats_user_daily (day_ts)")
+    
+    # Watermarks of background maintenance (e.g., last analytics id rolled up)
+    c.execute("CREATE TABLE IF NOT EXISTS maintenance_state (\n        name TEXT PRIMARY KEY,\n        value INTEGER\n    )")
+    
+    # Seed groups known only from settings (older databases)
+    c.execute("INSERT OR IGNORE INTO chats (chat_id, status, is_active, updated_at) \n              SELECT chat_id, 'unknown', 1, ? FROM settings WHERE chat_id LIKE '-%'", (now_ts(),))
     
     conn.commit()
+    
+    # Free-form action strings -> action codes (older databases)
+    if c.execute("PRAGMA user_version").fetchone()[0] < ANALYTICS_SCHEMA_VERSION:
+        migrate_analytics(conn)
+    # Analytics is read by id range only (rollups, prune); a secondary index would just slow every insert
+    c.execute("DROP INDEX IF EXISTS idx_analytics_chat_action")
+    migrate_punishments(conn)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_punishments_user ON punishments (chat_id, user_id, id)")
+    conn.commit()
+    
+    # Incremental auto-vacuum lets retention deletes give space back without a full VACUUM.
+    # Switching an existing database needs one VACUUM (one-time migration).
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("VACUUM")
+        logging.info("🧹 Database switched to incremental auto-vacuum")
     conn.close()
     logging.info("✅ Database initialized successfully")
 
+def parse_legacy_action(action):
+    "Old analytics string (\"toggle:lock_urls:1\", \"muted:60s\") -> (Action, arg, value)"
+    kind, _sep, rest = (action or '').partition(':')
+    code = Action.__members__.get(kind.upper())
+    if code is None:
+        return Action.OTHER, action, None
+    if code == Action.TOGGLE and ':' in rest:
+        key, value = rest.rsplit(':', 1)
+        return code, key, int(value) if value.lstrip('-').isdigit() else None
+    number = rest[:-1] if code == Action.MUTED and rest.endswith('s') else rest
+    if number.lstrip('-').isdigit():
+        return code, None, int(number)
+    return code, rest or None, None
+
+def migrate_analytics(conn):
+    """
+    One-time migration of analytics from TEXT action strings to action codes with interned payloads
+    (ids kept, so the rollup watermark stays valid). Sets PRAGMA user_version.
+    """
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(analytics)").fetchall()]
+    if 'arg' not in columns:
+        logging.info("🔄 Migrating analytics to action codes...")
+        conn.execute("CREATE TABLE analytics_new (\n        id INTEGER PRIMARY KEY AUTOINCREMENT,\n        chat_id INTEGER,\n        user_id INTEGER,\n        action INTEGER,\n        arg INTEGER,\n        value INTEGER,\n        at INTEGER\n    )")
+        last_id = 0
+        migrated = 0
+        fresh = {}
+        while True:
+            rows = conn.execute("SELECT id, chat_id, user_id, action, at FROM analytics WHERE id > ? ORDER BY id LIMIT 50000",
+                                (last_id,)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            converted = []
+            for row in rows:
+                code, arg, value = parse_legacy_action(row['action'])
+                converted.append((row['id'], row['chat_id'], row['user_id'], int(code), intern_string(conn, arg, fresh), value, row['at']))
+            conn.executemany("INSERT INTO analytics_new (id, chat_id, user_id, action, arg, value, at) VALUES (?,?,?,?,?,?,?)", converted)
+            migrated += len(rows)
+        conn.execute("DROP TABLE analytics")
+        conn.execute("ALTER TABLE analytics_new RENAME TO analytics")
+        logging.info(f"✅ Migrated {migrated} analytics rows")
+    conn.execute(f"PRAGMA user_version = {ANALYTICS_SCHEMA_VERSION}")
+    conn.commit()
+    if 'arg' not in columns:
+        cache_strings(fresh)
+
+def migrate_punishments(conn):
+    """
+    One-time migration of the punishments ledger (older databases): adds created_at/active,
+    deactivates ended mutes and expired warns, seeds punishment_counters and schedules expiry jobs.
+    Also adds the reason column (e.g. 'fed:<id>' tags federation bans).
+    """
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(punishments)").fetchall()]
+    if 'reason' not in columns:
+        conn.execute("ALTER TABLE punishments ADD COLUMN reason TEXT")
+        conn.commit()
+    if 'active' in columns:
+        return
+    logging.info("🔄 Migrating punishments ledger...")
+    now = now_ts()
+    counted = ','.join('?' * len(COUNTED_PUNISHMENTS))
+    conn.execute("ALTER TABLE punishments ADD COLUMN created_at INTEGER")
+    conn.execute("ALTER TABLE punishments ADD COLUMN active INTEGER DEFAULT 1")
+    # warn/blacklist rows stored their creation time in until_ts
+    conn.execute(f"UPDATE punishments SET created_at=until_ts, until_ts=0 WHERE type IN ({counted})", COUNTED_PUNISHMENTS)
+    conn.execute("UPDATE punishments SET active=0 WHERE type='mute' AND until_ts<=?", (now,))
+    if WARN_EXPIRY_DAYS:
+        conn.execute(f"UPDATE punishments SET active=0 WHERE type IN ({counted}) AND created_at<=?",
+                     COUNTED_PUNISHMENTS + (now - WARN_EXPIRY_DAYS * 86400,))
+    conn.execute(f"INSERT OR REPLACE INTO punishment_counters (chat_id, user_id, type, count, updated_at) \n                  SELECT chat_id, user_id, type, COUNT(*), MAX(created_at) FROM punishments \n                  WHERE active=1 AND type IN ({counted}) GROUP BY chat_id, user_id, type", COUNTED_PUNISHMENTS)
+    jobs = []
+    for row in conn.execute("SELECT id, type, until_ts, created_at FROM punishments WHERE active=1").fetchall():
+        if row['type'] == 'mute':
+            jobs.append((row['until_ts'], 'punishment_expire', str(row['id']), jdump({'id': row['id']})))
+        elif row['type'] in COUNTED_PUNISHMENTS and WARN_EXPIRY_DAYS:
+            jobs.append(((row['created_at'] or now) + WARN_EXPIRY_DAYS * 86400, 'punishment_expire', str(row['id']), jdump({'id': row['id']})))
+    conn.executemany("INSERT INTO scheduled_jobs (run_at, kind, ref, payload_json) VALUES (?,?,?,?)", jobs)
+    conn.commit()
+    logging.info(f"✅ Punishments migrated ({len(jobs)} expiry jobs scheduled)")
+
+def intern_string(conn, text, fresh):
+    """
+    Id of text in the strings table (inserted if new); None for None.
+    Ids looked up in conn's open transaction are collected in fresh ({text: id}) and only
+    reach STRING_IDS via cache_strings(fresh) after the caller commits, so a rollback
+    can't leave an id in the cache that doesn't exist on disk.
+    """
+    if text is None:
+        return None
+    text = str(text)[:STRING_MAX_LEN]
+    with STRING_LOCK:
+        string_id = STRING_IDS.get(text)
+        if string_id is not None:
+            STRING_IDS.move_to_end(text)
+            return string_id
+    if text not in fresh:
+        conn.execute("INSERT OR IGNORE INTO strings (text) VALUES (?)", (text,))
+        fresh[text] = conn.execute("SELECT id FROM strings WHERE text=?", (text,)).fetchone()[0]
+    return fresh[text]
+
+def cache_strings(fresh):
+    "Publish ids collected by intern_string once their transaction is committed"
+    with STRING_LOCK:
+        STRING_IDS.update(fresh)
+        while len(STRING_IDS) > STRING_CACHE_SIZE:
+            STRING_IDS.popitem(last=False)
+
 init_db()
 
 # ---------- Settings Helper Functions (existing, preserved) ----------
@@ -345,15 +1128,90 @@ def ensure_settings(chat_id):
         conn.commit()
     conn.close()
 
-def get_settings(chat_id):
-    "Get settings row as dict"
-    ensure_settings(str(chat_id))
+def _load_chat_config(chat_id):
+    "Load settings row, blacklist and triggers of a chat and compute its feature bitmap"
+    ensure_settings(chat_id)
     conn = db()
     c = conn.cursor()
-    c.execute("SELECT * FROM settings WHERE chat_id=?", (str(chat_id),))
+    c.execute("SELECT * FROM settings WHERE chat_id=?", (chat_id,))
     row = c.fetchone()
+    settings = dict(row) if row else {}
+    c.execute("SELECT word FROM blacklist WHERE chat_id=?", (chat_id,))
+    blacklist = [canonicalize(r['word']) for r in c.fetchall()]
+    c.execute("SELECT id, pattern, reply, is_regex FROM triggers WHERE chat_id=? AND enabled=1 ORDER BY id", (chat_id,))
+    triggers = []
+    for trigger in map(dict, c.fetchall()):
+        if trigger['is_regex'] and validate_regex(trigger['pattern']):
+            continue  # Stored before validation existed; never run it
+        trigger['canonical'] = canonicalize(trigger['pattern'])
+        triggers.append(trigger)
     conn.close()
-    return dict(row) if row else {}
+
+    locks = jload(settings.get('locks_json', '{}'), {})
+    menu = jload(settings.get('menu_json', '{}'), {})
+
+    features = 0
+    if settings.get('flood_limit', 7) > 0:
+        features |= FEAT_FLOOD
+    if settings.get('blacklist_enabled') and blacklist:
+        features |= FEAT_BLACKLIST
+    link_policy = LinkPolicy(bool(locks.get('urls')), locks.get('url_allow') or (), locks.get('url_deny') or ())
+    if link_policy.active:
+        features |= FEAT_LOCK_URLS
+    if any(locks.get(key) for key in MEDIA_LOCK_KEYS):
+        features |= FEAT_LOCK_MEDIA
+    if menu.get('xp_settings', {}).get('xp_enabled', 1):
+        features |= FEAT_XP
+    if triggers:
+        features |= FEAT_TRIGGERS
+    if locks.get('duplicates'):
+        features |= FEAT_DUPES
+
+    return {
+        'settings': settings,
+        'blacklist': blacklist,
+        'triggers': triggers,
+        'link_policy': link_policy,
+        'features': features,
+        'loaded_at': now_ts()
+    }
+
+def get_chat_config(chat_id):
+    "Get cached chat config (settings, blacklist, triggers, feature bitmap); treat as read-only"
+    key = str(chat_id)
+    with CONFIG_LOCK:
+        config = CONFIG_CACHE.get(key)
+        if config and now_ts() - config['loaded_at'] < CONFIG_CACHE_TTL:
+            return config
+        generation = CONFIG_GENERATION.get(key, 0)
+    config = _load_chat_config(key)
+    with CONFIG_LOCK:
+        # Invalidated while loading: serve this copy once, but don't cache what may be stale
+        if CONFIG_GENERATION.get(key, 0) == generation:
+            CONFIG_CACHE[key] = config
+    return config
+
+def invalidate_chat_config(chat_id):
+    "Drop cached config after settings/blacklist/triggers change"
+    key = str(chat_id)
+    with CONFIG_LOCK:
+        CONFIG_CACHE.pop(key, None)
+        CONFIG_GENERATION[key] = CONFIG_GENERATION.get(key, 0) + 1
+
+def chat_features(chat_id):
+    "Feature bitmap of a chat (FEAT_* flags)"
+    return get_chat_config(chat_id)['features']
+
+def record_fast_path(is_fast):
+    "Count a group message and whether it skipped all optional pipeline stages"
+    with FAST_PATH_LOCK:
+        FAST_PATH_STATS['messages'] += 1
+        if is_fast:
+            FAST_PATH_STATS['fast_path'] += 1
+
+def get_settings(chat_id):
+    "Get settings row as dict (served from config cache)"
+    return dict(get_chat_config(chat_id)['settings'])
 
 def set_setting(chat_id, key, value):
     "Update single setting"
@@ -363,6 +1221,7 @@ def set_setting(chat_id, key, value):
     c.execute(f"UPDATE settings SET {key}=? WHERE chat_id=?", (value, str(chat_id)))
     conn.commit()
     conn.close()
+    invalidate_chat_config(chat_id)
 
 def menu_get(chat_id):
     "Get menu_json as dict"
@@ -391,94 +1250,291 @@ def locks_set(chat_id, data):
     "Set locks_json"
     set_setting(str(chat_id), 'locks_json', jdump(data))
 
+# ---------- Bot Identity & Chat Metadata Cache ----------
+def get_bot_info():
+    "Return cached bot identity (get_me is called only once)"
+    global BOT_INFO, BOT_USERNAME
+    if BOT_INFO is None:
+        BOT_INFO = bot.get_me()
+        BOT_USERNAME = BOT_INFO.username
+    return BOT_INFO
+
+def update_chat_cache(chat_id, **fields):
+    "Merge fields into the cached metadata of a chat and return a copy"
+    with CHAT_CACHE_LOCK:
+        entry = CHAT_CACHE.setdefault(str(chat_id), {})
+        entry.update(fields)
+        return dict(entry)
+
+def invalidate_chat_cache(chat_id):
+    "Drop cached metadata for a chat"
+    with CHAT_CACHE_LOCK:
+        CHAT_CACHE.pop(str(chat_id), None)
+
+def get_chat_info(chat_id):
+    "Get chat metadata (title, type) from cache, refreshing after CHAT_CACHE_TTL"
+    with CHAT_CACHE_LOCK:
+        entry = CHAT_CACHE.get(str(chat_id))
+        if entry and 'title' in entry and now_ts() - entry.get('fetched_at', 0) < CHAT_CACHE_TTL:
+            return dict(entry)
+
+    chat = bot.get_chat(chat_id)  # Raises if the bot can't see the chat
+    return update_chat_cache(chat_id, title=chat.title, type=chat.type, fetched_at=now_ts())
+
+def get_chat_title(chat_id, default=""):
+    "Get cached chat title, falling back to default on API errors"
+    try:
+        return get_chat_info(chat_id).get('title') or default
+    except Exception:
+        return default
+
+def _bot_permissions_from_member(member):
+    "Convert bot's ChatMember object to permissions dict"
+    return {
+        'can_restrict': bool(getattr(member, 'can_restrict_members', False)),
+        'can_delete': bool(getattr(member, 'can_delete_messages', False)),
+        'can_invite': bool(getattr(member, 'can_invite_users', False)),
+        'can_pin': bool(getattr(member, 'can_pin_messages', False)),
+        'is_admin': member.status == 'administrator'
+    }
+
+# ---------- Chat Tracking (bot membership state) ----------
+def chat_track(chat_id, status=None, chat=None, permissions=None):
+    "Upsert a chat's membership row; left/kicked statuses mark it inactive"
+    is_active = 0 if status in ['left', 'kicked', 'migrated', 'dead'] else 1
+    conn = db()
+    conn.execute("INSERT INTO chats (chat_id, type, title, status, is_active, last_activity, bot_perms_json, updated_at) \n                  VALUES (?,?,?,?,?,?,?,?) \n                  ON CONFLICT(chat_id) DO UPDATE SET \n                  type=COALESCE(excluded.type, type), title=COALESCE(excluded.title, title), \n                  status=COALESCE(excluded.status, status), is_active=excluded.is_active, \n                  bot_perms_json=COALESCE(excluded.bot_perms_json, bot_perms_json), updated_at=excluded.updated_at",
+                 (str(chat_id),
+                  chat.type if chat else None,
+                  chat.title if chat else None,
+                  status,
+                  is_active,
+                  now_ts(),
+                  jdump(permissions) if permissions is not None else None,
+                  now_ts()))
+    conn.commit()
+    conn.close()
+    with CHAT_ACTIVITY_LOCK:
+        if is_active:
+            CHAT_ACTIVITY_SEEN[str(chat_id)] = now_ts()
+        else:
+            CHAT_ACTIVITY_SEEN.pop(str(chat_id), None)
+
+def touch_chat_activity(chat_id):
+    "Record activity in a group (written at most once per CHAT_ACTIVITY_INTERVAL)"
+    key = str(chat_id)
+    now = now_ts()
+    with CHAT_ACTIVITY_LOCK:
+        if now - CHAT_ACTIVITY_SEEN.get(key, 0) < CHAT_ACTIVITY_INTERVAL:
+            return
+        CHAT_ACTIVITY_SEEN[key] = now
+    try:
+        conn = db()
+        conn.execute("INSERT INTO chats (chat_id, status, is_active, last_activity, updated_at) VALUES (?, 'member', 1, ?, ?) \n                      ON CONFLICT(chat_id) DO UPDATE SET is_active=1, last_activity=excluded.last_activity",
+                     (key, now, now))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logging.warning(f"Chat activity update failed: {e}")
+
+def get_active_chat_ids():
+    "Return ids of groups where the bot is still a member"
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT chat_id FROM chats WHERE is_active=1")
+    ids = [row['chat_id'] for row in c.fetchall()]
+    conn.close()
+    return ids
+
+def note_chat_api_error(chat_id, error):
+    "Mark chat inactive if an API error says the bot can't reach it; return True if so"
+    text = str(error).lower()
+    if any(marker in text for marker in DEAD_CHAT_ERRORS):
+        logging.warning(f"Marking chat {chat_id} inactive: {error}")
+        chat_track(chat_id, status='dead')
+        invalidate_chat_cache(chat_id)
+        return True
+    return False
+
 # ---------- Admin & Permission Check Functions (existing, preserved) ----------
+def get_member_status(chat_id, user_id):
+    "Get a user's status in a chat, cached for MEMBER_CACHE_TTL (None if unavailable)"
+    key = (str(chat_id), str(user_id))
+    now = now_ts()
+    with MEMBER_CACHE_LOCK:
+        cached = MEMBER_CACHE.get(key)
+        if cached and now - cached[1] < MEMBER_CACHE_TTL:
+            return cached[0]
+    try:
+        status = bot.get_chat_member(chat_id, user_id).status
+    except Exception:
+        return None
+    set_member_status(chat_id, user_id, status)
+    return status
+
+def set_member_status(chat_id, user_id, status):
+    "Store a known member status (e.g., from chat_member updates)"
+    with MEMBER_CACHE_LOCK:
+        MEMBER_CACHE[(str(chat_id), str(user_id))] = (status, now_ts())
+        if len(MEMBER_CACHE) > MEMBER_CACHE_SIZE:
+            # Drop the oldest half when the cache grows too big
+            for key in sorted(MEMBER_CACHE, key=lambda k: MEMBER_CACHE[k][1])[:len(MEMBER_CACHE) // 2]:
+                del MEMBER_CACHE[key]
+
 def is_admin_member(chat_id, user_id):
     "Check if user is admin in the chat"
+    return get_member_status(chat_id, user_id) in ['creator', 'administrator']
+        
+# -------------------- Managed Groups (Membership Index) --------------------
+def admin_index_set(chat_id, user_id, status):
+    "Record a user's admin status in a chat (non-admin statuses remove the entry)"
+    conn = db()
+    c = conn.cursor()
+    if status in ['creator', 'administrator']:
+        c.execute("INSERT INTO admin_index (user_id, chat_id, status, updated_at) VALUES (?,?,?,?) \n                  ON CONFLICT(user_id, chat_id) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at",
+                  (str(user_id), str(chat_id), status, now_ts()))
+    else:
+        c.execute("DELETE FROM admin_index WHERE user_id=? AND chat_id=?", (str(user_id), str(chat_id)))
+    conn.commit()
+    conn.close()
+
+def admin_index_drop_chat(chat_id):
+    "Forget every admin entry of a chat (bot removed from it)"
+    conn = db()
+    conn.execute("DELETE FROM admin_index WHERE chat_id=?", (str(chat_id),))
+    conn.commit()
+    conn.close()
+
+def _admin_index_lookup(user_id):
+    "Return (scanned_at, [(chat_id, status), ...]) from the persisted index"
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT scanned_at FROM admin_index_scans WHERE user_id=?", (str(user_id),))
+    row = c.fetchone()
+    scanned_at = row['scanned_at'] if row else None
+    c.execute("SELECT chat_id, status FROM admin_index WHERE user_id=?", (str(user_id),))
+    entries = [(r['chat_id'], r['status']) for r in c.fetchall()]
+    conn.close()
+    return scanned_at, entries
+
+def _probe_group_membership(chat_id, user_id):
+    "Worker: return (chat_id, status, title) or None if the chat is unreachable"
     try:
         member = bot.get_chat_member(chat_id, user_id)
-        return member.status in ['creator', 'administrator']
-    except:
-        return False
-        
-# -------------------- नया हेल्पर फ़ंक्शन (Add this block) --------------------
+        set_member_status(chat_id, user_id, member.status)
+        if member.status not in ['creator', 'administrator']:
+            return chat_id, member.status, None
+        return chat_id, member.status, get_chat_title(chat_id, str(chat_id))
+    except telebot.apihelper.ApiTelegramException as e:
+        # यदि चैट नहीं मिली (बॉट को हटा दिया गया या पहुँच नहीं है), तो इसे inactive mark करें
+        if not note_chat_api_error(chat_id, e):
+            logging.error(f"Error fetching chat info for {chat_id}: {e}")
+    except Exception as e:
+        logging.error(f"Unexpected error fetching chat info for {chat_id}: {e}")
+    return None
+
+def refresh_admin_index(user_id):
+    "Rebuild a user's index entries by probing all groups in parallel (bounded workers)"
+    all_group_ids = get_active_chat_ids()
+
+    with ThreadPoolExecutor(max_workers=ADMIN_SCAN_WORKERS) as pool:
+        results = [r for r in pool.map(lambda cid: _probe_group_membership(cid, user_id), all_group_ids) if r]
+
+    entries = [(cid, status) for cid, status, _title in results if status in ['creator', 'administrator']]
+
+    conn = db()
+    c = conn.cursor()
+    c.execute("DELETE FROM admin_index WHERE user_id=?", (str(user_id),))
+    c.executemany("INSERT INTO admin_index (user_id, chat_id, status, updated_at) VALUES (?,?,?,?)",
+                  [(str(user_id), cid, status, now_ts()) for cid, status in entries])
+    c.execute("INSERT OR REPLACE INTO admin_index_scans (user_id, scanned_at) VALUES (?,?)", (str(user_id), now_ts()))
+    conn.commit()
+    conn.close()
+    return entries
+
+def _refresh_admin_index_background(user_id):
+    "Background re-scan; at most one per user runs at a time"
+    try:
+        refresh_admin_index(user_id)
+    except Exception as e:
+        logging.error(f"Admin index refresh failed for {user_id}: {e}")
+    finally:
+        with ADMIN_REFRESH_LOCK:
+            ADMIN_REFRESHING.discard(user_id)
+
 def get_user_managed_groups(user_id):
     """
     यूज़र द्वारा प्रबंधित ग्रुप (जहाँ यूज़र क्रिएटर है और बॉट एक्टिव है) की सूची लाता है।
-    यह फ़ंक्शन मानता है कि 'settings' टेबल में बॉट के एक्टिव सभी ग्रुप_आईडी मौजूद हैं।
+    Persisted admin_index से पढ़ता है (chat_member updates से maintained); पहली बार या
+    ADMIN_INDEX_TTL के बाद index parallel scan से refresh होता है।
     """
-    conn = db()
-    c = conn.cursor()
-    # उन सभी chat_id को चुनें जो ग्रुप (नेगेटिव ID) हैं
-    c.execute("SELECT DISTINCT chat_id FROM settings WHERE chat_id LIKE '-%'")
-    all_group_ids = [row['chat_id'] for row in c.fetchall()]
-    conn.close()
-    
+    scanned_at, entries = _admin_index_lookup(user_id)
+
+    if scanned_at is None:
+        # Never scanned: build the index synchronously (parallel probes)
+        entries = refresh_admin_index(user_id)
+    elif now_ts() - scanned_at > ADMIN_INDEX_TTL:
+        # Stale: serve the index now, refresh in the background (unless already refreshing)
+        with ADMIN_REFRESH_LOCK:
+            start = user_id not in ADMIN_REFRESHING
+            ADMIN_REFRESHING.add(user_id)
+        if start:
+            Thread(target=_refresh_admin_index_background, args=(user_id,), daemon=True).start()
+
     managed_groups = []
-    for chat_id in all_group_ids:
-        # क्रिएटर की जाँच करें (is_creator_member फ़ंक्शन का उपयोग करके)
-        if is_creator_member(chat_id, user_id):
-            # ग्रुप का टाइटल प्राप्त करने का प्रयास करें
-            try:
-                # यदि बॉट ग्रुप से हटा दिया गया है, तो यह API कॉल विफल हो जाएगा
-                group_info = bot.get_chat(chat_id) 
-                
-                # सुनिश्चित करें कि बॉट अभी भी ग्रुप में है (get_chat() सफल होने का मतलब है कि ग्रुप मौजूद है)
-                
-                managed_groups.append({
-                    'id': chat_id, 
-                    'title': group_info.title
-                })
-            except telebot.apihelper.ApiTelegramException as e:
-                # यदि चैट नहीं मिली (बॉट को हटा दिया गया या पहुँच नहीं है), तो इसे नज़रअंदाज़ करें
-                if 'chat not found' in str(e) or 'not a member of the chat' in str(e):
-                    logging.warning(f"Bot removed or chat not found for ID: {chat_id}")
-                else:
-                    logging.error(f"Error fetching chat info for {chat_id}: {e}")
-                pass
-            except Exception as e:
-                logging.error(f"Unexpected error fetching chat info for {chat_id}: {e}")
-                pass
+    for chat_id, status in entries:
+        if status != 'creator':
+            continue
+        managed_groups.append({
+            'id': chat_id,
+            'title': get_chat_title(chat_id, str(chat_id))
+        })
     return managed_groups
     
 
 def is_creator_member(chat_id, user_id):
     "Check if user is creator of the chat"
-    try:
-        member = bot.get_chat_member(chat_id, user_id)
-        return member.status == 'creator'
-    except:
-        return False
+    return get_member_status(chat_id, user_id) == 'creator'
+
+def filter_creator_chats(chat_ids, user_id):
+    "Subset of chat_ids the user created: admin index first, remaining ids probed in parallel"
+    _scanned_at, entries = _admin_index_lookup(user_id)
+    indexed = {str(cid) for cid, status in entries if status == 'creator'}
+    unknown = [cid for cid in chat_ids if str(cid) not in indexed]
+    confirmed = set(indexed)
+    if unknown:
+        with ThreadPoolExecutor(max_workers=ADMIN_SCAN_WORKERS) as pool:
+            confirmed.update(cid for cid, ok in zip(unknown, pool.map(lambda cid: is_creator_member(cid, user_id), unknown)) if ok)
+    return [cid for cid in chat_ids if str(cid) in confirmed]
 
 def check_bot_permissions(chat_id):
-    "Check if bot has required permissions"
+    "Check if bot has required permissions (cached, refreshed by my_chat_member updates)"
+    with CHAT_CACHE_LOCK:
+        entry = CHAT_CACHE.get(str(chat_id))
+        if entry and 'permissions' in entry and now_ts() - entry.get('perms_at', 0) < CHAT_CACHE_TTL:
+            return dict(entry['permissions'])
+
     try:
-        global BOT_USERNAME
-        if not BOT_USERNAME:
-            BOT_USERNAME = bot.get_me().username
-            
-        member = bot.get_chat_member(chat_id, bot.get_me().id)
-        return {
-            'can_restrict': member.can_restrict_members,
-            'can_delete': member.can_delete_messages,
-            'can_invite': member.can_invite_users,
-            'can_pin': member.can_pin_messages,
-            'is_admin': member.status == 'administrator'
-        }
+        member = bot.get_chat_member(chat_id, get_bot_info().id)
+        permissions = _bot_permissions_from_member(member)
+        update_chat_cache(chat_id, permissions=permissions, perms_at=now_ts())
+        return dict(permissions)
     except:
         return {}
 
-def notify_missing_permission(chat_id, permission):
-    "Notify admin about missing bot permission"
+def notify_creator(chat_id, text):
+    "Send text to the group creator in private (HTML)"
     try:
         admins = bot.get_chat_administrators(chat_id)
         creator = [a for a in admins if a.status == 'creator']
         if creator:
-            bot.send_message(
-                creator[0].user.id,
-                f"⚠️ Bot को '{permission}' permission नहीं है। Group: {chat_id}"
-            )
+            bot.send_message(creator[0].user.id, text, parse_mode="HTML")
     except Exception as e:
-        print(f"Error notifying missing permission: {e}")
+        logging.warning(f"Creator notification for {chat_id} failed: {e}")
+
+def notify_missing_permission(chat_id, permission):
+    "Notify admin about missing bot permission"
+    notify_creator(chat_id, f"⚠️ Bot को '{safe_html(permission)}' permission नहीं है। Group: {chat_id}")
 
 def has_command_permission(chat_id, user_id, command):
     "Check if user has permission to use command based on roles_json"
@@ -498,18 +1554,37 @@ def has_command_permission(chat_id, user_id, command):
     return False
 
 # ---------- Logging & Analytics (existing, preserved) ----------
-def log_action(chat_id, user_id, action):
-    "Log action to analytics table"
+def log_action(chat_id, user_id, action, arg=None, value=None):
+    "Log action (an Action code) to analytics; arg is an interned string payload, value an int"
     try:
         conn = db()
         c = conn.cursor()
-        c.execute("INSERT INTO analytics (chat_id, user_id, action, at) VALUES (?,?,?,?)",
-                  (str(chat_id), str(user_id), action, now_ts()))
+        fresh = {}
+        c.execute("INSERT INTO analytics (chat_id, user_id, action, arg, value, at) VALUES (?,?,?,?,?,?)",
+                  (int(chat_id), int(user_id), int(action), intern_string(conn, arg, fresh), value, now_ts()))
         conn.commit()
         conn.close()
+        cache_strings(fresh)
     except Exception as e:
         logging.warning(f"Log action failed: {e}")
 
+def log_actions_bulk(rows):
+    "Log many (chat_id, user_id, action[, arg[, value]]) rows in one transaction"
+    if not rows:
+        return
+    try:
+        at = now_ts()
+        conn = db()
+        fresh = {}
+        conn.executemany("INSERT INTO analytics (chat_id, user_id, action, arg, value, at) VALUES (?,?,?,?,?,?)",
+                         [(int(row[0]), int(row[1]), int(row[2]), intern_string(conn, row[3] if len(row) > 3 else None, fresh),
+                           row[4] if len(row) > 4 else None, at) for row in rows])
+        conn.commit()
+        conn.close()
+        cache_strings(fresh)
+    except Exception as e:
+        logging.warning(f"Bulk log action failed: {e}")
+
 def forward_log(chat_id, text):
     "Forward log to configured channel/chat"
     try:
@@ -523,6 +1598,386 @@ def forward_log(chat_id, text):
     except Exception as e:
         logging.warning(f"Forward log failed: {e}")
 
+# ---------- Analytics Rollups & Retention ----------
+
+def maintenance_get(name, default=0):
+    "Read a maintenance watermark"
+    conn = db()
+    row = conn.execute("SELECT value FROM maintenance_state WHERE name=?", (name,)).fetchone()
+    conn.close()
+    return row['value'] if row else default
+
+def rollup_analytics():
+    """
+    Aggregate new analytics rows (id above the 'analytics_rollup' watermark) into analytics_hourly and
+    analytics_daily, one batch per transaction together with the watermark. Returns rows rolled up.
+    """
+    total = 0
+    while True:
+        conn = db()
+        try:
+            last_id = conn.execute("SELECT value FROM maintenance_state WHERE name='analytics_rollup'").fetchone()
+            last_id = last_id['value'] if last_id else 0
+            max_id = conn.execute("SELECT MAX(id) FROM analytics").fetchone()[0] or 0
+            upper = min(max_id, last_id + ANALYTICS_ROLLUP_BATCH)
+            if upper <= last_id:
+                return total
+            for table, column, period in (('analytics_hourly', 'hour_ts', 3600), ('analytics_daily', 'day_ts', 86400)):
+                conn.execute(f"""INSERT INTO {table} (chat_id, {column}, kind, count)
+                                SELECT CAST(a.chat_id AS TEXT), a.at / {period} * {period}, COALESCE(k.name, 'other'), COUNT(*)
+                                FROM analytics a LEFT JOIN action_kinds k ON k.code = a.action
+                                WHERE a.id > ? AND a.id <= ? GROUP BY 1, 2, 3
+                                ON CONFLICT (chat_id, {column}, kind) DO UPDATE SET count = count + excluded.count""",
+                             (last_id, upper))
+            conn.execute("INSERT OR REPLACE INTO maintenance_state (name, value) VALUES ('analytics_rollup', ?)", (upper,))
+            conn.commit()
+            total += upper - last_id
+        finally:
+            conn.close()
+
+def _delete_in_chunks(query, params):
+    "Run a 'DELETE ... WHERE rowid IN (SELECT ... LIMIT ?)' query until nothing is left; one chunk per transaction"
+    deleted = 0
+    while True:
+        conn = db()
+        count = conn.execute(query, params + (ANALYTICS_DELETE_CHUNK,)).rowcount
+        conn.commit()
+        conn.close()
+        deleted += count
+        if count < ANALYTICS_DELETE_CHUNK:
+            return deleted
+        time.sleep(0.05) # Let handlers get the write lock between chunks
+
+def prune_analytics():
+    """
+    Retention: delete raw analytics rows older than ANALYTICS_RETENTION_DAYS that are already rolled up,
+    and hourly rollups older than ANALYTICS_HOURLY_RETENTION_DAYS, in small chunks; then return free
+    pages with incremental_vacuum. Returns (raw rows, hourly rows) deleted.
+    """
+    now = now_ts()
+    rolled_up = maintenance_get('analytics_rollup')
+    raw = _delete_in_chunks("DELETE FROM analytics WHERE id IN (SELECT id FROM analytics WHERE id <= ? AND at < ? ORDER BY id LIMIT ?)",
+                            (rolled_up, now - ANALYTICS_RETENTION_DAYS * 86400))
+    hourly = _delete_in_chunks("DELETE FROM analytics_hourly WHERE rowid IN (SELECT rowid FROM analytics_hourly WHERE hour_ts < ? LIMIT ?)",
+                               (now - ANALYTICS_HOURLY_RETENTION_DAYS * 86400,))
+    hourly += _delete_in_chunks("DELETE FROM stats_user_daily WHERE rowid IN (SELECT rowid FROM stats_user_daily WHERE day_ts < ? LIMIT ?)",
+                                (now - ANALYTICS_HOURLY_RETENTION_DAYS * 86400,))
+    conn = db()
+    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    return raw, hourly
+
+# ---------- Group Statistics ----------
+def stats_incr(chat_id, kind, user=None):
+    "Count a group event in memory ('message' with user also counts towards top users)"
+    now = now_ts()
+    chat_id = str(chat_id)
+    with STATS_LOCK:
+        key = (chat_id, now // 3600 * 3600, kind)
+        STATS_COUNTS[key] = STATS_COUNTS.get(key, 0) + 1
+        if user is not None:
+            user_key = (chat_id, now // 86400 * 86400, str(user.id))
+            entry = STATS_USER_COUNTS.setdefault(user_key, [0, user.first_name or ""])
+            entry[0] += 1
+
+def flush_stats():
+    "Write in-memory counters into analytics_hourly/daily and stats_user_daily (one transaction)"
+    global STATS_COUNTS, STATS_USER_COUNTS
+    with STATS_LOCK:
+        counts, STATS_COUNTS = STATS_COUNTS, {}
+        user_counts, STATS_USER_COUNTS = STATS_USER_COUNTS, {}
+    if not counts and not user_counts:
+        return 0
+    daily = {}
+    for (chat_id, hour_ts, kind), count in counts.items():
+        day_key = (chat_id, hour_ts // 86400 * 86400, kind)
+        daily[day_key] = daily.get(day_key, 0) + count
+    conn = db()
+    conn.executemany("""INSERT INTO analytics_hourly (chat_id, hour_ts, kind, count) VALUES (?,?,?,?)
+                        ON CONFLICT (chat_id, hour_ts, kind) DO UPDATE SET count = count + excluded.count""",
+                     [key + (count,) for key, count in counts.items()])
+    conn.executemany("""INSERT INTO analytics_daily (chat_id, day_ts, kind, count) VALUES (?,?,?,?)
+                        ON CONFLICT (chat_id, day_ts, kind) DO UPDATE SET count = count + excluded.count""",
+                     [key + (count,) for key, count in daily.items()])
+    conn.executemany("""INSERT INTO stats_user_daily (chat_id, day_ts, user_id, name, messages) VALUES (?,?,?,?,?)
+                        ON CONFLICT (chat_id, day_ts, user_id) DO UPDATE SET messages = messages + excluded.messages, name = excluded.name""",
+                     [key + (name, count) for key, (count, name) in user_counts.items()])
+    conn.commit()
+    conn.close()
+    return len(counts) + len(user_counts)
+
+def get_group_stats(chat_id, period='today'):
+    """
+    Totals and top users of a period from the daily rollups: reads at most 30 days x kinds rows,
+    independent of the group's history.
+    """
+    chat_id = str(chat_id)
+    since = now_ts() // 86400 * 86400 - (STATS_PERIODS.get(period, 1) - 1) * 86400
+    conn = db()
+    totals = {row['kind']: row['total'] for row in conn.execute(
+        "SELECT kind, SUM(count) AS total FROM analytics_daily WHERE chat_id=? AND day_ts>=? GROUP BY kind", (chat_id, since))}
+    top = conn.execute("""SELECT user_id, MAX(name) AS name, SUM(messages) AS messages FROM stats_user_daily
+                          WHERE chat_id=? AND day_ts>=? GROUP BY user_id ORDER BY messages DESC LIMIT ?""",
+                       (chat_id, since, STATS_TOP_USERS)).fetchall()
+    conn.close()
+    # Counters not flushed yet
+    with STATS_LOCK:
+        for (c_id, hour_ts, kind), count in STATS_COUNTS.items():
+            if c_id == chat_id and hour_ts >= since:
+                totals[kind] = totals.get(kind, 0) + count
+    return {
+        'messages': totals.get('message', 0),
+        'joins': totals.get('join', 0),
+        'leaves': totals.get('left', 0),
+        'punishments': sum(totals.get(kind, 0) for kind in STATS_PUNISHMENT_KINDS),
+        'top': [(row['user_id'], row['name'], row['messages']) for row in top],
+    }
+
+def render_group_stats(lang_chat_id, chat_id, period='today'):
+    "Stats text of chat_id in the language of lang_chat_id"
+    stats = get_group_stats(chat_id, period)
+    lines = [_(lang_chat_id, 'stats_title', period=_(lang_chat_id, f'stats_period_{period}')),
+             _(lang_chat_id, 'stats_body', **{k: v for k, v in stats.items() if k != 'top'})]
+    if stats['top']:
+        lines.append(_(lang_chat_id, 'stats_top'))
+        for rank, (user_id, name, messages) in enumerate(stats['top'], 1):
+            lines.append(f'{rank}. <a href="tg://user?id={user_id}">{safe_html(name or user_id)}</a> — {messages}')
+    return "\n".join(lines)
+
+def analytics_maintenance_thread():
+    """Flushes stats counters and rolls up analytics every ANALYTICS_ROLLUP_INTERVAL; applies retention and vacuums hourly."""
+    last_maintenance = 0
+    while True:
+        try:
+            flush_stats()
+            rolled = rollup_analytics()
+            if rolled:
+                logging.info(f"📊 Analytics rollup: {rolled} rows")
+            if now_ts() - last_maintenance >= ANALYTICS_MAINTENANCE_INTERVAL:
+                last_maintenance = now_ts()
+                raw, hourly = prune_analytics()
+                if raw or hourly:
+                    logging.info(f"🧹 Analytics retention: {raw} raw rows, {hourly} hourly rollups deleted")
+        except Exception as e:
+            logging.error(f"Analytics maintenance error: {e}")
+        time.sleep(ANALYTICS_ROLLUP_INTERVAL)
+
+# ---------- Config Import / Export ----------
+def _settings_columns(conn):
+    "Columns of the settings table except chat_id"
+    return [row['name'] for row in conn.execute("PRAGMA table_info(settings)").fetchall() if row['name'] != 'chat_id']
+
+def export_config(chat_id, out):
+    """
+    Stream a chat's config (settings incl. locks/roles/menu, notes, triggers, blacklist) as JSON into
+    the text file out, row by row from the cursors instead of building the document in memory.
+    """
+    chat_id = str(chat_id)
+    conn = db()
+    row = conn.execute("SELECT * FROM settings WHERE chat_id=?", (chat_id,)).fetchone()
+    settings = {}
+    if row:
+        for key in row.keys():
+            if key != 'chat_id':
+                settings[key] = jload(row[key], row[key]) if key.endswith('_json') else row[key]
+    out.write('{"version":1,"chat_id":%s,"exported_at":%d,"settings":%s' % (jdump(chat_id), now_ts(), jdump(settings)))
+    sections = (
+        ('notes', "SELECT key, content, expires_at FROM notes WHERE chat_id=? ORDER BY id"),
+        ('triggers', "SELECT pattern, reply, is_regex FROM triggers WHERE chat_id=? ORDER BY id"),
+        ('blacklist', "SELECT word FROM blacklist WHERE chat_id=? ORDER BY id"),
+    )
+    for name, query in sections:
+        out.write(',"%s":[' % name)
+        for i, item in enumerate(conn.execute(query, (chat_id,))):
+            value = item['word'] if name == 'blacklist' else dict(item)
+            out.write((',' if i else '') + jdump(value))
+        out.write(']')
+    out.write('}')
+    conn.close()
+
+def _parse_import_file(module, filename, stream):
+    """
+    Parse an uploaded file into a config dict ({'notes': [...], 'triggers': [...], 'blacklist': [...]}
+    and optionally 'settings'). A full /export JSON is returned as is; otherwise entries are for module.
+    Text and CSV are read line by line from stream.
+    """
+    name = (filename or '').lower()
+    if name.endswith('.json'):
+        data = json.load(stream)
+        if isinstance(data, dict):
+            return data
+        items = data
+    elif name.endswith('.csv'):
+        items = (row for row in csv.reader(stream) if row)
+    else:
+        lines = (line.strip() for line in stream)
+        if module == 'blacklist':
+            items = (line for line in lines if line)
+        else:
+            items = (line.split(maxsplit=1) for line in lines if line)
+
+    if module == 'blacklist':
+        words = (item[0] if isinstance(item, list) else item.get('word') if isinstance(item, dict) else item for item in items)
+        return {'blacklist': [str(word) for word in words if word]}
+    if module == 'note':
+        return {'notes': [item if isinstance(item, dict) else {'key': item[0], 'content': item[1] if len(item) > 1 else ''}
+                          for item in items]}
+    if module == 'trigger':
+        return {'triggers': [item if isinstance(item, dict) else {'pattern': item[0], 'reply': item[1] if len(item) > 1 else '',
+                                                                 'is_regex': int(item[2]) if len(item) > 2 else 0}
+                             for item in items]}
+    raise ValueError("a full config export (JSON object) is required")
+
+def import_config(conn, chat_id, config, replace=False):
+    """
+    Write a config dict into chat_id using conn, without committing (caller owns the transaction).
+    Lists are bulk-inserted with executemany; notes/triggers with an existing key are replaced,
+    duplicate blacklist words skipped. replace=True clears the chat's lists first.
+    Returns {'settings': n, 'notes': n, 'triggers': n, 'blacklist': n}.
+    """
+    chat_id = str(chat_id)
+    counts = {'settings': 0, 'notes': 0, 'triggers': 0, 'blacklist': 0}
+
+    settings = config.get('settings')
+    if settings:
+        columns = [col for col in _settings_columns(conn) if col in settings]
+        values = [settings[col] if not col.endswith('_json') or isinstance(settings[col], str) else jdump(settings[col])
+                  for col in columns]
+        conn.execute("INSERT OR IGNORE INTO settings (chat_id) VALUES (?)", (chat_id,))
+        if columns:
+            conn.execute(f"UPDATE settings SET {', '.join(col + '=?' for col in columns)} WHERE chat_id=?", values + [chat_id])
+        counts['settings'] = len(columns)
+
+    if replace:
+        for table in ('notes', 'triggers', 'blacklist'):
+            if table in config:
+                conn.execute(f"DELETE FROM {table} WHERE chat_id=?", (chat_id,))
+
+    notes = [(chat_id, str(n['key']), str(n.get('content') or ''), now_ts(), int(n.get('expires_at') or 0))
+             for n in config.get('notes') or [] if n.get('key')]
+    if notes:
+        if not replace:
+            conn.executemany("DELETE FROM notes WHERE chat_id=? AND key=?", [(chat_id, n[1]) for n in notes])
+        conn.executemany("INSERT INTO notes (chat_id, key, content, created_at, expires_at) VALUES (?,?,?,?,?)", notes)
+        counts['notes'] = len(notes)
+
+    triggers = [(chat_id, str(t['pattern']), str(t.get('reply') or ''), int(t.get('is_regex') or 0))
+                for t in config.get('triggers') or [] if t.get('pattern')]
+    valid = [t for t in triggers if not (t[3] and validate_regex(t[1]))]  # Regex triggers are validated at creation
+    if len(valid) < len(triggers):
+        counts['invalid_regex'] = len(triggers) - len(valid)
+        triggers = valid
+    if triggers:
+        if not replace:
+            conn.executemany("DELETE FROM triggers WHERE chat_id=? AND pattern=?", [(chat_id, t[1]) for t in triggers])
+        conn.executemany("INSERT INTO triggers (chat_id, pattern, reply, is_regex) VALUES (?,?,?,?)", triggers)
+        counts['triggers'] = len(triggers)
+
+    words = config.get('blacklist') or []
+    if words:
+        seen = set() if replace else {r['word'] for r in conn.execute("SELECT word FROM blacklist WHERE chat_id=?", (chat_id,))}
+        rows = []
+        for word in words:
+            word = str(word).lower().strip()
+            if word and word not in seen:
+                seen.add(word)
+                rows.append((chat_id, word))
+        conn.executemany("INSERT INTO blacklist (chat_id, word) VALUES (?,?)", rows)
+        counts['blacklist'] = len(rows)
+
+    return counts
+
+def import_config_file(chat_id, module, filename, data):
+    "Parse and import an uploaded file in one transaction; caches are invalidated once. Returns counts."
+    stream = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8-sig', newline='')
+    config = _parse_import_file(module, filename, stream)
+    conn = db()
+    try:
+        counts = import_config(conn, chat_id, config)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    invalidate_chat_config(chat_id)
+    return counts
+
+def send_config_export(to_chat_id, chat_id):
+    "Export chat_id's config to a temporary file and send it as a document"
+    path = None
+    try:
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', prefix=f"config_{str(chat_id).lstrip('-')}_",
+                                         suffix='.json', delete=False) as out:
+            path = out.name
+            export_config(chat_id, out)
+        with open(path, 'rb') as doc:
+            bot.send_document(to_chat_id, doc, caption=_(chat_id, 'export_caption', title=safe_html(get_chat_title(chat_id, str(chat_id)))),
+                              parse_mode="HTML")
+    finally:
+        if path:
+            os.remove(path)
+
+# ---------- Config Templates ----------
+def snapshot_config(chat_id):
+    "Full config of a chat as a dict (same shape as /export)"
+    out = io.StringIO()
+    export_config(chat_id, out)
+    return json.loads(out.getvalue())
+
+def template_save(owner_id, name, chat_id):
+    "Snapshot chat_id's config as the owner's template name (overwrites)"
+    config = snapshot_config(chat_id)
+    conn = db()
+    conn.execute("INSERT OR REPLACE INTO config_templates (owner_id, name, source_chat_id, config_json, created_at) VALUES (?,?,?,?,?)",
+                 (str(owner_id), name, str(chat_id), jdump(config), now_ts()))
+    conn.commit()
+    conn.close()
+
+def template_get(owner_id, name):
+    "Stored template config or None"
+    conn = db()
+    row = conn.execute("SELECT config_json FROM config_templates WHERE owner_id=? AND name=?", (str(owner_id), name)).fetchone()
+    conn.close()
+    return jload(row['config_json'], None) if row else None
+
+def template_list(owner_id):
+    "[(name, source_chat_id, created_at)] of an owner"
+    conn = db()
+    rows = conn.execute("SELECT name, source_chat_id, created_at FROM config_templates WHERE owner_id=? ORDER BY name",
+                        (str(owner_id),)).fetchall()
+    conn.close()
+    return [(row['name'], row['source_chat_id'], row['created_at']) for row in rows]
+
+def template_delete(owner_id, name):
+    "Delete a template; True if it existed"
+    conn = db()
+    deleted = conn.execute("DELETE FROM config_templates WHERE owner_id=? AND name=?", (str(owner_id), name)).rowcount
+    conn.commit()
+    conn.close()
+    return bool(deleted)
+
+def apply_config_to_chats(config, chat_ids):
+    """
+    Apply a config snapshot to many chats in one transaction (settings overwritten, notes/triggers/
+    blacklist replaced), then invalidate each chat's cached config once.
+    """
+    chat_ids = [str(chat_id) for chat_id in chat_ids]
+    conn = db()
+    try:
+        for chat_id in chat_ids:
+            import_config(conn, chat_id, config, replace=True)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    for chat_id in chat_ids:
+        invalidate_chat_config(chat_id)
+    return len(chat_ids)
+
 # ---------- User Info Helpers (existing, preserved) ----------
 def get_user_display_name(user):
     "Get user's display name"
@@ -539,28 +1994,91 @@ def get_user_mention(user):
     return f'<a href="tg://user?id={user.id}">{name}</a>'
 
 # ---------- Punishment System (existing, preserved) ----------
-def warn_user(chat_id, user_id, reason=""):
-    "Warn user with escalation (3 warns → ban)"
+def record_punishment(chat_id, user_id, ptype, until_ts=0, reason=None):
+    """
+    Add a ledger entry (and bump its counter for warn/blacklist) in one write transaction.
+    BEGIN IMMEDIATE serializes concurrent callers, so exactly one of them sees the count reach WARN_LIMIT;
+    that one deactivates the counted entries and resets the counter. Returns (count, escalate).
+    """
+    chat_id, user_id = str(chat_id), str(user_id)
+    now = now_ts()
+    count, escalate = 0, False
     conn = db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) as cnt FROM punishments WHERE chat_id=? AND user_id=? AND type='warn'",
-              (str(chat_id), str(user_id)))
-    count = c.fetchone()['cnt'] + 1
-    
-    c.execute("INSERT INTO punishments (chat_id, user_id, type, until_ts) VALUES (?,?,?,?)",
-              (str(chat_id), str(user_id), 'warn', now_ts()))
-    conn.commit()
-    conn.close()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        pid = conn.execute("INSERT INTO punishments (chat_id, user_id, type, until_ts, created_at, active, reason) VALUES (?,?,?,?,?,1,?)",
+                           (chat_id, user_id, ptype, until_ts, now, reason or None)).lastrowid
+        if ptype in COUNTED_PUNISHMENTS:
+            conn.execute("INSERT INTO punishment_counters (chat_id, user_id, type, count, updated_at) VALUES (?,?,?,1,?) \n                          ON CONFLICT (chat_id, user_id, type) DO UPDATE SET count=count+1, updated_at=excluded.updated_at",
+                         (chat_id, user_id, ptype, now))
+            count = conn.execute("SELECT count FROM punishment_counters WHERE chat_id=? AND user_id=? AND type=?",
+                                 (chat_id, user_id, ptype)).fetchone()[0]
+            if count >= WARN_LIMIT:
+                escalate = True
+                conn.execute("UPDATE punishments SET active=0 WHERE chat_id=? AND user_id=? AND type=? AND active=1",
+                             (chat_id, user_id, ptype))
+                conn.execute("UPDATE punishment_counters SET count=0, updated_at=? WHERE chat_id=? AND user_id=? AND type=?",
+                             (now, chat_id, user_id, ptype))
+        conn.commit()
+    finally:
+        conn.close()
     
-    log_action(chat_id, user_id, f"warned:{reason}")
+    if ptype == 'mute' and until_ts:
+        schedule_job(until_ts, 'punishment_expire', str(pid), {'id': pid})
+    elif ptype in COUNTED_PUNISHMENTS and WARN_EXPIRY_DAYS and not escalate:
+        schedule_job(now + WARN_EXPIRY_DAYS * 86400, 'punishment_expire', str(pid), {'id': pid})
+    return count, escalate
+
+def deactivate_punishments(conn, rows):
+    "Mark ledger rows inactive and decrement their counters; returns the rows that were still active"
+    changed = []
+    for row in rows:
+        if not conn.execute("UPDATE punishments SET active=0 WHERE id=? AND active=1", (row['id'],)).rowcount:
+            continue
+        if row['type'] in COUNTED_PUNISHMENTS:
+            conn.execute("UPDATE punishment_counters SET count=MAX(count-1, 0), updated_at=? WHERE chat_id=? AND user_id=? AND type=?",
+                         (now_ts(), row['chat_id'], row['user_id'], row['type']))
+        changed.append(row)
+    return changed
+
+def expire_punishments(payloads):
+    "Batch expiry of warns / blacklist violations / mutes; lifts mutes Telegram would have kept forever"
+    ids = [payload['id'] for payload in payloads]
+    lift = []
+    conn = db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(f"SELECT id, chat_id, user_id, type, until_ts, created_at FROM punishments WHERE id IN ({','.join('?' * len(ids))})",
+                            ids).fetchall()
+        for row in deactivate_punishments(conn, rows):
+            if row['type'] != 'mute':
+                continue
+            if row['created_at'] is None or MUTE_TELEGRAM_MIN <= row['until_ts'] - row['created_at'] <= MUTE_TELEGRAM_MAX:
+                continue  # Telegram already lifted it at until_date (migrated rows: assume so)
+            still_muted = conn.execute("SELECT 1 FROM punishments WHERE chat_id=? AND user_id=? AND type='mute' AND active=1 LIMIT 1",
+                                       (row['chat_id'], row['user_id'])).fetchone()
+            if not still_muted:
+                lift.append((row['chat_id'], row['user_id']))
+        conn.commit()
+    finally:
+        conn.close()
+    for chat_id, user_id in lift:
+        API_LIMITER.acquire()
+        unrestrict_user(chat_id, user_id)
+        logging.info(f"Mute expired for {user_id} in {chat_id}")
+
+def warn_user(chat_id, user_id, reason=""):
+    "Warn user with escalation (WARN_LIMIT active warns → ban)"
+    count, escalate = record_punishment(chat_id, user_id, 'warn', reason=reason)
+    log_action(chat_id, user_id, Action.WARNED, reason or None)
     
-    if count >= 3:
-        ban_user(chat_id, user_id, "3 warnings")
+    if escalate:
+        ban_user(chat_id, user_id, f"{WARN_LIMIT} warnings")
         return count, 'banned'
     return count, 'warned'
 
 def mute_user(chat_id, user_id, duration_sec=3600):
-    "Mute user for specified duration"
+    "Mute user for specified duration (expiry is scheduled)"
     try:
         until = now_ts() + duration_sec
         bot.restrict_chat_member(
@@ -568,13 +2086,8 @@ def mute_user(chat_id, user_id, duration_sec=3600):
             until_date=until,
             can_send_messages=False
         )
-        conn = db()
-        c = conn.cursor()
-        c.execute("INSERT INTO punishments (chat_id, user_id, type, until_ts) VALUES (?,?,?,?)",
-                  (str(chat_id), str(user_id), 'mute', until))
-        conn.commit()
-        conn.close()
-        log_action(chat_id, user_id, f"muted:{duration_sec}s")
+        record_punishment(chat_id, user_id, 'mute', until)
+        log_action(chat_id, user_id, Action.MUTED, value=duration_sec)
         return True
     except Exception as e:
         logging.warning(f"Mute failed: {e}")
@@ -584,116 +2097,671 @@ def ban_user(chat_id, user_id, reason=""):
     "Ban user permanently"
     try:
         bot.ban_chat_member(chat_id, user_id)
+        record_punishment(chat_id, user_id, 'ban', reason=reason)
+        log_action(chat_id, user_id, Action.BANNED, reason or None)
+        return True
+    except Exception as e:
+        logging.warning(f"Ban failed: {e}")
+        return False
+
+def kick_user(chat_id, user_id):
+    "Kick user (ban then unban)"
+    try:
+        bot.ban_chat_member(chat_id, user_id)
+        bot.unban_chat_member(chat_id, user_id)
+        log_action(chat_id, user_id, Action.KICKED)
+        return True
+    except Exception as e:
+        logging.warning(f"Kick failed: {e}")
+        return False
+
+def undo_punishment(chat_id, user_id):
+    "Undo last active punishment for user (kept in the ledger as inactive)"
+    try:
         conn = db()
-        c = conn.cursor()
-        c.execute("INSERT INTO punishments (chat_id, user_id, type, until_ts) VALUES (?,?,?,?)",
-                  (str(chat_id), str(user_id), 'ban', 0))
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, chat_id, user_id, type FROM punishments \n                                WHERE chat_id=? AND user_id=? AND active=1 \n                                ORDER BY id DESC LIMIT 1",
+                               (str(chat_id), str(user_id))).fetchone()
+            if row:
+                deactivate_punishments(conn, [row])
+            conn.commit()
+        finally:
+            conn.close()
+        if not row:
+            return False, "No punishment found"
+        
+        pid, ptype = row['id'], row['type']
+        cancel_job('punishment_expire', str(pid))
+        if ptype == 'ban':
+            bot.unban_chat_member(chat_id, user_id)
+        elif ptype == 'mute':
+            unrestrict_user(chat_id, user_id)
+        
+        log_action(chat_id, user_id, Action.UNDO, ptype)
+        return True, ptype
+    except Exception as e:
+        logging.warning(f"Undo failed: {e}")
+        return False, str(e)
+
+def parse_duration(text, default=(3600, '1h')):
+    "'30m' / '2h' / '1d' -> (seconds, label); default if text is not a duration"
+    match = re.match(r"(\d+)([mhd])", (text or '').lower())
+    if not match:
+        return default
+    value, unit = int(match.group(1)), match.group(2)
+    return value * {'m': 60, 'h': 3600, 'd': 86400}[unit], f"{value}{unit}"
+
+# ---------- Mass Moderation ----------
+def record_punishments_bulk(chat_id, user_ids, ptype, until_ts=0, reason=None):
+    "Ledger entries for many users in one transaction (mass ban/mute), with their expiry jobs"
+    if not user_ids:
+        return
+    chat_id = str(chat_id)
+    now = now_ts()
+    conn = db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM punishments").fetchone()[0]
+        conn.executemany("INSERT INTO punishments (chat_id, user_id, type, until_ts, created_at, active, reason) VALUES (?,?,?,?,?,1,?)",
+                         [(chat_id, str(uid), ptype, until_ts, now, reason) for uid in user_ids])
+        if ptype == 'mute' and until_ts:
+            # Writers are serialized by BEGIN IMMEDIATE, so every id above last_id is ours
+            ids = [row[0] for row in conn.execute("SELECT id FROM punishments WHERE id > ?", (last_id,)).fetchall()]
+            conn.executemany("INSERT INTO scheduled_jobs (run_at, kind, ref, payload_json) VALUES (?,?,?,?)",
+                             [(until_ts, 'punishment_expire', str(pid), jdump({'id': pid})) for pid in ids])
         conn.commit()
+    finally:
         conn.close()
-        log_action(chat_id, user_id, f"banned:{reason}")
+
+def lift_bans_bulk(chat_id, user_ids, reason=None):
+    "Deactivate the active ban entries of many users (mass unban); with reason, only the bans tagged with it"
+    conn = db()
+    if reason is None:
+        conn.executemany("UPDATE punishments SET active=0 WHERE chat_id=? AND user_id=? AND type='ban' AND active=1",
+                         [(str(chat_id), str(uid)) for uid in user_ids])
+    else:
+        conn.executemany("UPDATE punishments SET active=0 WHERE chat_id=? AND user_id=? AND type='ban' AND active=1 AND reason=?",
+                         [(str(chat_id), str(uid), reason) for uid in user_ids])
+    conn.commit()
+    conn.close()
+
+def parse_mass_targets(chat_id, message, args):
+    "User ids for a mass command: 'joined <minutes>' (recent_joiners), ids in args, or ids in the replied-to text/caption/file"
+    if len(args) > 1 and args[0].lower() == 'joined' and args[1].isdigit():
+        return recent_joiners(chat_id, now_ts() - int(args[1]) * 60, MASS_MOD_MAX_TARGETS + 1)
+    
+    text = " ".join(args)
+    reply = message.reply_to_message
+    if reply:
+        text += " " + (reply.text or reply.caption or "")
+        document = reply.document
+        if document and (document.file_size or 0) <= IMPORT_MAX_BYTES:
+            file_info = bot.get_file(document.file_id)
+            text += " " + bot.download_file(file_info.file_path).decode('utf-8', 'replace')
+    return list(dict.fromkeys(int(uid) for uid in MASS_ID_RE.findall(text)))
+
+def _mass_apply(chat_id, action, user_id, until):
+    "One mass-moderation API call through the global rate limiter; True on success"
+    try:
+        API_LIMITER.acquire()
+        if action == 'ban':
+            bot.ban_chat_member(chat_id, user_id)
+        elif action == 'mute':
+            bot.restrict_chat_member(chat_id, user_id, until_date=until, can_send_messages=False)
+        elif action == 'kick':
+            bot.ban_chat_member(chat_id, user_id)
+            API_LIMITER.acquire()
+            bot.unban_chat_member(chat_id, user_id)
+        else:
+            bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
         return True
     except Exception as e:
-        logging.warning(f"Ban failed: {e}")
+        logging.warning(f"Mass {action} of {user_id} in {chat_id} failed: {e}")
         return False
 
-def kick_user(chat_id, user_id):
-    "Kick user (ban then unban)"
+def _edit_mass_status(chat_id, message_id, text):
+    try:
+        API_LIMITER.acquire(chat_id)
+        bot.edit_message_text(text, chat_id, message_id, parse_mode="HTML")
+    except Exception as e:
+        if not note_chat_api_error(chat_id, e):
+            logging.warning(f"Mass status edit failed: {e}")
+
+def run_mass_moderation(chat_id, admin_id, action, user_ids, duration_sec, status_id, skipped=0):
+    """
+    Apply action to user_ids with a bounded worker pool, editing one status message with progress,
+    then write the ledger and analytics in bulk. Releases the group's mass_jobs slot when done.
+    """
+    label = f"/mass{action}"
+    until = now_ts() + duration_sec if action == 'mute' else 0
+    succeeded, failed = [], 0
+    last_edit = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=MASS_MOD_WORKERS) as pool:
+            results = pool.map(lambda uid: _mass_apply(chat_id, action, uid, until), user_ids)
+            for done, (uid, ok) in enumerate(zip(user_ids, results), 1):
+                if ok:
+                    succeeded.append(uid)
+                else:
+                    failed += 1
+                if done < len(user_ids) and time.monotonic() - last_edit >= MASS_PROGRESS_INTERVAL:
+                    last_edit = time.monotonic()
+                    _edit_mass_status(chat_id, status_id, _(chat_id, 'mass_progress', action=label, done=done,
+                                                             total=len(user_ids), ok=len(succeeded), failed=failed))
+        
+        if action in ('ban', 'mute'):
+            record_punishments_bulk(chat_id, succeeded, action, until)
+        elif action == 'unban':
+            lift_bans_bulk(chat_id, succeeded)
+        code = {'ban': Action.BANNED, 'mute': Action.MUTED, 'kick': Action.KICKED, 'unban': Action.UNBANNED}[action]
+        log_actions_bulk([(chat_id, uid, code, f"mass by {admin_id}", duration_sec if action == 'mute' else None)
+                          for uid in succeeded])
+        _edit_mass_status(chat_id, status_id, _(chat_id, 'mass_done', action=label, ok=len(succeeded),
+                                                total=len(user_ids), failed=failed, skipped=skipped))
+        logging.info(f"Mass {action} in {chat_id} by {admin_id}: {len(succeeded)}/{len(user_ids)} ok")
+    finally:
+        mass_jobs.pop(chat_id, None)
+
+# ---------- Federations (shared ban lists) ----------
+def load_federations():
+    "Load federation subscriptions and ban lists into memory (startup); checks never query SQLite"
+    conn = db()
+    chats = {row['chat_id']: row['fed_id'] for row in conn.execute("SELECT chat_id, fed_id FROM federation_chats").fetchall()}
+    bans = {}
+    for row in conn.execute("SELECT fed_id, user_id FROM federation_bans").fetchall():
+        bans.setdefault(row['fed_id'], set()).add(int(row['user_id']))
+    conn.close()
+    with FED_LOCK:
+        FED_OF_CHAT.clear()
+        FED_OF_CHAT.update(chats)
+        FED_BANS.clear()
+        FED_BANS.update(bans)
+    logging.info(f"🌐 Federations loaded: {len(chats)} groups, {sum(len(users) for users in bans.values())} bans")
+
+def fed_of_chat(chat_id):
+    return FED_OF_CHAT.get(str(chat_id))
+
+def is_fed_banned(chat_id, user_id):
+    "O(1): is user_id on the ban list of the federation chat_id subscribes to"
+    fed_id = FED_OF_CHAT.get(str(chat_id))
+    return fed_id is not None and user_id in FED_BANS.get(fed_id, ())
+
+def fed_chats(fed_id):
+    "Subscribed group ids of a federation"
+    with FED_LOCK:
+        return [chat_id for chat_id, fed in FED_OF_CHAT.items() if fed == fed_id]
+
+def fed_get(fed_id):
+    "Federation row as dict (admins as a list of ints) or None"
+    conn = db()
+    row = conn.execute("SELECT fed_id, name, owner_id, admins_json FROM federations WHERE fed_id=?", (fed_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {'fed_id': row['fed_id'], 'name': row['name'], 'owner_id': int(row['owner_id']),
+            'admins': [int(uid) for uid in jload(row['admins_json'], [])]}
+
+def fed_create(owner_id, name):
+    "Create a federation owned by owner_id; returns its id"
+    fed_id = base64.b32encode(os.urandom(5)).decode().lower()
+    conn = db()
+    conn.execute("INSERT INTO federations (fed_id, name, owner_id, admins_json, created_at) VALUES (?,?,?,?,?)",
+                 (fed_id, name, str(owner_id), '[]', now_ts()))
+    conn.commit()
+    conn.close()
+    with FED_LOCK:
+        FED_BANS[fed_id] = set()
+    return fed_id
+
+def fed_set_admins(fed_id, admins):
+    conn = db()
+    conn.execute("UPDATE federations SET admins_json=? WHERE fed_id=?", (jdump(sorted(set(admins))), fed_id))
+    conn.commit()
+    conn.close()
+
+def fed_subscribe(chat_id, fed_id):
+    "Subscribe chat_id to fed_id (None = leave the current federation)"
+    chat_id = str(chat_id)
+    conn = db()
+    if fed_id:
+        conn.execute("INSERT OR REPLACE INTO federation_chats (chat_id, fed_id) VALUES (?,?)", (chat_id, fed_id))
+    else:
+        conn.execute("DELETE FROM federation_chats WHERE chat_id=?", (chat_id,))
+    conn.commit()
+    conn.close()
+    with FED_LOCK:
+        if fed_id:
+            FED_OF_CHAT[chat_id] = fed_id
+        else:
+            FED_OF_CHAT.pop(chat_id, None)
+
+def fed_can_manage(fed, user_id):
+    return user_id == fed['owner_id'] or user_id in fed['admins']
+
+def fed_ban(fed_id, user_id, banned_by, reason=""):
+    "Add user_id to the federation ban list and queue the ban for every subscribed group"
+    conn = db()
+    conn.execute("INSERT OR REPLACE INTO federation_bans (fed_id, user_id, reason, banned_by, at) VALUES (?,?,?,?,?)",
+                 (fed_id, str(user_id), reason, str(banned_by), now_ts()))
+    conn.commit()
+    conn.close()
+    with FED_LOCK:
+        FED_BANS.setdefault(fed_id, set()).add(user_id)
+    ref = f"{fed_id}:{user_id}"
+    cancel_job('fed_propagate', ref)
+    schedule_job(now_ts(), 'fed_propagate', ref, {'fed_id': fed_id, 'user_id': user_id, 'action': 'ban'})
+
+def fed_unban(fed_id, user_id):
+    "Remove user_id from the federation ban list and queue the unbans; False if not banned"
+    conn = db()
+    removed = conn.execute("DELETE FROM federation_bans WHERE fed_id=? AND user_id=?", (fed_id, str(user_id))).rowcount
+    conn.commit()
+    conn.close()
+    if not removed:
+        return False
+    with FED_LOCK:
+        FED_BANS.get(fed_id, set()).discard(user_id)
+    ref = f"{fed_id}:{user_id}"
+    cancel_job('fed_propagate', ref)
+    schedule_job(now_ts(), 'fed_propagate', ref, {'fed_id': fed_id, 'user_id': user_id, 'action': 'unban'})
+    return True
+
+def fed_unban_targets(fed_id, user_id):
+    """
+    Groups where an unban of user_id is owed to the federation: ([chats to unban], [chats whose
+    fed ban entry just needs lifting]). Only bans tagged 'fed:<fed_id>' count; a group that also
+    holds its own active ban keeps the user banned.
+    """
+    tag = f"fed:{fed_id}"
+    unban, lift_only = [], []
+    conn = db()
+    for chat_id in fed_chats(fed_id):
+        reasons = [row['reason'] for row in conn.execute(
+            "SELECT reason FROM punishments WHERE chat_id=? AND user_id=? AND type='ban' AND active=1", (chat_id, str(user_id)))]
+        if tag in reasons:
+            (lift_only if any(reason != tag for reason in reasons) else unban).append(chat_id)
+    conn.close()
+    return unban, lift_only
+
+def propagate_fed_actions(payloads):
+    """
+    Batch job: apply queued federation bans/unbans in every subscribed group (worker pool + API_LIMITER).
+    Bans are recorded with reason 'fed:<fed_id>'; unbans only undo those.
+    """
+    latest = {}
+    for payload in payloads:
+        latest[(payload['fed_id'], payload['user_id'])] = payload['action']  # Last action per user wins
+    tasks = []
+    for (fed_id, user_id), action in latest.items():
+        if action == 'ban':
+            tasks += [(chat_id, action, user_id, fed_id) for chat_id in fed_chats(fed_id)]
+            continue
+        unban, lift_only = fed_unban_targets(fed_id, user_id)
+        tasks += [(chat_id, action, user_id, fed_id) for chat_id in unban]
+        for chat_id in lift_only:
+            lift_bans_bulk(chat_id, [user_id], f"fed:{fed_id}")
+    with ThreadPoolExecutor(max_workers=MASS_MOD_WORKERS) as pool:
+        results = list(pool.map(lambda task: _mass_apply(task[0], task[1], task[2], 0), tasks))
+    
+    done = {}  # {(chat_id, action, fed_id): [user ids]}
+    analytics_rows = []
+    for (chat_id, action, user_id, fed_id), ok in zip(tasks, results):
+        if ok:
+            done.setdefault((chat_id, action, fed_id), []).append(user_id)
+            analytics_rows.append((chat_id, user_id, Action.BANNED if action == 'ban' else Action.UNBANNED, f"fed:{fed_id}"))
+    for (chat_id, action, fed_id), user_ids in done.items():
+        if action == 'ban':
+            record_punishments_bulk(chat_id, user_ids, 'ban', reason=f"fed:{fed_id}")
+        else:
+            lift_bans_bulk(chat_id, user_ids, f"fed:{fed_id}")
+    log_actions_bulk(analytics_rows)
+    logging.info(f"🌐 Federation propagation: {len(analytics_rows)}/{len(tasks)} group actions applied")
+
+def fed_admin_chats(fed_id, user_id):
+    "Subscribed groups of a federation where user_id is an admin (member cache, probed in parallel)"
+    chats = fed_chats(fed_id)
+    with ThreadPoolExecutor(max_workers=ADMIN_SCAN_WORKERS) as pool:
+        flags = list(pool.map(lambda chat_id: is_admin_member(chat_id, user_id), chats))
+    return [chat_id for chat_id, is_admin in zip(chats, flags) if is_admin]
+
+def enforce_fed_ban(chat_id, user_id, joined=False):
+    """
+    Ban a federation-banned user on sight (join or message).
+    Admins of the group are exempt (member cache); True only if the user is (being) banned.
+    One join arrives both as a service message and as a chat_member update (joined=True):
+    only the first call bans, a concurrent one or one finding an active 'fed:<id>' ban is a no-op.
+    A message always re-bans, since its sender is evidently in the group.
+    """
+    if not is_fed_banned(chat_id, user_id) or is_admin_member(chat_id, user_id):
+        return False
+    key = (str(chat_id), user_id)
+    if not fed_enforcing.compute(key, lambda busy: (True, not busy)):
+        return True  # The other path is banning right now
+    try:
+        reason = f"fed:{fed_of_chat(chat_id)}"
+        if joined:
+            conn = db()
+            already = conn.execute("SELECT 1 FROM punishments WHERE chat_id=? AND user_id=? AND type='ban' AND active=1 AND reason=? LIMIT 1",
+                                   (str(chat_id), str(user_id), reason)).fetchone()
+            conn.close()
+            if already:
+                return True
+        return ban_user(chat_id, user_id, reason)
+    finally:
+        fed_enforcing.pop(key)
+
+# ---------- Flood Protection (existing, preserved) ----------
+def check_flood(chat_id, user_id):
+    "Check if user is flooding, return (is_flood, count, limit)"
+    settings = get_settings(chat_id)
+    window = settings.get('flood_window', 15)
+    limit = settings.get('flood_limit', 7)
+    
+    now = now_ts()
+    cutoff = now - window
+    
+    def _record(timestamps):
+        # Remove old messages and add this one
+        timestamps = [ts for ts in (timestamps or []) if ts > cutoff]
+        timestamps.append(now)
+        return timestamps, len(timestamps)
+    
+    count = user_messages.compute((chat_id, user_id), _record)
+    return count > limit, count, limit
+
+# ---------- Text Canonicalization ----------
+def canonicalize(text):
+    """
+    Matching form of text: invisible characters removed, NFKC, casefold, look-alike letters and
+    leetspeak folded to Latin ("FR€Е 𝐌𝐎𝐍𝐄𝐘" ~ "fr€e money", "c4sh" -> "cash"). Used on both sides of a match.
+    """
+    if text.isascii():
+        return text.lower().translate(CANON_ASCII_TABLE)
+    text = unicodedata.normalize('NFKC', CANON_INVISIBLE_RE.sub('', text))
+    return text.casefold().translate(CANON_TABLE)
+
+def message_canonical(message):
+    "canonicalize(text or caption), computed once per message and memoized on it"
+    canonical = getattr(message, '_canonical', None)
+    if canonical is None:
+        canonical = message._canonical = canonicalize(message.text or message.caption or '')
+    return canonical
+
+# ---------- Regex Triggers (sandboxed) ----------
+def validate_regex(pattern):
+    "None if pattern is acceptable as a regex trigger, else the reason"
+    if len(pattern) > REGEX_MAX_LEN:
+        return f"pattern longer than {REGEX_MAX_LEN} characters"
     try:
-        bot.ban_chat_member(chat_id, user_id)
-        bot.unban_chat_member(chat_id, user_id)
-        log_action(chat_id, user_id, "kicked")
-        return True
-    except Exception as e:
-        logging.warning(f"Kick failed: {e}")
+        re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        return str(e)
+    if REGEX_NESTED_QUANTIFIER_RE.search(pattern):
+        return "nested quantifier like (a+)+"
+    if REGEX_BACKREF_RE.search(pattern):
+        return "backreferences are not allowed"
+    return None
+
+def _regex_worker_init():
+    "Sandbox process setup: the CPU timer interrupts re (it checks for signals while matching)"
+    def _out_of_time(_signum, _frame):
+        raise TimeoutError()
+    signal.signal(signal.SIGVTALRM, _out_of_time)
+
+def _regex_worker_search(pattern, text, limit):
+    """
+    Runs inside a sandbox process (re caches the compiled pattern per process).
+    Returns (matched, cpu_seconds); matched is None if the pattern used up `limit` CPU seconds.
+    CPU time of this process only counts the pattern itself, not queueing or machine load.
+    """
+    started = time.process_time()
+    try:
+        signal.setitimer(signal.ITIMER_VIRTUAL, limit)
+        try:
+            matched = re.search(pattern, text, re.IGNORECASE) is not None
+        finally:
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+    except TimeoutError:
+        matched = None
+    return matched, time.process_time() - started
+
+class RegexSandbox:
+    """
+    Runs admin-supplied regexes in a small process pool, since re cannot be interrupted in-thread.
+    Each worker enforces the per-pattern CPU limit itself, so a slow pattern never takes down
+    searches of other messages and waiting in the queue never counts against a pattern.
+    """
+    def __init__(self, workers):
+        self._workers = workers
+        self._lock = Lock()
+        self._pool = None
+
+    def start(self):
+        "Create the pool if needed (main() calls this before other threads start, so the fork is clean)"
+        with self._lock:
+            if self._pool is None:
+                method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+                self._pool = multiprocessing.get_context(method).Pool(self._workers, initializer=_regex_worker_init)
+            return self._pool
+
+    def search(self, pattern, text, limit, wait):
+        """
+        (matched, cpu_seconds) as returned by _regex_worker_search, or None if no worker answered
+        within `wait` seconds (pool busy: no verdict on the pattern, the queued search still runs).
+        """
+        try:
+            return self.start().apply_async(_regex_worker_search, (pattern, text, limit)).get(wait)
+        except multiprocessing.TimeoutError:
+            return None
+
+REGEX_SANDBOX = RegexSandbox(REGEX_WORKERS)
+
+def regex_trigger_match(chat_id, trigger, text, deadline):
+    """
+    Run one regex trigger in the sandbox within the message budget. The trigger is disabled
+    only if its own run used up REGEX_TIMEOUT of CPU time; a busy pool just skips it.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
         return False
+    result = REGEX_SANDBOX.search(trigger['pattern'], text, REGEX_TIMEOUT, remaining)
+    if result is None:
+        return False
+    matched, _cpu = result
+    if matched is None:
+        disable_trigger(chat_id, trigger)
+        return False
+    return matched
 
-def undo_punishment(chat_id, user_id):
-    "Undo last punishment for user"
+def disable_trigger(chat_id, trigger):
+    "Switch off a trigger that exceeded its time budget and tell the group creator"
+    conn = db()
+    conn.execute("UPDATE triggers SET enabled=0 WHERE id=?", (trigger['id'],))
+    conn.commit()
+    conn.close()
+    invalidate_chat_config(chat_id)
+    logging.warning(f"Regex trigger {trigger['id']} in {chat_id} exceeded {REGEX_TIMEOUT}s and was disabled")
+    notify_creator(chat_id, _(chat_id, 'regex_trigger_disabled', pattern=safe_html(trigger['pattern']),
+                              ms=int(REGEX_TIMEOUT * 1000), title=safe_html(get_chat_title(chat_id, chat_id))))
+
+# ---------- Duplicate Content Detection ----------
+class DupeIndex:
+    "Bounded LRU of fingerprint -> [count, first_seen, notified]; a count restarts once its window has passed"
+    def __init__(self, max_entries):
+        self._entries = OrderedDict()
+        self._max = max_entries
+        self.last_seen = 0
+
+    def hit(self, fingerprint, now):
+        entry = self._entries.get(fingerprint)
+        if entry is None or now - entry[1] >= DUPE_WINDOW:
+            entry = self._entries[fingerprint] = [0, now, False]
+        else:
+            self._entries.move_to_end(fingerprint)
+        entry[0] += 1
+        self.last_seen = now
+        if len(self._entries) > self._max:
+            self._entries.popitem(last=False)
+        return entry
+
+DUPE_CHAT_INDEX = {}  # {chat_id: DupeIndex} - only groups with the duplicates lock on
+DUPE_GLOBAL_INDEX = DupeIndex(DUPE_GLOBAL_ENTRIES)
+DUPE_LOCK = Lock()
+
+def content_fingerprint(message):
+    "64-bit fingerprint of a message: media file_unique_id, or its normalized text (None if too short)"
+    media = message.photo[-1] if message.photo else (message.video or getattr(message, 'animation', None) or message.document)
+    if media:
+        key = 'm:' + media.file_unique_id
+    else:
+        key = DUPE_STRIP_RE.sub('', message_canonical(message))
+        if len(key) < DUPE_MIN_CHARS:
+            return None
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+def check_duplicate(chat_id, message):
+    """
+    Count this content in the group's and the cross-group index (O(message length), fixed memory).
+    Returns (is_duplicate, copies seen, first time flagged in this group).
+    """
+    fingerprint = content_fingerprint(message)
+    if fingerprint is None:
+        return False, 0, False
+    now = now_ts()
+    with DUPE_LOCK:
+        index = DUPE_CHAT_INDEX.get(chat_id)
+        if index is None:
+            index = DUPE_CHAT_INDEX[chat_id] = DupeIndex(DUPE_CHAT_ENTRIES)
+        entry = index.hit(fingerprint, now)
+        count = entry[0]
+        is_dupe = count >= DUPE_LIMIT
+        if DUPE_CROSS_LIMIT:
+            cross_count = DUPE_GLOBAL_INDEX.hit(fingerprint, now)[0]
+            if cross_count >= DUPE_CROSS_LIMIT:
+                is_dupe, count = True, max(count, cross_count)
+        first = is_dupe and not entry[2]
+        if is_dupe:
+            entry[2] = True
+    return is_dupe, count, first
+
+def handle_duplicate(chat_id, message):
+    "Delete repeated content and mute its sender (admins exempt); True if the message was handled"
+    is_dupe, count, first = check_duplicate(chat_id, message)
+    user_id = message.from_user.id
+    if not is_dupe or is_admin_member(chat_id, user_id):
+        return False
     try:
-        conn = db()
-        c = conn.cursor()
-        c.execute("SELECT id, type FROM punishments \n                     WHERE chat_id=? AND user_id=? \n                     ORDER BY id DESC LIMIT 1",
-                  (str(chat_id), str(user_id)))
-        row = c.fetchone()
-        if not row:
-            return False, "No punishment found"
-        
-        pid, ptype = row['id'], row['type']
-        c.execute("DELETE FROM punishments WHERE id=?", (pid,))
-        conn.commit()
-        conn.close()
-        
-        if ptype == 'ban':
-            bot.unban_chat_member(chat_id, user_id)
-        elif ptype == 'mute':
-            bot.restrict_chat_member(
-                chat_id, user_id,
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True
-            )
-        
-        log_action(chat_id, user_id, f"undo:{ptype}")
-        return True, ptype
+        bot.delete_message(chat_id, message.message_id)
     except Exception as e:
-        logging.warning(f"Undo failed: {e}")
-        return False, str(e)
+        if not note_chat_api_error(chat_id, e):
+            logging.warning(f"Duplicate delete failed in {chat_id}: {e}")
+    if first:
+        bot.send_message(chat_id, _(chat_id, 'dupe_detected', count=count))
+    mute_user(chat_id, user_id, DUPE_MUTE_SEC)
+    log_action(chat_id, user_id, Action.DUPLICATE_SPAM, value=count)
+    return True
 
-# ---------- Flood Protection (existing, preserved) ----------
-def check_flood(chat_id, user_id):
-    "Check if user is flooding, return (is_flood, count, limit)"
-    with FLOOD_LOCK:
-        settings = get_settings(chat_id)
-        window = settings.get('flood_window', 15)
-        limit = settings.get('flood_limit', 7)
-        
-        key = (chat_id, user_id)
-        now = now_ts()
-        cutoff = now - window
-        
-        # Remove old messages
-        user_messages[key] = [ts for ts in user_messages[key] if ts > cutoff]
-        user_messages[key].append(now)
-        
-        count = len(user_messages[key])
-        return count > limit, count, limit
+def prune_dupe_index(now):
+    "Drop per-group indexes idle for a whole window"
+    with DUPE_LOCK:
+        for chat_id in [cid for cid, index in DUPE_CHAT_INDEX.items() if now - index.last_seen >= DUPE_WINDOW]:
+            del DUPE_CHAT_INDEX[chat_id]
 
 # ---------- Blacklist System (existing, preserved) ----------
-def check_blacklist(chat_id, text):
-    "Check if text contains blacklisted words, return (found, word, violation_count)"
+def check_blacklist(chat_id, canonical):
+    "Check if canonical text (see canonicalize) contains blacklisted words, return (found, word, violation_count)"
     try:
-        conn = db()
-        c = conn.cursor()
-        c.execute("SELECT word FROM blacklist WHERE chat_id=?", (str(chat_id),))
-        words = [row['word'].lower() for row in c.fetchall()]
-        conn.close()
+        words = get_chat_config(chat_id)['blacklist']
         
-        text_lower = text.lower()
         for word in words:
-            if word in text_lower:
+            if word in canonical:
                 return True, word, 1
         return False, None, 0
     except:
         return False, None, 0
 
 def add_blacklist_violation(chat_id, user_id):
-    "Track blacklist violations, auto-ban on 3rd"
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) as cnt FROM punishments \n                 WHERE chat_id=? AND user_id=? AND type='blacklist'",
-              (str(chat_id), str(user_id)))
-    count = c.fetchone()['cnt'] + 1
-    
-    c.execute("INSERT INTO punishments (chat_id, user_id, type, until_ts) VALUES (?,?,?,?)",
-              (str(chat_id), str(user_id), 'blacklist', now_ts()))
-    conn.commit()
-    conn.close()
-    
-    if count >= 3:
-        ban_user(chat_id, user_id, "3 blacklist violations")
-        return count, True
-    return count, False
+    "Track blacklist violations, auto-ban at WARN_LIMIT active violations"
+    count, escalate = record_punishment(chat_id, user_id, 'blacklist')
+    if escalate:
+        ban_user(chat_id, user_id, f"{WARN_LIMIT} blacklist violations")
+    return count, escalate
+
+# ---------- Link Policy (URL lock) ----------
+class LinkPolicy:
+    """
+    Compiled link rules of a chat (cached with its config): a suffix trie of domain labels
+    (com -> example -> ads) ending in 'allow'/'deny'. The most specific matching rule wins;
+    without one, links are blocked only when the URL lock is on.
+    """
+    __slots__ = ('block_all', 'has_deny', 'trie')
+
+    def __init__(self, block_all, allow=(), deny=()):
+        self.block_all = block_all
+        self.has_deny = bool(deny)
+        self.trie = {}
+        for domains, verdict in ((allow, 'allow'), (deny, 'deny')):
+            for domain in domains:
+                node = self.trie
+                for label in reversed(domain.split('.')):
+                    node = node.setdefault(label, {})
+                node[''] = verdict  # '' is never a domain label
+
+    @property
+    def active(self):
+        return self.block_all or self.has_deny
+
+    def verdict(self, host):
+        "'allow' / 'deny' of the most specific rule matching host, None if none matches"
+        node, verdict = self.trie, None
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            verdict = node.get('', verdict)
+        return verdict
+
+    def blocks(self, host):
+        verdict = self.verdict(host) if host else None
+        return verdict == 'deny' or (verdict is None and self.block_all)
+
+def url_host(url):
+    "Lowercase host of a URL or bare domain ('' if none); tg:// links count as t.me"
+    url = url.strip()
+    if url.lower().startswith('tg:'):
+        return 't.me'
+    if '://' not in url:
+        url = 'http://' + url
+    try:
+        return (urlsplit(url).hostname or '').rstrip('.')
+    except ValueError:
+        return ''
+
+def message_link_hosts(message):
+    "Hosts of all url/text_link entities of text and caption, in one pass (offsets are UTF-16 code units)"
+    hosts = []
+    for text, entities in ((message.text, message.entities), (message.caption, message.caption_entities)):
+        encoded = None
+        for entity in entities or ():
+            if entity.type == 'text_link':
+                hosts.append(url_host(entity.url))
+            elif entity.type == 'url':
+                if encoded is None:
+                    encoded = (text or '').encode('utf-16-le')
+                hosts.append(url_host(encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le', 'ignore')))
+    return hosts
+
+def link_violation(chat_id, message):
+    "True if a link in the message is blocked by the chat's link policy"
+    policy = get_chat_config(chat_id)['link_policy']
+    if not policy.active:
+        return False
+    hosts = message_link_hosts(message)
+    if hosts:
+        return any(policy.blocks(host) for host in hosts)
+    # Obfuscated links Telegram did not mark: no host to check against the allowlist
+    return policy.block_all and bool(LINK_HINT_RE.search(message_canonical(message)))
 
 # ---------- Locks System (existing, preserved) ----------
 def check_locks(chat_id, message):
@@ -701,11 +2769,8 @@ def check_locks(chat_id, message):
     locks = locks_get(chat_id)
     
     violations = []
-    if locks.get('urls') and message.entities:
-        for entity in message.entities:
-            if entity.type in ['url', 'text_link']:
-                violations.append('urls')
-                break
+    if link_violation(chat_id, message):
+        violations.append('urls')
     
     if locks.get('photos') and message.photo:
         violations.append('photos')
@@ -725,36 +2790,161 @@ def check_locks(chat_id, message):
     return violations
 
 # ---------- Captcha System (existing, preserved) ----------
-def create_captcha(chat_id, user_id):
-    "Create math captcha for new user"
-    with CAPTCHA_LOCK:
-        num1 = random.randint(1, 10)
-        num2 = random.randint(1, 10)
-        answer = num1 + num2
-        
-        pending_captcha[(chat_id, user_id)] = {
-            'answer': answer,
-            'created_at': now_ts(),
-            'q1': num1,
-            'q2': num2
-        }
-        return num1, num2
+def create_captcha(chat_id, user_id, numbers=None):
+    "Create math captcha for new user (numbers=(q1, q2) reuses a shared question)"
+    num1, num2 = numbers if numbers else (random.randint(1, 10), random.randint(1, 10))
+    answer = num1 + num2
+    
+    pending_captcha[(chat_id, user_id)] = {
+        'answer': answer,
+        'created_at': now_ts(),
+        'q1': num1,
+        'q2': num2
+    }
+    return num1, num2
+
+def _captcha_failure(entry):
+    "compute() step for a wrong answer: count it and drop the entry once CAPTCHA_MAX_ATTEMPTS is reached"
+    if entry is None:
+        return None, (None, None)
+    entry = dict(entry, attempts=entry.get('attempts', 0) + 1)
+    return (None if entry['attempts'] >= CAPTCHA_MAX_ATTEMPTS else entry), (False, entry)
 
 def verify_captcha(chat_id, user_id, answer):
-    "Verify captcha answer"
-    with CAPTCHA_LOCK:
-        key = (chat_id, user_id)
-        if key not in pending_captcha:
-            return False
-        
-        correct = pending_captcha[key]['answer']
+    """
+    Atomically verify a captcha answer.
+    Returns (status, entry): status is None if no captcha is pending, else True/False;
+    a correct answer removes the pending entry in the same step, a wrong one bumps
+    entry['attempts'] (the entry is removed when it reaches CAPTCHA_MAX_ATTEMPTS).
+    """
+    def _check(entry):
+        if entry is None:
+            return None, (None, None)
         try:
-            if int(answer) == correct:
-                del pending_captcha[key]
-                return True
+            if int(answer) == entry['answer']:
+                return None, (True, entry)
         except ValueError:
             pass # Invalid input, treat as incorrect
-        return False
+        return _captcha_failure(entry)
+    
+    return pending_captcha.compute((chat_id, user_id), _check)
+
+def kick_failed_captcha(chat_id, user, notice='captcha_kicked'):
+    "Kick a user who failed the captcha (CAPTCHA_MAX_ATTEMPTS typed answers or one wrong button) and announce it"
+    pending_captcha.pop((chat_id, user.id), None)
+    kick_user(chat_id, user.id)
+    cancel_job('captcha_expire', f"{chat_id}:{user.id}")
+    try:
+        bot.send_message(chat_id, _(chat_id, notice, name=get_user_mention(user), attempts=CAPTCHA_MAX_ATTEMPTS),
+                         parse_mode="HTML")
+    except Exception as e:
+        logging.warning(f"Captcha kick notice failed: {e}")
+
+def remember_member(chat_id, user_id):
+    "Record a join in known_members; return True if the user was already known in this chat"
+    key = (str(chat_id), str(user_id))
+    now = now_ts()
+    with REJOIN_CACHE_LOCK:
+        entry = REJOIN_CACHE.get(key)
+        cached = entry is not None
+        if cached:
+            REJOIN_CACHE.move_to_end(key)
+            entry[1] = now  # Every join is visible to recent_joiners(), written or not
+    if cached and now - entry[0] < REJOIN_TOUCH_INTERVAL:
+        # last_seen only matters at retention granularity (days): skip SQLite for frequent rejoins
+        return True
+    
+    conn = db()
+    c = conn.cursor()
+    if cached:
+        seen = True
+    else:
+        c.execute("INSERT OR IGNORE INTO known_members (chat_id, user_id, first_seen, last_seen) VALUES (?,?,?,?)",
+                  (key[0], key[1], now, now))
+        seen = c.rowcount == 0
+    if seen:
+        c.execute("UPDATE known_members SET last_seen=? WHERE chat_id=? AND user_id=?", (now, key[0], key[1]))
+    conn.commit()
+    conn.close()
+    
+    _rejoin_cache_store([key], now)
+    return seen
+
+def _rejoin_cache_store(keys, now):
+    "Cache freshly written members; evicted entries with an unwritten later join are written out first"
+    unwritten = []
+    with REJOIN_CACHE_LOCK:
+        for key in keys:
+            REJOIN_CACHE[key] = [now, now]
+            REJOIN_CACHE.move_to_end(key)
+        while len(REJOIN_CACHE) > REJOIN_CACHE_SIZE:
+            key, (written, joined) = REJOIN_CACHE.popitem(last=False)
+            if joined > written:
+                unwritten.append((joined, key[0], key[1]))
+    if unwritten:
+        conn = db()
+        conn.executemany("UPDATE known_members SET last_seen=MAX(last_seen, ?) WHERE chat_id=? AND user_id=?", unwritten)
+        conn.commit()
+        conn.close()
+
+def recent_joiners(chat_id, since, limit):
+    """
+    User ids that joined chat_id at or after since: known_members plus the joins the rejoin LRU
+    has not written yet (throttled by REJOIN_TOUCH_INTERVAL). Joins not yet written when the process
+    restarts are lost, so after a restart a window may miss up to REJOIN_TOUCH_INTERVAL of rejoins.
+    """
+    chat_key = str(chat_id)
+    conn = db()
+    rows = conn.execute("SELECT user_id FROM known_members WHERE chat_id=? AND last_seen>=? LIMIT ?",
+                        (chat_key, since, limit)).fetchall()
+    conn.close()
+    user_ids = {int(row['user_id']) for row in rows}
+    with REJOIN_CACHE_LOCK:
+        user_ids.update(int(key[1]) for key, (_written, joined) in REJOIN_CACHE.items()
+                        if key[0] == chat_key and joined >= since)
+    return sorted(user_ids)[:limit]
+
+def remember_members(chat_id, user_ids):
+    "Bulk remember_member for a batch of joins; return the set of already known user ids"
+    chat_key = str(chat_id)
+    now = now_ts()
+    conn = db()
+    c = conn.cursor()
+    seen = set()
+    ids = [str(uid) for uid in user_ids]
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        c.execute(f"SELECT user_id FROM known_members WHERE chat_id=? AND user_id IN ({','.join('?' * len(chunk))})",
+                  [chat_key] + chunk)
+        seen.update(row['user_id'] for row in c.fetchall())
+    c.executemany("INSERT INTO known_members (chat_id, user_id, first_seen, last_seen) VALUES (?,?,?,?) \n                   ON CONFLICT(chat_id, user_id) DO UPDATE SET last_seen=excluded.last_seen",
+                  [(chat_key, uid, now, now) for uid in ids])
+    conn.commit()
+    conn.close()
+    
+    _rejoin_cache_store([(chat_key, uid) for uid in ids], now)
+    return {int(uid) for uid in seen}
+
+def prune_known_members(batch_size=5000):
+    "Delete members not seen within REJOIN_RETENTION_DAYS, in small chunks"
+    cutoff = now_ts() - REJOIN_RETENTION_DAYS * 86400
+    deleted = 0
+    while True:
+        conn = db()
+        c = conn.cursor()
+        c.execute("DELETE FROM known_members WHERE rowid IN \n                     (SELECT rowid FROM known_members WHERE last_seen < ? LIMIT ?)", (cutoff, batch_size))
+        count = c.rowcount
+        conn.commit()
+        conn.close()
+        deleted += count
+        if count < batch_size:
+            break
+        time.sleep(0.1)  # Let handlers get the write lock between chunks
+    
+    with REJOIN_CACHE_LOCK:
+        for key in [k for k, (_written, joined) in REJOIN_CACHE.items() if joined < cutoff]:
+            del REJOIN_CACHE[key]
+    return deleted
 
 def restrict_new_user(chat_id, user_id):
     "Restrict new user until captcha verification"
@@ -786,6 +2976,196 @@ def unrestrict_user(chat_id, user_id):
         logging.warning(f"Unrestrict failed: {e}")
         return False
 
+# ---------- Button Captcha (stateless, HMAC-signed callback data) ----------
+def _b36(number):
+    "Encode a non-negative int in base 36"
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        number, rem = divmod(number, 36)
+        out = digits[rem] + out
+        if not number:
+            return out
+
+def _captcha_sig(chat_id, user_id, expires, choice, correct):
+    "Short HMAC over the challenge; the correct flag is only recoverable with the secret"
+    msg = f"{chat_id}:{user_id}:{expires}:{choice}:{int(correct)}".encode()
+    digest = hmac.new(CAPTCHA_SECRET, msg, hashlib.sha256).digest()[:8]
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+def captcha_mode(chat_id):
+    "'button' or 'math' captcha for a chat (menu_json -> captcha -> button_mode)"
+    return 'button' if menu_get(chat_id).get('captcha', {}).get('button_mode') else 'math'
+
+def build_button_captcha(chat_id, user_id, numbers):
+    """
+    Build a button captcha for the question numbers=(q1, q2) stored in the pending entries.
+    user_id 0 means any pending user may answer (raid batches).
+    Returns (q1, q2, expires, keyboard); callback_data: cap:<chat>:<user>:<exp36>:<choice>:<sig>
+    """
+    q1, q2 = numbers
+    answer = q1 + q2
+    choices = {answer}
+    while len(choices) < CAPTCHA_OPTIONS:
+        choices.add(random.randint(2, 20))
+    choices = list(choices)
+    random.shuffle(choices)
+    
+    expires = now_ts() + CAPTCHA_TIMEOUT
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(*[
+        types.InlineKeyboardButton(
+            str(choice),
+            callback_data=f"cap:{chat_id}:{user_id}:{_b36(expires)}:{choice}:{_captcha_sig(chat_id, user_id, expires, choice, choice == answer)}"
+        )
+        for choice in choices
+    ])
+    return q1, q2, expires, keyboard
+
+def check_button_captcha(data):
+    """
+    Verify signed captcha callback data without any state lookup.
+    Returns (chat_id, user_id, expires, correct) or None if malformed/forged.
+    """
+    try:
+        _prefix, chat_id, user_id, expires36, choice, sig = data.split(':')
+        chat_id, user_id, expires, choice = int(chat_id), int(user_id), int(expires36, 36), int(choice)
+    except ValueError:
+        return None
+    for correct in (True, False):
+        if hmac.compare_digest(sig, _captcha_sig(chat_id, user_id, expires, choice, correct)):
+            return chat_id, user_id, expires, correct
+    return None
+
+def send_button_captcha(chat_id, user_id, text, numbers):
+    "Send a button captcha message for the pending question numbers=(q1, q2) and schedule its expiry"
+    q1, q2, expires, keyboard = build_button_captcha(chat_id, user_id, numbers)
+    sent = bot.send_message(
+        chat_id,
+        f"{text}\n\n{_(chat_id, 'captcha_button_verify', q1=q1, q2=q2)}",
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+    schedule_job(expires, 'captcha_expire', f"{chat_id}:{user_id}",
+                 {'chat_id': chat_id, 'user_id': user_id, 'message_id': getattr(sent, 'message_id', None)})
+    return sent
+
+def handle_captcha_callback(call):
+    "Verify a button captcha click (signed data); a wrong click kicks the clicker"
+    clicker = call.from_user.id
+    result = check_button_captcha(call.data)
+    if not result:
+        bot.answer_callback_query(call.id, _(call.message.chat.id, 'invalid_input'), show_alert=True)
+        return
+    
+    chat_id, user_id, expires, correct = result
+    if expires < now_ts():
+        bot.answer_callback_query(call.id, _(chat_id, 'captcha_expired'), show_alert=True)
+        return
+    # Single-user captcha: only that user; batch captcha (user 0): only users with a pending captcha
+    if (user_id and user_id != clicker) or (not user_id and (chat_id, clicker) not in pending_captcha):
+        bot.answer_callback_query(call.id, _(chat_id, 'captcha_not_for_you'), show_alert=True)
+        return
+    
+    if not correct:
+        bot.answer_callback_query(call.id, _(chat_id, 'captcha_failed'), show_alert=True)
+        log_action(chat_id, clicker, Action.CAPTCHA_FAILED)
+        kick_failed_captcha(chat_id, call.from_user, 'captcha_kicked_button')
+        if user_id:
+            try:
+                bot.delete_message(chat_id, call.message.message_id)
+            except Exception as e:
+                logging.warning(f"Captcha message delete failed: {e}")
+        return
+    
+    pending_captcha.pop((chat_id, clicker), None)
+    unrestrict_user(chat_id, clicker)
+    name = get_user_mention(call.from_user)
+    bot.answer_callback_query(call.id, _(chat_id, 'captcha_success', name=call.from_user.first_name or ''))
+    if user_id:
+        cancel_job('captcha_expire', f"{chat_id}:{user_id}")
+        try:
+            bot.edit_message_text(_(chat_id, 'captcha_success', name=name), chat_id, call.message.message_id, parse_mode="HTML")
+        except Exception as e:
+            logging.warning(f"Captcha message edit failed: {e}")
+    log_action(chat_id, clicker, Action.CAPTCHA_PASSED)
+
+# ---------- Scheduler (persisted, batched jobs) ----------
+def schedule_job(run_at, kind, ref, payload):
+    "Schedule a job; ref identifies it for cancel_job"
+    conn = db()
+    conn.execute("INSERT INTO scheduled_jobs (run_at, kind, ref, payload_json) VALUES (?,?,?,?)",
+                 (run_at, kind, ref, jdump(payload)))
+    conn.commit()
+    conn.close()
+
+def cancel_job(kind, ref):
+    "Cancel pending jobs of a kind with the given ref"
+    conn = db()
+    conn.execute("DELETE FROM scheduled_jobs WHERE kind=? AND ref=?", (kind, ref))
+    conn.commit()
+    conn.close()
+
+def expire_button_captchas(payloads):
+    "Batch expiry: remove timed-out captcha messages and lift restrictions (same as math captcha timeout)"
+    for payload in payloads:
+        chat_id, user_id, message_id = payload['chat_id'], payload['user_id'], payload.get('message_id')
+        if message_id:
+            try:
+                API_LIMITER.acquire()
+                bot.delete_message(chat_id, message_id)
+            except Exception as e:
+                if not note_chat_api_error(chat_id, e):
+                    logging.warning(f"Captcha message delete failed: {e}")
+        if user_id:
+            pending_captcha.pop((chat_id, user_id), None)
+            API_LIMITER.acquire()
+            unrestrict_user(chat_id, user_id)
+            logging.info(f"Button captcha expired for {user_id} in {chat_id}")
+
+JOB_HANDLERS = {
+    'captcha_expire': expire_button_captchas,
+    'punishment_expire': expire_punishments,
+    'fed_propagate': propagate_fed_actions,
+}
+
+def run_due_jobs():
+    "Claim due jobs and run them grouped by kind (one handler call per kind)"
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT id, kind, payload_json FROM scheduled_jobs WHERE run_at<=? ORDER BY run_at LIMIT ?",
+              (now_ts(), SCHEDULER_BATCH))
+    rows = c.fetchall()
+    if rows:
+        c.executemany("DELETE FROM scheduled_jobs WHERE id=?", [(row['id'],) for row in rows])
+        conn.commit()
+    conn.close()
+    
+    batches = {}
+    for row in rows:
+        batches.setdefault(row['kind'], []).append(jload(row['payload_json']))
+    for kind, payloads in batches.items():
+        handler = JOB_HANDLERS.get(kind)
+        if not handler:
+            logging.warning(f"No handler for scheduled job kind: {kind}")
+            continue
+        try:
+            handler(payloads)
+        except Exception as e:
+            logging.error(f"Scheduled job '{kind}' failed: {e}")
+    return len(rows)
+
+def scheduler_thread():
+    """Runs due scheduled jobs every SCHEDULER_INTERVAL seconds."""
+    while True:
+        try:
+            # Drain backlog quickly, then sleep
+            while run_due_jobs() >= SCHEDULER_BATCH:
+                pass
+        except Exception as e:
+            logging.error(f"Scheduler error: {e}")
+        time.sleep(SCHEDULER_INTERVAL)
+
 # ---------- XP System (XP & Ranking) (existing, preserved logic) ----------
 def add_xp(chat_id, user_id, points=1):
     "Add XP to user, respecting cooldown and enable flag"
@@ -847,6 +3227,114 @@ def get_rank(chat_id, user_id):
             
     return rank, xp
 
+# ---------- Raid Mode (batched join handling) ----------
+def register_join(chat_id):
+    "Record a join; return True if the chat is (now) in raid mode"
+    now = now_ts()
+    cutoff = now - RAID_WINDOW
+    
+    def _record(stamps):
+        stamps = [ts for ts in (stamps or []) if ts > cutoff]
+        stamps.append(now)
+        return stamps, len(stamps)
+    
+    rate = join_rates.compute(chat_id, _record)
+    
+    def _update(state):
+        if state and state['until'] > now:
+            # Every join during a raid extends the cool-down
+            return {'until': now + RAID_COOLDOWN, 'started_at': state['started_at']}, (True, False)
+        if rate >= RAID_THRESHOLD:
+            return {'until': now + RAID_COOLDOWN, 'started_at': now}, (True, True)
+        return None, (False, False)
+    
+    in_raid, started = raid_state.compute(chat_id, _update)
+    if started:
+        logging.warning(f"🚨 Raid detected in {chat_id}: {rate} joins in {RAID_WINDOW}s")
+        log_action(chat_id, 0, Action.RAID_START, value=rate)
+        try:
+            API_LIMITER.acquire(chat_id)
+            bot.send_message(chat_id, _(chat_id, 'raid_detected', count=rate, window=RAID_WINDOW))
+        except Exception as e:
+            logging.warning(f"Raid notice failed: {e}")
+    return in_raid
+
+def queue_raid_join(chat_id, user):
+    "Queue a joining user for the next batched flush"
+    entry = {'id': user.id, 'name': user.first_name or f"User{user.id}"}
+    raid_queue.compute(chat_id, lambda queue: ((queue or []) + [entry], None))
+
+def _raid_mention(entry):
+    return f'<a href="tg://user?id={entry["id"]}">{safe_html(entry["name"])}</a>'
+
+def _restrict_limited(chat_id, user_id):
+    API_LIMITER.acquire()
+    return restrict_new_user(chat_id, user_id)
+
+def flush_raid_joins(chat_id, entries):
+    "Handle a batch of joins: parallel restricts, one aggregated welcome/captcha message, bulk logging"
+    settings = get_settings(chat_id)
+    seen = remember_members(chat_id, [entry['id'] for entry in entries])
+    new_users = [entry for entry in entries if entry['id'] not in seen]
+    
+    if not settings.get('welcome_enabled', 1):
+        return
+    
+    analytics_rows = [(chat_id, entry['id'], Action.WELCOME_REJOIN) for entry in entries if entry['id'] in seen]
+    captcha_text = ""
+    if new_users:
+        # Restrict everyone new in parallel, through the global rate limiter
+        with ThreadPoolExecutor(max_workers=RAID_WORKERS) as pool:
+            list(pool.map(lambda entry: _restrict_limited(chat_id, entry['id']), new_users))
+        
+        # One shared question for the whole batch
+        numbers = (random.randint(1, 10), random.randint(1, 10))
+        pending_captcha.set_many(
+            ((chat_id, entry['id']), {'answer': sum(numbers), 'created_at': now_ts(), 'q1': numbers[0], 'q2': numbers[1]})
+            for entry in new_users
+        )
+        captcha_text = _(chat_id, 'captcha_verify', q1=numbers[0], q2=numbers[1])
+        analytics_rows += [(chat_id, entry['id'], Action.WELCOME_CAPTCHA) for entry in new_users]
+    
+    mentions = ", ".join(_raid_mention(entry) for entry in entries[:RAID_MAX_MENTIONS])
+    if len(entries) > RAID_MAX_MENTIONS:
+        mentions += " " + _(chat_id, 'raid_more', count=len(entries) - RAID_MAX_MENTIONS)
+    text = _(chat_id, 'welcome_message', name=mentions)
+    
+    try:
+        API_LIMITER.acquire(chat_id)
+        if new_users and captcha_mode(chat_id) == 'button':
+            # One button captcha for the whole batch (user 0 = any pending user), same question as the pending entries
+            send_button_captcha(chat_id, 0, text, numbers)
+        else:
+            if captcha_text:
+                text += f"\n\n{captcha_text}"
+            bot.send_message(chat_id, text, parse_mode="HTML")
+    except Exception as e:
+        if not note_chat_api_error(chat_id, e):
+            logging.warning(f"Raid welcome failed in {chat_id}: {e}")
+    log_actions_bulk(analytics_rows)
+
+def raid_flush_thread():
+    """Flushes queued raid joins every RAID_FLUSH_INTERVAL seconds and ends raids after the cool-down."""
+    while True:
+        try:
+            for chat_id, entries in raid_queue.pop_where(lambda chat_id, entries: bool(entries)):
+                flush_raid_joins(chat_id, entries)
+            
+            now = now_ts()
+            for chat_id, state in raid_state.pop_where(lambda chat_id, state: state['until'] <= now):
+                logging.info(f"✅ Raid mode ended in {chat_id} after {now - state['started_at']}s")
+                log_action(chat_id, 0, Action.RAID_END)
+                # Anything queued after the last flush is handled now
+                leftover = raid_queue.pop(chat_id)
+                if leftover:
+                    flush_raid_joins(chat_id, leftover)
+        except Exception as e:
+            logging.error(f"Raid flush error: {e}")
+        
+        time.sleep(RAID_FLUSH_INTERVAL)
+
 # ----------------------------------------------------------------------
 # -------------------- UX/Menu Overhaul Functions ----------------------
 # ----------------------------------------------------------------------
@@ -877,10 +3365,8 @@ def build_toggle_row(chat_id, key, value, desc_key, target_id=None):
     is_enabled = bool(value)
     state_text = _(chat_id_str, 'enabled') if is_enabled else _(chat_id_str, 'disabled')
     
-    # Prefix callback data with target_id if in private context (Point 16)
-    target_id_prefix = f"{target_id}:" if target_id else ""
-    # format: toggle:[target_id]:[key]:[new_value]
-    callback_data = f"toggle:{target_id_prefix}{key}:{int(not is_enabled)}" 
+    # format: toggle:[target_id]:[key]:[new_value] (key may be menu:<name>:<key>)
+    callback_data = cb_pack('toggle', target_id, *key.split(':'), int(not is_enabled))
     
     # HTML formatted description line
     desc_html_line = f"<b>{desc_title}</b>: <i>{desc_full}</i>"
@@ -928,13 +3414,19 @@ def _build_settings_menu(chat_id, settings, target_id):
     blacklist_desc, blacklist_kb = build_toggle_row(chat_id, 'blacklist_enabled', settings.get('blacklist_enabled', 1), 'blacklist_toggle', target_id)
     desc_lines.append(blacklist_desc)
     keyboard.add(*blacklist_kb)
+    
+    # Captcha Mode Toggle (button captcha instead of math answer)
+    button_mode = jload(settings.get('menu_json', '{}'), {}).get('captcha', {}).get('button_mode', 0)
+    captcha_desc, captcha_kb = build_toggle_row(chat_id, 'menu:captcha:button_mode', button_mode, 'captcha_button_mode', target_id)
+    desc_lines.append(captcha_desc)
+    keyboard.add(*captcha_kb)
 
     return "\n\n".join(desc_lines), keyboard
 
 def _build_locks_menu(chat_id, locks, target_id):
     """Builds the Locks menu with all lock toggles."""
     chat_id_str = str(chat_id)
-    desc_lines = [_(chat_id_str, 'locks_desc')]
+    desc_lines = [_(chat_id_str, 'locks_desc'), _(chat_id_str, 'links_hint')]
     keyboard = types.InlineKeyboardMarkup()
     
     # Lock Keys: {db_key: lang_key}
@@ -945,6 +3437,7 @@ def _build_locks_menu(chat_id, locks, target_id):
         'stickers': 'lock_stickers', 
         'forwards': 'lock_forwards', 
         'documents': 'lock_documents',
+        'duplicates': 'lock_duplicates',
     }
     
     # Rows of two toggles
@@ -976,11 +3469,11 @@ def _build_xp_system_menu(chat_id, target_id):
     keyboard = types.InlineKeyboardMarkup()
 
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'xp_settings'), callback_data=f"menu:{target_id}:xp_settings"),
-        types.InlineKeyboardButton(_(chat_id_str, 'leaderboard'), callback_data=f"xp:{target_id}:leaderboard")
+        types.InlineKeyboardButton(_(chat_id_str, 'xp_settings'), callback_data=cb_pack('menu', target_id, 'xp_settings')),
+        types.InlineKeyboardButton(_(chat_id_str, 'leaderboard'), callback_data=cb_pack('xp', target_id, 'leaderboard'))
     )
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'my_rank'), callback_data=f"xp:{target_id}:my_rank")
+        types.InlineKeyboardButton(_(chat_id_str, 'my_rank'), callback_data=cb_pack('xp', target_id, 'my_rank'))
     )
 
     return "\n\n".join(desc_lines), keyboard
@@ -1008,9 +3501,9 @@ def _build_xp_settings_menu(chat_id, menu_data, target_id):
     
     # Cooldown buttons (Point 4 - control)
     keyboard.add(
-        types.InlineKeyboardButton("-10s", callback_data=f"xp:{target_id}:cooldown:-10"),
+        types.InlineKeyboardButton("-10s", callback_data=cb_pack('xp', target_id, 'cooldown', '-10')),
         types.InlineKeyboardButton(f"Cool: {cooldown}s", callback_data="ignore_label"),
-        types.InlineKeyboardButton("+10s", callback_data=f"xp:{target_id}:cooldown:+10")
+        types.InlineKeyboardButton("+10s", callback_data=cb_pack('xp', target_id, 'cooldown', '+10'))
     )
     
     return "\n\n".join(desc_lines), keyboard
@@ -1025,9 +3518,12 @@ def _build_triggers_menu(chat_id, counts, target_id):
     
     # Add/List buttons
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'add_trigger'), callback_data=f"trigger:{target_id}:add"),
-        types.InlineKeyboardButton(_(chat_id_str, 'list_triggers'), callback_data=f"trigger:{target_id}:list")
+        types.InlineKeyboardButton(_(chat_id_str, 'add_trigger'), callback_data=cb_pack('trigger', target_id, 'add')),
+        types.InlineKeyboardButton(_(chat_id_str, 'list_triggers'), callback_data=cb_pack('trigger', target_id, 'list'))
     )
+    # Bulk import reads a document sent in private
+    if not chat_id_str.startswith('-'):
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'import_button'), callback_data=cb_pack('trigger', target_id, 'import')))
     
     # Placeholder for displaying existing triggers (Point 5)
     # The list view will be a separate menu type (not implemented here yet)
@@ -1045,9 +3541,12 @@ def _build_notes_menu(chat_id, counts, target_id):
 
     # Add/List buttons
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'add_note'), callback_data=f"note:{target_id}:add"),
-        types.InlineKeyboardButton(_(chat_id_str, 'list_notes'), callback_data=f"note:{target_id}:list")
+        types.InlineKeyboardButton(_(chat_id_str, 'add_note'), callback_data=cb_pack('note', target_id, 'add')),
+        types.InlineKeyboardButton(_(chat_id_str, 'list_notes'), callback_data=cb_pack('note', target_id, 'list'))
     )
+    # Bulk import reads a document sent in private
+    if not chat_id_str.startswith('-'):
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'import_button'), callback_data=cb_pack('note', target_id, 'import')))
     
     return "\n\n".join(desc_lines), keyboard
 
@@ -1061,9 +3560,12 @@ def _build_blacklist_menu(chat_id, counts, target_id):
     
     # Add/List buttons
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'add_word'), callback_data=f"blacklist:{target_id}:add"),
-        types.InlineKeyboardButton(_(chat_id_str, 'list_words'), callback_data=f"blacklist:{target_id}:list")
+        types.InlineKeyboardButton(_(chat_id_str, 'add_word'), callback_data=cb_pack('blacklist', target_id, 'add')),
+        types.InlineKeyboardButton(_(chat_id_str, 'list_words'), callback_data=cb_pack('blacklist', target_id, 'list'))
     )
+    # Bulk import reads a document sent in private
+    if not chat_id_str.startswith('-'):
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'import_button'), callback_data=cb_pack('blacklist', target_id, 'import')))
     
     return "\n\n".join(desc_lines), keyboard
 
@@ -1093,8 +3595,8 @@ def _build_polls_menu(chat_id, counts, target_id):
 
     # Create/Active buttons
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'create_poll'), callback_data=f"poll:{target_id}:create"),
-        types.InlineKeyboardButton(_(chat_id_str, 'active_polls'), callback_data=f"poll:{target_id}:active")
+        types.InlineKeyboardButton(_(chat_id_str, 'create_poll'), callback_data=cb_pack('poll', target_id, 'create')),
+        types.InlineKeyboardButton(_(chat_id_str, 'active_polls'), callback_data=cb_pack('poll', target_id, 'active'))
     )
     
     return "\n\n".join(desc_lines), keyboard
@@ -1107,6 +3609,7 @@ def _build_moderation_menu(chat_id):
 
     # Inform the user how to use commands
     desc_lines.append("\n💡 <b>Usage:</b> किसी भी मैसेज को <b>reply</b> करके कमांड का उपयोग करें।\n   जैसे: <i>/warn</i>, <i>/mute 1h</i>, <i>/ban</i>")
+    desc_lines.append("🧹 <b>Mass:</b> <i>/massban, /massmute [1h], /masskick, /massunban</i> + user ids, <i>joined 30</i> (पिछले 30 मिनट में join हुए), या ids वाले मैसेज/फ़ाइल को reply।")
     
     # Dummy buttons for visual guidance (no action, only ignore_label)
     keyboard.add(
@@ -1120,7 +3623,7 @@ def _build_moderation_menu(chat_id):
 
 
 # ---------- Menu Rendering (Point 2, 12, 13, 18, 19) ----------
-def send_menu(chat_id, user_id, menu_type, message_id=None, is_private=False, group_title="", target_group_id=None):
+def send_menu(chat_id, user_id, menu_type, message_id=None, is_private=False, group_title="", target_group_id=None, menu_arg=None):
     "Generates and sends/edits the specified menu"
     chat_id_str = str(chat_id)
     settings = get_settings(chat_id_str)
@@ -1141,7 +3644,7 @@ def send_menu(chat_id, user_id, menu_type, message_id=None, is_private=False, gr
     # Initial description line
     if is_private and target_group_id:
         # Private chat context for a specific group
-        title_line = _(chat_id_str, 'menu_in_private_opened', title=safe_html(group_title))
+        title_line = _(chat_id_str, 'menu_in_private_opened', title=safe_html(group_title), desc=_(chat_id_str, 'main_menu_desc'))
     else:
         # Normal main menu in group or private
         title_line = _(chat_id_str, 'main_menu_desc')
@@ -1156,113 +3659,125 @@ def send_menu(chat_id, user_id, menu_type, message_id=None, is_private=False, gr
         
         # [Settings] [Moderation]
         keyboard.add(
-            types.InlineKeyboardButton(_(chat_id_str, 'settings'), callback_data=f"menu:{callback_target_id}:settings"),
-            types.InlineKeyboardButton(_(chat_id_str, 'moderation'), callback_data=f"menu:{callback_target_id}:moderation")
+            types.InlineKeyboardButton(_(chat_id_str, 'settings'), callback_data=cb_pack('menu', callback_target_id, 'settings')),
+            types.InlineKeyboardButton(_(chat_id_str, 'moderation'), callback_data=cb_pack('menu', callback_target_id, 'moderation'))
         )
         
         # [Locks] [XP System]
         keyboard.add(
-            types.InlineKeyboardButton(_(chat_id_str, 'locks'), callback_data=f"menu:{callback_target_id}:locks"),
-            types.InlineKeyboardButton(_(chat_id_str, 'xp_system'), callback_data=f"menu:{callback_target_id}:xp_system")
+            types.InlineKeyboardButton(_(chat_id_str, 'locks'), callback_data=cb_pack('menu', callback_target_id, 'locks')),
+            types.InlineKeyboardButton(_(chat_id_str, 'xp_system'), callback_data=cb_pack('menu', callback_target_id, 'xp_system'))
         )
         
         # [Notes] [Triggers]
         notes_btn_text = f"{_(chat_id_str, 'notes')} ({counts['notes']})"
         triggers_btn_text = f"{_(chat_id_str, 'triggers')} ({counts['triggers']})"
         keyboard.add(
-            types.InlineKeyboardButton(notes_btn_text, callback_data=f"menu:{callback_target_id}:notes"),
-            types.InlineKeyboardButton(triggers_btn_text, callback_data=f"menu:{callback_target_id}:triggers")
+            types.InlineKeyboardButton(notes_btn_text, callback_data=cb_pack('menu', callback_target_id, 'notes')),
+            types.InlineKeyboardButton(triggers_btn_text, callback_data=cb_pack('menu', callback_target_id, 'triggers'))
         )
         
         # [Blacklist] [Commands]
         blacklist_btn_text = f"{_(chat_id_str, 'blacklist')} ({counts['blacklist']})"
         keyboard.add(
-            types.InlineKeyboardButton(blacklist_btn_text, callback_data=f"menu:{callback_target_id}:blacklist"),
-            types.InlineKeyboardButton(_(chat_id_str, 'commands'), callback_data=f"menu:{callback_target_id}:commands")
+            types.InlineKeyboardButton(blacklist_btn_text, callback_data=cb_pack('menu', callback_target_id, 'blacklist')),
+            types.InlineKeyboardButton(_(chat_id_str, 'commands'), callback_data=cb_pack('menu', callback_target_id, 'commands'))
         )
         
         # [Polls] [Language] (Point 4)
         polls_btn_text = f"{_(chat_id_str, 'polls')} ({counts['polls']})"
         lang_btn_text = f"🌐 {_(chat_id_str, 'language')}: {data_settings['lang'].upper()}"
         keyboard.add(
-            types.InlineKeyboardButton(polls_btn_text, callback_data=f"menu:{callback_target_id}:polls"),
-            types.InlineKeyboardButton(lang_btn_text, callback_data=f"lang:{callback_target_id}:toggle")
+            types.InlineKeyboardButton(polls_btn_text, callback_data=cb_pack('menu', callback_target_id, 'polls')),
+            types.InlineKeyboardButton(lang_btn_text, callback_data=cb_pack('lang', callback_target_id, 'toggle'))
         )
         
+        # [Stats]
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'stats'), callback_data=cb_pack('menu', callback_target_id, 'stats')))
+        
     # --- Settings Menu (Point 1, 2, 19) ---
     elif menu_type == 'settings':
         desc, kb = _build_settings_menu(chat_id, data_settings, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard # Replace keyboard rows
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
     
     # --- Moderation Menu (Point 10) ---
     elif menu_type == 'moderation':
         desc, kb = _build_moderation_menu(chat_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
 
     # --- Locks Menu (Point 5, 19) ---
     elif menu_type == 'locks':
         desc, kb = _build_locks_menu(chat_id, data_locks, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
         
     # --- XP System Menu (Point 8, 19) ---
     elif menu_type == 'xp_system':
         desc, kb = _build_xp_system_menu(chat_id, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
 
     # --- XP Settings Sub-Menu (Point 4, 19) ---
     elif menu_type == 'xp_settings':
         desc, kb = _build_xp_settings_menu(chat_id, data_menu, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:xp_system"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'xp_system')))
 
     # --- Triggers Menu (Point 5, 19) ---
     elif menu_type == 'triggers':
         desc, kb = _build_triggers_menu(chat_id, counts, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
         
     # --- Notes Menu (Point 6, 19) ---
     elif menu_type == 'notes':
         desc, kb = _build_notes_menu(chat_id, counts, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
 
     # --- Blacklist Menu (Point 8, 19) ---
     elif menu_type == 'blacklist':
         desc, kb = _build_blacklist_menu(chat_id, counts, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
 
     # --- Commands Menu (Point 9, 19) ---
     elif menu_type == 'commands':
         desc, kb = _build_commands_menu(chat_id, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
 
     # --- Polls Menu (Point 7, 19) ---
     elif menu_type == 'polls':
         desc, kb = _build_polls_menu(chat_id, counts, callback_target_id)
         desc_lines.append(desc)
         keyboard.keyboard = kb.keyboard
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
+        
+    # --- Stats Page (menu_arg = period) ---
+    elif menu_type == 'stats':
+        period = menu_arg if menu_arg in STATS_PERIODS else 'today'
+        desc_lines.append(render_group_stats(chat_id_str, data_chat_id, period))
+        keyboard.row(*[types.InlineKeyboardButton(("• " if name == period else "") + _(chat_id_str, f'stats_period_{name}'),
+                                                  callback_data=cb_pack('menu', callback_target_id, 'stats', name))
+                       for name in STATS_PERIODS])
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', callback_target_id, 'main')))
         
     # --- Fallback/Unknown Menu ---
     else:
         desc_lines.append(_(chat_id_str, 'unknown_action'))
-        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'main_menu'), callback_data=f"menu:{callback_target_id}:main"))
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'main_menu'), callback_data=cb_pack('menu', callback_target_id, 'main')))
         
     # Final message assembly
     menu_text = "\n\n".join(desc_lines)
@@ -1322,12 +3837,8 @@ def handle_start_menu(message):
                         )
                         return
                         
-                    # 2. Group info प्राप्त करें
-                    try:
-                        group_info = bot.get_chat(target_group_id)
-                        group_title = group_info.title
-                    except Exception:
-                        group_title = target_group_id
+                    # 2. Group info प्राप्त करें (cached)
+                    group_title = get_chat_title(target_group_id, target_group_id)
                         
                     # सीधे ग्रुप की main settings मेन्यू भेजें
                     send_menu(chat_id, user_id, 'main', is_private=True, group_title=group_title, target_group_id=target_group_id)
@@ -1426,270 +3937,667 @@ def handle_start_menu(message):
 
             
 # ---------- Callback Inline Handler (Point 3, 15, 16, 17) ----------
+# menu_json sub-sections whose toggles live on another menu page
+TOGGLE_MENU_FOR = {'captcha': 'settings'}
+
+# Parsed callback_data: action[:target_id][:args...]; target_id defaults to the current chat
+CallbackData = namedtuple('CallbackData', ['action', 'target_id', 'args', 'chat_id', 'user_id', 'message_id'])
+
+# Compact form: ~op:target:arg... (op = one letter, target = signed base36 chat id or empty
+# for the current chat, args = one-letter word codes, '#'+base36 ints or "'"+literals with
+# '%' and ':' percent-escaped). Args that don't fit in 64 bytes go to CB_PAYLOADS and the
+# data carries '$'+token; cb_stash() does the same for selected free-text args.
+CB_OPS = {'menu': 'm', 'toggle': 't', 'lang': 'l', 'xp': 'x', 'note': 'n',
+          'trigger': 'r', 'blacklist': 'b', 'poll': 'p'}
+CB_WORDS = ('main', 'settings', 'moderation', 'locks', 'xp_system', 'xp_settings', 'notes', 'triggers',
+            'blacklist', 'commands', 'polls', 'menu', 'toggle', 'cooldown', 'my_rank', 'leaderboard',
+            'add', 'list', 'del', 'vote', 'close', 'create', 'active', 'page', 'search', 'size')
+CB_WORD_CODES = {word: chr(ord('A') + i) for i, word in enumerate(CB_WORDS)}
+CB_OPS_REV = {code: op for op, code in CB_OPS.items()}
+CB_WORDS_REV = {code: word for word, code in CB_WORD_CODES.items()}
+CB_PAYLOADS = ShardedState(ttl=CB_PAYLOAD_TTL, namespace='cbp')  # {(target, token): [args]}
+CallbackStash = namedtuple('CallbackStash', ['token'])  # cb_pack arg stored in CB_PAYLOADS
+
+def _cb_arg(arg):
+    if isinstance(arg, CallbackStash):
+        return '$' + arg.token
+    if isinstance(arg, int) and not isinstance(arg, bool) and arg >= 0:
+        return '#' + _b36(arg)
+    arg = str(arg)
+    if arg in CB_WORD_CODES:
+        return CB_WORD_CODES[arg]
+    return "'" + arg.replace('%', '%25').replace(':', '%3A')
+
+def _cb_unarg(arg):
+    "Decode one compact arg (unmarked args come from keyboards sent before literals were quoted)"
+    if arg.startswith("'"):
+        return unquote(arg[1:])
+    if arg.startswith('#'):
+        return str(int(arg[1:], 36))
+    return CB_WORDS_REV.get(arg, arg)
+
+def _cb_target(target_id):
+    "Signed base36 target, '' for the current chat"
+    target = str(target_id) if target_id not in (None, '') else ''
+    if target:
+        number = int(target)
+        target = ('-' if number < 0 else '') + _b36(abs(number))
+    return target
+
+def cb_stash(target_id, *args):
+    "Store free-text args server-side once; the result can be passed to cb_pack for many buttons"
+    token = _b36(random.getrandbits(48))
+    CB_PAYLOADS[(_cb_target(target_id) or '0', token)] = [str(arg) for arg in args]
+    return CallbackStash(token)
+
+def cb_pack(action, target_id=None, *args):
+    "Encode callback data compactly; oversized args are stored server-side"
+    head = f"~{CB_OPS.get(action, action)}:{_cb_target(target_id)}"
+    data = ':'.join([head] + [_cb_arg(arg) for arg in args])
+    if len(data.encode()) <= CB_MAX_BYTES:
+        return data
+    # Oversized: store every arg (already stashed ones flattened in place) under one token
+    target = _cb_target(target_id) or '0'
+    flat = []
+    for arg in args:
+        flat.extend(CB_PAYLOADS.get((target, arg.token), []) if isinstance(arg, CallbackStash) else [str(arg)])
+    return f"{head}:${cb_stash(target_id, *flat).token}"
+
+def _cb_unpack(data, chat_id):
+    "Decode compact callback data in one pass -> (action, target_id, args); args None if the payload expired"
+    parts = data[1:].split(':')
+    action = CB_OPS_REV.get(parts[0], parts[0])
+    target = parts[1] if len(parts) > 1 else ''
+    target_id = str(int(target, 36)) if target else str(chat_id)
+    args = []
+    for arg in parts[2:]:
+        if arg.startswith('$'):
+            stored = CB_PAYLOADS.get((target or '0', arg[1:]))
+            if stored is None:
+                return action, target_id, None
+            args.extend(stored)
+        else:
+            args.append(_cb_unarg(arg))
+    return action, target_id, tuple(args)
+
+CALLBACK_ROUTES = {}  # {(action, sub_action) or action: (handler, auth)}
+
+def callback_route(action, sub_action=None, auth='creator'):
+    """
+    Register a callback handler for an action (optionally a specific sub-action, args[0]).
+    auth: 'none' (anyone), 'admin' (chat admin) or 'creator' (creator of the target group).
+    """
+    def decorator(fn):
+        CALLBACK_ROUTES[(action, sub_action) if sub_action else action] = (fn, auth)
+        return fn
+    return decorator
+
+def parse_callback_data(call):
+    "Parse call.data once into a CallbackData struct (compact or legacy format)"
+    chat_id = call.message.chat.id
+    if call.data.startswith('~'):
+        try:
+            action, target_id, args = _cb_unpack(call.data, chat_id)
+        except ValueError:
+            # Malformed (tampered) data: falls through to the unknown-action handler
+            action, target_id, args = 'invalid', str(chat_id), ()
+        if args is None:
+            action, args = 'expired', ()
+        return CallbackData(action, target_id, args, chat_id, call.from_user.id, call.message.message_id)
+    # Legacy action:target:args strings (keyboards sent before the compact encoding)
+    parts = call.data.split(':')
+    if len(parts) > 1 and parts[1].startswith('-'):
+        target_id, args = parts[1], tuple(parts[2:])
+    else:
+        target_id, args = str(chat_id), tuple(parts[1:])
+    return CallbackData(parts[0], target_id, args, chat_id, call.from_user.id, call.message.message_id)
+
+def authorize_callback(cb, auth):
+    "Authorization middleware (member statuses come from the member status cache)"
+    if auth == 'none':
+        return True
+    if auth == 'admin':
+        return is_admin_member(cb.chat_id, cb.user_id)
+    # 'creator': settings of a group are managed by its creator, in the group or in private
+    if cb.target_id.startswith('-'):
+        return is_creator_member(cb.target_id, cb.user_id)
+    return True # Private chat acting on itself (like language toggle)
+
 @bot.callback_query_handler(func=lambda call: True)
 def callback_inline(call):
-    chat_id = call.message.chat.id
-    user_id = call.from_user.id
-    message_id = call.message.message_id
-    data = call.data
+    "Single entry point: parse once, look up the route in O(1), authorize, dispatch"
+    # Logging the callback (Point 17)
+    logging.info(f"Callback from {call.from_user.id} in {call.message.chat.id}: {call.data}")
+    
+    cb = parse_callback_data(call)
+    sub_action = cb.args[0] if cb.args else None
+    route = CALLBACK_ROUTES.get((cb.action, sub_action)) or CALLBACK_ROUTES.get(cb.action)
+    handler, auth = route if route else (_callback_unknown, 'creator')
+    
+    if not authorize_callback(cb, auth):
+        bot.answer_callback_query(call.id, _(cb.target_id, 'admin_only'), show_alert=True)
+        return
+    handler(call, cb)
+
+def _private_group_title(cb):
+    "Group title for the private-chat menu header"
+    return get_chat_title(cb.target_id) if not str(cb.chat_id).startswith('-') else ""
+
+# --- Fallback for Unknown Action (Point 17) ---
+def _callback_unknown(call, cb):
+    logging.warning(f"Unknown callback action: {call.data}")
+    bot.answer_callback_query(call.id, _(cb.target_id, 'unknown_action'), show_alert=True)
+    # Re-render main menu as a safe fallback
+    send_menu(cb.chat_id, cb.user_id, 'main', message_id=cb.message_id, target_group_id=cb.target_id)
+
+@callback_route('expired')
+def _callback_expired(call, cb):
+    bot.answer_callback_query(call.id, _(cb.target_id, 'menu_expired'), show_alert=True)
+    send_menu(cb.chat_id, cb.user_id, 'main', message_id=cb.message_id, target_group_id=cb.target_id)
+
+# --- Button Captcha: answered by new (non-admin) users, verified by signature ---
+@callback_route('cap', auth='none')
+def _callback_captcha(call, cb):
+    handle_captcha_callback(call)
+
+# --- Ignore Label ---
+@callback_route('ignore_label', auth='none')
+def _callback_ignore(call, cb):
+    bot.answer_callback_query(call.id, "")
+
+# --- Menu Navigation (Point 2) ---
+@callback_route('menu')
+def _callback_menu(call, cb):
+    menu_type = cb.args[0]
+    # In private chat context, need to pass group title for re-rendering the header
+    send_menu(cb.chat_id, cb.user_id, menu_type, message_id=cb.message_id, is_private=True,
+              group_title=_private_group_title(cb), target_group_id=cb.target_id,
+              menu_arg=cb.args[1] if len(cb.args) > 1 else None)
+    bot.answer_callback_query(call.id)
+
+# --- Language Toggle (Point 3, 15) ---
+@callback_route('lang')
+def _callback_lang(call, cb):
+    target_id = cb.target_id
+    old_lang = get_settings(target_id).get('lang', 'hi')
+    new_lang = 'en' if old_lang == 'hi' else 'hi'
+    set_setting(target_id, 'lang', new_lang)
+    
+    # Log language change
+    log_action(target_id, cb.user_id, Action.LANG_CHANGE, new_lang)
+    
+    # Re-render the menu instantly
+    send_menu(cb.chat_id, cb.user_id, 'main', message_id=cb.message_id, target_group_id=target_id)
+    bot.answer_callback_query(call.id, _(target_id, 'lang_changed'))
+
+# --- Generic Toggle Handler (Point 1, 3, 16) ---
+@callback_route('toggle')
+def _callback_toggle(call, cb):
+    # Data format: toggle:[target_id]:[key]:[new_value]; key may itself contain ':' (menu:submenu:setting)
+    target_id = cb.target_id
+    key = ':'.join(cb.args[:-1])
+    value = int(cb.args[-1])
+    
+    # Check if it's a menu_json key (e.g., menu:xp_settings:xp_enabled)
+    if key.startswith('menu:'):
+        # Format: menu:submenu:setting_key
+        _prefix, submenu, setting_key = key.split(':')
+        menu_data = menu_get(target_id)
+        if submenu not in menu_data:
+            menu_data[submenu] = {}
+        menu_data[submenu][setting_key] = value
+        menu_set(target_id, menu_data)
+        menu_type = TOGGLE_MENU_FOR.get(submenu, submenu) # Use submenu to re-render the correct view
+    
+    # Check if it's a lock setting (e.g., lock_urls)
+    elif key.startswith('lock_'):
+        lock_key = key.replace('lock_', '')
+        locks_data = locks_get(target_id)
+        locks_data[lock_key] = value
+        locks_set(target_id, locks_data)
+        menu_type = 'locks' # Use 'locks' to re-render
+        
+    # Standard settings (e.g., welcome_enabled)
+    else:
+        set_setting(target_id, key, value)
+        menu_type = 'settings' # Use 'settings' to re-render
+    
+    # Log the action (Point 17)
+    log_action(target_id, cb.user_id, Action.TOGGLE, key, value)
+    
+    # Re-render the menu instantly (in private chat, target_id is the group)
+    send_menu(cb.chat_id, cb.user_id, menu_type, message_id=cb.message_id, is_private=True,
+              group_title=_private_group_title(cb), target_group_id=target_id)
+    bot.answer_callback_query(call.id, _(target_id, 'setting_updated'))
+
+# --- XP Cooldown Change (Point 4) ---
+@callback_route('xp', 'cooldown')
+def _callback_xp_cooldown(call, cb):
+    target_id = cb.target_id
+    change = int(cb.args[1])
+    
+    menu_data = menu_get(target_id)
+    xp_settings = menu_data.get('xp_settings', {})
+    current_cooldown = xp_settings.get('xp_cooldown', 60)
+    
+    new_cooldown = max(5, current_cooldown + change) # Minimum 5 seconds
+    
+    xp_settings['xp_cooldown'] = new_cooldown
+    menu_data['xp_settings'] = xp_settings
+    menu_set(target_id, menu_data)
+    
+    log_action(target_id, cb.user_id, Action.XP_COOLDOWN, value=new_cooldown)
+    
+    # Re-render XP settings menu
+    send_menu(cb.chat_id, cb.user_id, 'xp_settings', message_id=cb.message_id, target_group_id=target_id)
+    bot.answer_callback_query(call.id, _(target_id, 'setting_updated'))
+
+@callback_route('xp', 'my_rank')
+def _callback_xp_my_rank(call, cb):
+    # Get rank and XP for the user who clicked the button (user_id)
+    rank, xp = get_rank(cb.target_id, cb.user_id)
+    name = get_user_display_name(call.from_user)
+    
+    response_text = _(cb.target_id, 'rank_display', name=safe_html(name), rank=rank, xp=xp)
+    bot.answer_callback_query(call.id, response_text, show_alert=True)
+
+@callback_route('xp', 'leaderboard')
+def _callback_xp_leaderboard(call, cb):
+    target_id = cb.target_id
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT user_id, points FROM xp WHERE chat_id=? ORDER BY points DESC LIMIT 10", 
+              (target_id,))
+    leaderboard = c.fetchall()
+    conn.close()
+    
+    # Build leaderboard message
+    lb_text = "🏆 <b>Top 10 Leaderboard</b> 🏆\n\n"
+    for i, row in enumerate(leaderboard):
+        try:
+            member = bot.get_chat_member(target_id, row['user_id'])
+            name = get_user_display_name(member.user)
+        except:
+            name = f"User {row['user_id']}"
+            
+        lb_text += f"#{i+1}: {safe_html(name)} - {row['points']} XP\n"
+        
+    if not leaderboard:
+        lb_text += "No XP data yet."
+        
+    bot.answer_callback_query(call.id, "Leaderboard fetched.", show_alert=False)
+    bot.send_message(cb.chat_id, lb_text)
+
+# --- Other Modules (Notes, Triggers, Blacklist, Polls) - multi-step STATE flow (Point 3, 5, 6, 7, 8) ---
+@callback_route('note', 'add')
+@callback_route('trigger', 'add')
+@callback_route('blacklist', 'add')
+@callback_route('poll', 'create')
+def _callback_module_add(call, cb):
+    action, target_id = cb.action, cb.target_id
+    # Set state for the next user message to be captured
+    STATE[(cb.chat_id, cb.user_id)] = {'action': f'{action}_wait_for_key', 'target_id': target_id}
     
-    # Logging the callback (Point 17)
-    logging.info(f"Callback from {user_id} in {chat_id}: {data}")
-
-    # --- Pre-Check: Admin/Creator check ---
-    # In private chat, the user must be the creator of the target group
-    # Format: action:target_id:key:value
-    
-    # Parse data: [action, target_id, ...]
-    parts = data.split(':')
-    action = parts[0]
-    
-    # Determine the chat ID where settings are applied (target_id)
-    # If in private chat, the target_id is the group's chat_id
-    target_id = parts[1] if len(parts) > 1 and parts[1].startswith('-') else str(chat_id)
-
-    # If in private chat mode (target_id is a group ID), check if user is creator of that group
-    if str(chat_id).startswith('-') and target_id == str(chat_id):
-        # User clicked a button in a group, target is the same group
-        is_allowed = is_creator_member(chat_id, user_id)
-        if not is_allowed:
-            bot.answer_callback_query(call.id, _(chat_id, 'admin_only'), show_alert=True)
-            return
-    elif str(chat_id).startswith('-') and target_id.startswith('-'):
-        # User clicked a button in a group, but target_id is different (shouldn't happen with current flow)
-        is_allowed = is_creator_member(target_id, user_id)
-        if not is_allowed:
-            bot.answer_callback_query(call.id, _(target_id, 'admin_only'), show_alert=True)
-            return
-    elif not str(chat_id).startswith('-') and target_id.startswith('-'):
-        # User clicked a button in private chat, target is a group (Must be creator of target_id)
-        is_allowed = is_creator_member(target_id, user_id)
-        if not is_allowed:
-            bot.answer_callback_query(call.id, _(target_id, 'admin_only'), show_alert=True)
+    if action == 'note':
+        prompt = _(target_id, 'usage', usage="Note key और content भेजें, जैसे: <code>!rules The group rules are...</code>")
+    elif action == 'trigger':
+        prompt = _(target_id, 'usage', usage="Trigger pattern और reply भेजें, जैसे: <code>!hello Hi there!</code>\nRegex के लिए: <code>re:^(hi|hello)\\b Hi there!</code>")
+    elif action == 'blacklist':
+        prompt = _(target_id, 'usage', usage="ब्लैकलिस्ट करने के लिए शब्द भेजें। एक समय में एक शब्द।")
+    else:
+        prompt = _(target_id, 'usage', usage="Poll का प्रश्न और विकल्पों को नई लाइन में भेजें। \nउदाहरण: \n<code>Favourite colour?\nRed\nBlue\nGreen</code>")
+        
+    bot.send_message(cb.chat_id, prompt)
+    bot.answer_callback_query(call.id, f"Waiting for {action} input...")
+
+@callback_route('note', 'import')
+@callback_route('trigger', 'import')
+@callback_route('blacklist', 'import')
+def _callback_module_import(call, cb):
+    # The next private document is imported (handled in handle_private_documents)
+    STATE[(cb.chat_id, cb.user_id)] = {'action': f'{cb.action}_wait_for_file', 'target_id': cb.target_id}
+    bot.send_message(cb.chat_id, _(cb.target_id, 'import_prompt'))
+    bot.answer_callback_query(call.id)
+
+@callback_route('poll', 'active')
+def _callback_poll_active(call, cb):
+    list_text = "📋 Poll List\n"
+    conn = db()
+    c = conn.cursor()
+    c.execute("SELECT id, question FROM polls WHERE chat_id=? AND open=1", (cb.target_id,))
+    for row in c.fetchall():
+        list_text += f"<b>ID {row['id']}</b>: {safe_html(row['question'][:50])}...\n"
+    conn.close()
+    
+    bot.send_message(cb.chat_id, list_text)
+    bot.answer_callback_query(call.id, "Listing polls...")
+
+# ---------- Config Export / Import Commands ----------
+# Registered before handle_group_messages, which swallows every group text message
+@bot.message_handler(commands=['export', 'import'])
+def handle_config_commands(message):
+    "/export in a group (sent to the creator in private) or /export <group_id> and /import <group_id> in private"
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    command = message.text.split()[0].replace('/', '').split('@')[0]
+    parts = message.text.split()
+    
+    if message.chat.type == 'private':
+        if len(parts) < 2 or not parts[1].startswith('-'):
+            bot.send_message(chat_id, _(chat_id, 'usage', usage=f"/{command} &lt;group_id&gt;"))
             return
-    elif not str(chat_id).startswith('-') and target_id == str(chat_id):
-        # User clicked a button in private chat, target is private chat itself (like language toggle)
-        is_allowed = True # Always allowed in private chat
+        target_id = parts[1]
     else:
-        # User clicked a button in a group, target is the same group (Standard check)
-        is_allowed = is_admin_member(chat_id, user_id)
-        if not is_allowed:
-            bot.answer_callback_query(call.id, _(chat_id, 'admin_only'), show_alert=True)
+        if command == 'import':
+            bot.reply_to(message, _(chat_id, 'usage', usage="/import &lt;group_id&gt; (private chat)"))
             return
-
-
-    # --- Ignore Label ---
-    if data == 'ignore_label':
-        bot.answer_callback_query(call.id, "")
+        target_id = str(chat_id)
+    
+    if not is_creator_member(target_id, user_id):
+        bot.reply_to(message, _(target_id, 'admin_only'))
         return
-        
-    # --- Menu Navigation (Point 2) ---
-    if action == 'menu':
-        menu_type = parts[2]
-        # In private chat context, need to pass group title for re-rendering the header
-        group_title = ""
-        if not str(chat_id).startswith('-'):
-            try:
-                group_title = bot.get_chat(target_id).title
-            except:
-                pass
-
-        send_menu(chat_id, user_id, menu_type, message_id=message_id, is_private=True, group_title=group_title, target_group_id=target_id)
-        bot.answer_callback_query(call.id)
+    
+    if command == 'import':
+        STATE[(chat_id, user_id)] = {'action': 'config_wait_for_file', 'target_id': target_id}
+        bot.send_message(chat_id, _(target_id, 'import_prompt'))
         return
+    
+    try:
+        send_config_export(user_id, target_id)
+        log_action(target_id, user_id, Action.CONFIG_EXPORT)
+        if message.chat.type != 'private':
+            bot.reply_to(message, _(target_id, 'export_sent_private'))
+    except Exception as e:
+        logging.warning(f"Export of {target_id} failed: {e}")
+        bot.reply_to(message, _(target_id, 'error_occurred'))
 
-    # --- Language Toggle (Point 3, 15) ---
-    elif action == 'lang':
-        old_lang = get_settings(target_id).get('lang', 'hi')
-        new_lang = 'en' if old_lang == 'hi' else 'hi'
-        set_setting(target_id, 'lang', new_lang)
-        
-        # Log language change
-        log_action(target_id, user_id, f"lang_change:{new_lang}")
-        
-        # Re-render the menu instantly
-        send_menu(chat_id, user_id, 'main', message_id=message_id, target_group_id=target_id)
-        bot.answer_callback_query(call.id, _(target_id, 'lang_changed'))
+@bot.message_handler(commands=['template'])
+def handle_template_command(message):
+    """
+    /template save <name> [group_id] | apply <name> <group_id ...|all> | list | delete <name>
+    Templates belong to the user; saving and applying need creator rights on each group.
+    """
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    parts = message.text.split()
+    sub = parts[1].lower() if len(parts) > 1 else ''
+    name = parts[2] if len(parts) > 2 else ''
+    usage = "/template save &lt;name&gt; [group_id] | apply &lt;name&gt; &lt;group_id ...|all&gt; | list | delete &lt;name&gt;"
+    
+    if sub == 'list':
+        items = template_list(user_id)
+        lines = [f"• <code>{safe_html(t_name)}</code> ({safe_html(get_chat_title(source, source))})" for t_name, source, _at in items]
+        bot.reply_to(message, _(chat_id, 'template_list', items="\n".join(lines) or "-"))
         return
-
-    # --- Generic Toggle Handler (Point 1, 3, 16) ---
-    elif action == 'toggle':
-        # Data format: toggle:[target_id]:[key]:[new_value]
-        key = parts[2]
-        value = int(parts[3])
-        
-        setting_key = key
-        
-        # Check if it's a menu_json key (e.g., menu:xp_settings:xp_enabled)
-        if key.startswith('menu:'):
-            # Format: menu:submenu:setting_key
-            _, submenu, setting_key = key.split(':') 
-            menu_data = menu_get(target_id)
-            if submenu not in menu_data:
-                menu_data[submenu] = {}
-            menu_data[submenu][setting_key] = value
-            menu_set(target_id, menu_data)
-            menu_type = submenu # Use submenu to re-render the correct view
-        
-        # Check if it's a lock setting (e.g., lock_urls)
-        elif key.startswith('lock_'):
-            lock_key = key.replace('lock_', '')
-            locks_data = locks_get(target_id)
-            locks_data[lock_key] = value
-            locks_set(target_id, locks_data)
-            menu_type = 'locks' # Use 'locks' to re-render
-            
-        # Standard settings (e.g., welcome_enabled)
-        else:
-            set_setting(target_id, setting_key, value)
-            menu_type = 'settings' # Use 'settings' to re-render
-        
-        # Log the action (Point 17)
-        log_action(target_id, user_id, f"toggle:{key}:{value}")
-        
-        # Re-render the menu instantly
-        # If in private chat, target_id is the group.
-        group_title = ""
-        if not str(chat_id).startswith('-'):
-            try:
-                group_title = bot.get_chat(target_id).title
-            except:
-                pass
-                
-        send_menu(chat_id, user_id, menu_type, message_id=message_id, is_private=True, group_title=group_title, target_group_id=target_id)
-        bot.answer_callback_query(call.id, _(target_id, 'setting_updated'))
+    if not name or sub not in ('save', 'apply', 'delete'):
+        bot.reply_to(message, _(chat_id, 'usage', usage=usage))
         return
-
-    # --- XP Cooldown Change (Point 4) ---
-    elif action == 'xp':
-        sub_action = parts[2]
-        
-        if sub_action == 'cooldown':
-            change = int(parts[3])
-            
-            menu_data = menu_get(target_id)
-            xp_settings = menu_data.get('xp_settings', {})
-            current_cooldown = xp_settings.get('xp_cooldown', 60)
-            
-            new_cooldown = max(5, current_cooldown + change) # Minimum 5 seconds
-            
-            xp_settings['xp_cooldown'] = new_cooldown
-            menu_data['xp_settings'] = xp_settings
-            menu_set(target_id, menu_data)
-            
-            log_action(target_id, user_id, f"xp_cooldown:{new_cooldown}")
-            
-            # Re-render XP settings menu
-            send_menu(chat_id, user_id, 'xp_settings', message_id=message_id, target_group_id=target_id)
-            bot.answer_callback_query(call.id, _(target_id, 'setting_updated'))
+    
+    if sub == 'delete':
+        key = 'template_deleted' if template_delete(user_id, name) else 'template_not_found'
+        bot.reply_to(message, _(chat_id, key, name=safe_html(name)))
+        return
+    
+    if sub == 'save':
+        source_id = parts[3] if len(parts) > 3 else str(chat_id)
+        if not source_id.startswith('-') or not is_creator_member(source_id, user_id):
+            bot.reply_to(message, _(chat_id, 'admin_only'))
             return
+        template_save(user_id, name, source_id)
+        log_action(source_id, user_id, Action.TEMPLATE_SAVE, name)
+        bot.reply_to(message, _(chat_id, 'template_saved', name=safe_html(name)))
+        return
+    
+    # apply
+    config = template_get(user_id, name)
+    if config is None:
+        bot.reply_to(message, _(chat_id, 'template_not_found', name=safe_html(name)))
+        return
+    if len(parts) > 3 and parts[3].lower() == 'all':
+        # Managed groups come from the admin index (creator status already known)
+        targets = [str(group['id']) for group in get_user_managed_groups(user_id)]
+        skipped = []
+    else:
+        requested = parts[3:] if len(parts) > 3 else [str(chat_id)]
+        targets = filter_creator_chats([target for target in requested if target.startswith('-')], user_id)
+        skipped = [target for target in requested if target not in targets]
+    
+    count = apply_config_to_chats(config, targets) if targets else 0
+    log_actions_bulk([(target, user_id, Action.TEMPLATE_APPLY, name) for target in targets])
+    reply = _(chat_id, 'template_applied', name=safe_html(name), count=count)
+    if skipped:
+        reply += "\n" + _(chat_id, 'template_skipped', chats=safe_html(", ".join(skipped)))
+    bot.reply_to(message, reply)
+
+@bot.message_handler(commands=['stats'])
+def handle_stats_command(message):
+    "/stats [today|7d|30d] - group statistics for admins, served from the rollups"
+    chat_id = message.chat.id
+    if message.chat.type not in ['group', 'supergroup']:
+        bot.reply_to(message, "❌ यह कमांड सिर्फ़ ग्रुप्स में काम करता है।")
+        return
+    if not is_admin_member(chat_id, message.from_user.id):
+        bot.reply_to(message, _(chat_id, 'admin_only'))
+        return
+    parts = message.text.split()
+    period = parts[1] if len(parts) > 1 and parts[1] in STATS_PERIODS else 'today'
+    bot.reply_to(message, render_group_stats(chat_id, chat_id, period), parse_mode="HTML")
 
-        elif sub_action == 'leaderboard' or sub_action == 'my_rank':
-            # Basic implementation for now (Point 4 - functional)
-            
-            if sub_action == 'my_rank':
-                # Get rank and XP for the user who clicked the button (user_id)
-                rank, xp = get_rank(target_id, user_id)
-                user_info = bot.get_chat_member(target_id, user_id).user
-                name = get_user_display_name(user_info)
-                
-                response_text = _(target_id, 'rank_display', name=safe_html(name), rank=rank, xp=xp)
-                bot.answer_callback_query(call.id, response_text, show_alert=True)
-                return
-            
-            elif sub_action == 'leaderboard':
-                # Fetch leaderboard
-                conn = db()
-                c = conn.cursor()
-                c.execute("SELECT user_id, points FROM xp WHERE chat_id=? ORDER BY points DESC LIMIT 10", 
-                          (target_id,))
-                leaderboard = c.fetchall()
-                conn.close()
-                
-                # Build leaderboard message
-                lb_text = "🏆 <b>Top 10 Leaderboard</b> 🏆\n\n"
-                for i, row in enumerate(leaderboard):
-                    try:
-                        member = bot.get_chat_member(target_id, row['user_id'])
-                        name = get_user_display_name(member.user)
-                    except:
-                        name = f"User {row['user_id']}"
-                        
-                    lb_text += f"#{i+1}: {safe_html(name)} - {row['points']} XP\n"
-                    
-                if not leaderboard:
-                    lb_text += "No XP data yet."
-                    
-                bot.answer_callback_query(call.id, "Leaderboard fetched.", show_alert=False)
-                bot.send_message(chat_id, lb_text)
-                return
+@bot.message_handler(commands=list(MASS_ACTIONS))
+def handle_mass_moderation(message):
+    """
+    /massban | /massmute [1h] | /masskick | /massunban  <ids ...> | joined <minutes>
+    or as a reply to a message / .txt / .csv file with user ids. Runs in the background.
+    """
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    parts = message.text.split()
+    action = MASS_ACTIONS[parts[0].lstrip('/').split('@')[0].lower()]
+    
+    if message.chat.type not in ['group', 'supergroup']:
+        bot.reply_to(message, "❌ यह कमांड सिर्फ़ ग्रुप्स में काम करता है।")
+        return
+    if not is_admin_member(chat_id, user_id):
+        bot.reply_to(message, _(chat_id, 'admin_only'))
+        return
+    if not check_bot_permissions(chat_id).get('can_restrict'):
+        bot.reply_to(message, _(chat_id, 'admin_only') + " (Bot needs 'restrict members' permission)")
+        notify_missing_permission(chat_id, "restrict/ban members")
+        return
+    
+    args = parts[1:]
+    duration_sec, duration_str = 3600, '1h'
+    if action == 'mute' and args:
+        parsed = parse_duration(args[0], None)
+        if parsed:
+            (duration_sec, duration_str), args = parsed, args[1:]
+    try:
+        targets = parse_mass_targets(chat_id, message, args)
+        # Never touch admins, the bot or the caller (one API call for the whole list)
+        API_LIMITER.acquire()
+        protected = {admin.user.id for admin in bot.get_chat_administrators(chat_id)}
+    except Exception as e:
+        logging.warning(f"Mass {action} setup failed in {chat_id}: {e}")
+        bot.reply_to(message, _(chat_id, 'error_occurred'))
+        return
+    if not targets:
+        usage = f"/mass{action} &lt;user_id ...&gt; | joined &lt;minutes&gt; (या ids वाले मैसेज/फ़ाइल को reply)"
+        bot.reply_to(message, _(chat_id, 'mass_no_targets') + "\n" + _(chat_id, 'usage', usage=usage), parse_mode="HTML")
+        return
+    if len(targets) > MASS_MOD_MAX_TARGETS:
+        bot.reply_to(message, _(chat_id, 'mass_too_many', max=MASS_MOD_MAX_TARGETS))
+        return
+    protected |= {get_bot_info().id, user_id}
+    user_ids = [uid for uid in targets if uid not in protected]
+    
+    job = {'action': action, 'started_at': now_ts()}
+    if not mass_jobs.compute(chat_id, lambda current: (current, False) if current else (job, True)):
+        bot.reply_to(message, _(chat_id, 'mass_busy'))
+        return
+    try:
+        label = f"/mass{action}" + (f" {duration_str}" if action == 'mute' else "")
+        status = bot.reply_to(message, _(chat_id, 'mass_progress', action=label, done=0, total=len(user_ids), ok=0, failed=0),
+                              parse_mode="HTML")
+    except Exception:
+        mass_jobs.pop(chat_id, None)
+        raise
+    Thread(target=run_mass_moderation, daemon=True,
+           args=(chat_id, user_id, action, user_ids, duration_sec, status.message_id, len(targets) - len(user_ids))).start()
+
+@bot.message_handler(commands=['links'])
+def handle_links_command(message):
+    """
+    /links [allow|deny|remove <domain ...>] - link policy of the URL lock (admins).
+    Subdomains follow their domain; the most specific rule wins. Deny rules apply even with the lock off.
+    """
+    chat_id = message.chat.id
+    if message.chat.type not in ['group', 'supergroup']:
+        bot.reply_to(message, "❌ यह कमांड सिर्फ़ ग्रुप्स में काम करता है।")
+        return
+    if not is_admin_member(chat_id, message.from_user.id):
+        bot.reply_to(message, _(chat_id, 'admin_only'))
+        return
+    
+    parts = message.text.split()
+    sub = parts[1].lower() if len(parts) > 1 else 'list'
+    domains = [host for host in (url_host(arg.lstrip('*.')) for arg in parts[2:]) if host]
+    if sub not in ('list', 'allow', 'deny', 'remove') or (sub != 'list' and not domains):
+        bot.reply_to(message, _(chat_id, 'usage', usage="/links [allow|deny|remove &lt;domain ...&gt;]"), parse_mode="HTML")
+        return
+    
+    locks = locks_get(chat_id)
+    allow, deny = list(locks.get('url_allow') or []), list(locks.get('url_deny') or [])
+    if sub != 'list':
+        allow = [domain for domain in allow if domain not in domains]
+        deny = [domain for domain in deny if domain not in domains]
+        if sub == 'allow':
+            allow += domains
+        elif sub == 'deny':
+            deny += domains
+        if max(len(allow), len(deny)) > LINK_RULES_MAX:
+            bot.reply_to(message, _(chat_id, 'links_too_many', max=LINK_RULES_MAX))
+            return
+        # Logged like a toggle: the changed lock key as arg, its rule count as value
+        changed = [(key, rules) for key, rules in (('url_allow', allow), ('url_deny', deny))
+                   if rules != list(locks.get(key) or [])]
+        locks['url_allow'], locks['url_deny'] = allow, deny
+        locks_set(chat_id, locks)
+        log_actions_bulk([(chat_id, message.from_user.id, Action.TOGGLE, key, len(rules)) for key, rules in changed])
+    
+    state = _(chat_id, 'enabled') if locks.get('urls') else _(chat_id, 'disabled')
+    bot.reply_to(message, _(chat_id, 'links_policy', state=state, allow=safe_html(", ".join(allow)) or "-",
+                            deny=safe_html(", ".join(deny)) or "-"), parse_mode="HTML")
 
-    # --- Other Modules (Notes, Triggers, Blacklist, Polls) - Basic Wiring ---
-    # These will initiate multi-step STATE flow or list functions (Point 3, 5, 6, 7, 8)
-    elif action in ['note', 'trigger', 'blacklist', 'poll']:
-        sub_action = parts[2]
-        
-        # Example: Initiating 'add' flow (which requires state handling)
-        if sub_action == 'add' or sub_action == 'create':
-            # Set state for the next user message to be captured
-            STATE[(chat_id, user_id)] = {'action': f'{action}_wait_for_key', 'target_id': target_id}
-            
-            if action == 'note':
-                prompt = _(target_id, 'usage', usage="Note key और content भेजें, जैसे: <code>!rules The group rules are...</code>")
-            elif action == 'trigger':
-                prompt = _(target_id, 'usage', usage="Trigger pattern और reply भेजें, जैसे: <code>!hello Hi there!</code>")
-            elif action == 'blacklist':
-                prompt = _(target_id, 'usage', usage="ब्लैकलिस्ट करने के लिए शब्द भेजें। एक समय में एक शब्द।")
-            elif action == 'poll':
-                prompt = _(target_id, 'usage', usage="Poll का प्रश्न और विकल्पों को नई लाइन में भेजें। \nउदाहरण: \n<code>Favourite colour?\nRed\nBlue\nGreen</code>")
-            else:
-                prompt = _(target_id, 'invalid_input')
-                
-            bot.send_message(chat_id, prompt)
-            bot.answer_callback_query(call.id, f"Waiting for {action} input...")
+@bot.message_handler(commands=['fed'])
+def handle_fed_command(message):
+    """
+    /fed new <name> | join <fed_id> | leave | info | promote <user_id> | demote <user_id>
+    A group is in at most one federation; join/leave need creator rights, promote/demote the federation owner.
+    """
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    parts = message.text.split()
+    sub = parts[1].lower() if len(parts) > 1 else ''
+    arg = parts[2] if len(parts) > 2 else ''
+    usage = "/fed new &lt;name&gt; | join &lt;fed_id&gt; | leave | info | promote &lt;user_id&gt; | demote &lt;user_id&gt;"
+    
+    if sub == 'new' and arg:
+        name = " ".join(parts[2:])[:64]
+        fed_id = fed_create(user_id, name)
+        bot.reply_to(message, _(chat_id, 'fed_created', name=safe_html(name), fed_id=fed_id), parse_mode="HTML")
+        return
+    if sub not in ('join', 'leave', 'info', 'promote', 'demote'):
+        bot.reply_to(message, _(chat_id, 'usage', usage=usage), parse_mode="HTML")
+        return
+    if message.chat.type not in ['group', 'supergroup']:
+        bot.reply_to(message, "❌ यह कमांड सिर्फ़ ग्रुप्स में काम करता है।")
+        return
+    
+    if sub in ('join', 'leave'):
+        if not is_creator_member(chat_id, user_id):
+            bot.reply_to(message, _(chat_id, 'admin_only'))
             return
-            
-        # Example: Listing flow (requires fetching data)
-        elif sub_action == 'list' or sub_action == 'active':
-            # Placeholder for listing logic (to be expanded in subsequent parts)
-            list_text = f"📋 {action.capitalize()} List (WIP)\n"
-            
-            conn = db()
-            c = conn.cursor()
-            
-            if action == 'note':
-                c.execute("SELECT key, content FROM notes WHERE chat_id=?", (target_id,))
-                for row in c.fetchall():
-                    list_text += f"<b>{safe_html(row['key'])}</b>: {safe_html(row['content'][:30])}...\n"
-                
-            elif action == 'trigger':
-                c.execute("SELECT pattern, reply FROM triggers WHERE chat_id=?", (target_id,))
-                for row in c.fetchall():
-                    list_text += f"<b>{safe_html(row['pattern'])}</b>: {safe_html(row['reply'][:30])}...\n"
-            
-            elif action == 'blacklist':
-                c.execute("SELECT word FROM blacklist WHERE chat_id=?", (target_id,))
-                words = [row['word'] for row in c.fetchall()]
-                list_text += ", ".join(words)
-            
-            elif action == 'poll':
-                c.execute("SELECT id, question FROM polls WHERE chat_id=? AND open=1", (target_id,))
-                for row in c.fetchall():
-                    list_text += f"<b>ID {row['id']}</b>: {safe_html(row['question'][:50])}...\n"
-                
-            conn.close()
-            
-            bot.send_message(chat_id, list_text)
-            bot.answer_callback_query(call.id, f"Listing {action}s...")
+        if sub == 'leave':
+            fed_subscribe(chat_id, None)
+            bot.reply_to(message, _(chat_id, 'fed_left'))
+            return
+        fed = fed_get(arg)
+        if not fed:
+            bot.reply_to(message, _(chat_id, 'fed_not_found'))
             return
+        fed_subscribe(chat_id, fed['fed_id'])
+        bot.reply_to(message, _(chat_id, 'fed_joined', name=safe_html(fed['name']), bans=len(FED_BANS.get(fed['fed_id'], ()))),
+                     parse_mode="HTML")
+        return
+    
+    fed = fed_get(fed_of_chat(chat_id) or '')
+    if not fed:
+        bot.reply_to(message, _(chat_id, 'fed_none'))
+        return
+    if sub == 'info':
+        bot.reply_to(message, _(chat_id, 'fed_info', name=safe_html(fed['name']), fed_id=fed['fed_id'],
+                                chats=len(fed_chats(fed['fed_id'])), bans=len(FED_BANS.get(fed['fed_id'], ()))),
+                     parse_mode="HTML")
+        return
+    
+    # promote / demote
+    if user_id != fed['owner_id']:
+        bot.reply_to(message, _(chat_id, 'fed_not_admin'))
+        return
+    target_id = message.reply_to_message.from_user.id if message.reply_to_message else (int(arg) if arg.isdigit() else None)
+    if not target_id:
+        bot.reply_to(message, _(chat_id, 'usage', usage=usage), parse_mode="HTML")
+        return
+    admins = set(fed['admins'])
+    if sub == 'promote':
+        admins.add(target_id)
+    else:
+        admins.discard(target_id)
+    fed_set_admins(fed['fed_id'], admins)
+    bot.reply_to(message, _(chat_id, 'fed_admins_updated', admins=", ".join(map(str, sorted(admins))) or "-"))
 
-    # --- Fallback for Unknown Action (Point 17) ---
+@bot.message_handler(commands=['fban', 'funban'])
+def handle_fed_ban_command(message):
+    "/fban <user_id> [reason] | /funban <user_id> - or as a reply; federation owner/admins only"
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    parts = message.text.split()
+    command = parts[0].lstrip('/').split('@')[0].lower()
+    
+    fed = fed_get(fed_of_chat(chat_id) or '')
+    if not fed:
+        bot.reply_to(message, _(chat_id, 'fed_none'))
+        return
+    if not fed_can_manage(fed, user_id):
+        bot.reply_to(message, _(chat_id, 'fed_not_admin'))
+        return
+    
+    if message.reply_to_message:
+        target_user = message.reply_to_message.from_user
+        target_id, reason_parts = target_user.id, parts[1:]
+        mention = get_user_mention(target_user)
+    elif len(parts) > 1 and parts[1].isdigit():
+        target_id, reason_parts = int(parts[1]), parts[2:]
+        mention = f'<a href="tg://user?id={target_id}">{target_id}</a>'
     else:
-        logging.warning(f"Unknown callback action: {data}")
-        bot.answer_callback_query(call.id, _(target_id, 'unknown_action'), show_alert=True)
-        # Re-render main menu as a safe fallback
-        send_menu(chat_id, user_id, 'main', message_id=message_id, target_group_id=target_id)
+        bot.reply_to(message, _(chat_id, 'usage', usage=f"/{command} &lt;user_id&gt; [reason] (या reply)"), parse_mode="HTML")
         return
+    if target_id == user_id or target_id == fed['owner_id'] or target_id == get_bot_info().id:
+        bot.reply_to(message, "❌ आप खुद को, owner या bot को ban नहीं कर सकते।")
+        return
+    
+    if command == 'fban':
+        admin_chats = fed_admin_chats(fed['fed_id'], target_id)
+        if admin_chats:
+            bot.reply_to(message, _(chat_id, 'fed_target_admin', chats=len(admin_chats)))
+            return
+        fed_ban(fed['fed_id'], target_id, user_id, " ".join(reason_parts)[:200])
+        bot.reply_to(message, _(chat_id, 'fed_banned', user=mention, name=safe_html(fed['name']),
+                                chats=len(fed_chats(fed['fed_id']))), parse_mode="HTML")
+    elif fed_unban(fed['fed_id'], target_id):
+        bot.reply_to(message, _(chat_id, 'fed_unbanned', user=mention), parse_mode="HTML")
+    else:
+        bot.reply_to(message, _(chat_id, 'fed_not_banned'))
 
 # ---------- Message Handler (Text & All Content) ----------
 @bot.message_handler(func=lambda message: message.chat.type in ['group', 'supergroup'] and message.text)
@@ -1697,49 +4605,71 @@ def handle_group_messages(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     text = message.text
+    touch_chat_activity(chat_id)
+    stats_incr(chat_id, 'message', message.from_user)
+    
+    # Federation ban (in-memory set lookup)
+    if enforce_fed_ban(chat_id, user_id):
+        try:
+            bot.delete_message(chat_id, message.message_id)
+        except Exception:
+            pass
+        return
     
     # Ignore commands (handled elsewhere)
     if text.startswith('/') and len(text.split()) > 0 and text.split()[0][1:] in ['start', 'menu', 'warn', 'mute', 'ban', 'kick', 'undo', 'rank', 'leaderboard']:
         return
         
-    # 1. Captcha Check (If user is pending)
-    if (chat_id, user_id) in pending_captcha:
-        if verify_captcha(chat_id, user_id, text):
+    # 1. Captcha Check (If user is pending) - single atomic lookup
+    captcha_status, captcha_entry = verify_captcha(chat_id, user_id, text)
+    if captcha_status is not None:
+        if captcha_status:
             # Captcha success
             unrestrict_user(chat_id, user_id)
             name = get_user_mention(message.from_user)
             bot.reply_to(message, _(chat_id, 'captcha_success', name=name))
-            log_action(chat_id, user_id, "captcha_passed")
+            log_action(chat_id, user_id, Action.CAPTCHA_PASSED)
         else:
             # Captcha failure
-            # Delete message and re-ask
+            # Delete message and re-ask (kick after CAPTCHA_MAX_ATTEMPTS)
             try:
                 bot.delete_message(chat_id, message.message_id)
             except:
                 pass
             
-            q1, q2 = pending_captcha[(chat_id, user_id)]['q1'], pending_captcha[(chat_id, user_id)]['q2']
-            bot.send_message(chat_id, _(chat_id, 'captcha_failed') + " " + _(chat_id, 'captcha_verify', q1=q1, q2=q2))
-            log_action(chat_id, user_id, "captcha_failed")
+            log_action(chat_id, user_id, Action.CAPTCHA_FAILED)
+            if captcha_entry['attempts'] >= CAPTCHA_MAX_ATTEMPTS:
+                kick_failed_captcha(chat_id, message.from_user)
+            else:
+                q1, q2 = captcha_entry['q1'], captcha_entry['q2']
+                bot.send_message(chat_id, _(chat_id, 'captcha_failed') + " " + _(chat_id, 'captcha_verify', q1=q1, q2=q2))
         return
         
     # 2. Command Permissions Check (if user sends non-standard commands)
     # The default command handlers will do the check, but this ensures a fallback message
     # for custom commands (not fully implemented here, but preserved logic)
     
+    # Feature bitmap: skip stages that cannot fire for this chat
+    features = chat_features(chat_id)
+    record_fast_path(not (features & (FEAT_BLACKLIST | FEAT_LOCK_URLS | FEAT_TRIGGERS | FEAT_DUPES)))
+    
     # 3. Flood Check
-    is_flood, count, limit = check_flood(chat_id, user_id)
-    if is_flood:
-        bot.delete_message(chat_id, message.message_id)
-        bot.send_message(chat_id, _(chat_id, 'flood_detected', count=count, limit=limit))
-        mute_user(chat_id, user_id, 300) # Mute for 5 minutes
-        log_action(chat_id, user_id, "auto_mute:flood")
+    if features & FEAT_FLOOD:
+        is_flood, count, limit = check_flood(chat_id, user_id)
+        if is_flood:
+            bot.delete_message(chat_id, message.message_id)
+            bot.send_message(chat_id, _(chat_id, 'flood_detected', count=count, limit=limit))
+            mute_user(chat_id, user_id, 300) # Mute for 5 minutes
+            log_action(chat_id, user_id, Action.AUTO_MUTE, "flood")
+            return
+    
+    # 3b. Duplicate content (same normalized text from any user / group)
+    if features & FEAT_DUPES and handle_duplicate(chat_id, message):
         return
         
-    # 4. Blacklist Check (settings must be enabled)
-    settings = get_settings(chat_id)
-    if settings.get('blacklist_enabled'):
-        found, word, _ = check_blacklist(chat_id, text)
+    # 4. Blacklist Check (enabled and at least one word configured)
+    if features & FEAT_BLACKLIST:
+        found, word, _count = check_blacklist(chat_id, message_canonical(message))
         if found:
             bot.delete_message(chat_id, message.message_id)
             count, is_banned = add_blacklist_violation(chat_id, user_id)
@@ -1754,59 +4684,92 @@ def handle_group_messages(message):
             return
             
     # 5. Lock Check (for text-based locks like URLs)
-    violations = check_locks(chat_id, message)
-    if 'urls' in violations:
-        bot.delete_message(chat_id, message.message_id)
-        bot.send_message(chat_id, f"❌ {_(chat_id, 'lock_urls')} {_(chat_id, 'disabled')}")
-        return
+    if features & FEAT_LOCK_URLS:
+        violations = check_locks(chat_id, message)
+        if 'urls' in violations:
+            bot.delete_message(chat_id, message.message_id)
+            bot.send_message(chat_id, f"❌ {_(chat_id, 'lock_urls')} {_(chat_id, 'disabled')}")
+            return
 
     # 6. XP Gain (If enabled and not on cooldown)
-    if add_xp(chat_id, user_id, 1):
+    if features & FEAT_XP and add_xp(chat_id, user_id, 1):
         # Notify user of XP gain (optional, but requested in past logic)
         # bot.send_message(chat_id, _(chat_id, 'xp_gained', points=1), reply_to_message_id=message.message_id)
         pass
         
-    # 7. Trigger Check (Basic logic preserved)
-    conn = db()
-    c = conn.cursor()
-    c.execute("SELECT reply, is_regex FROM triggers WHERE chat_id=?", (str(chat_id),))
-    triggers = c.fetchall()
-    conn.close()
+    # 7. Trigger Check (cached trigger list)
+    if not features & FEAT_TRIGGERS:
+        return
     
-    for row in triggers:
+    deadline = time.monotonic() + REGEX_MESSAGE_BUDGET  # Shared by all regex triggers of this message
+    for row in get_chat_config(chat_id)['triggers']:
         pattern = row['pattern']
         reply = row['reply']
         is_regex = row['is_regex']
         
         match = False
         if is_regex:
-            try:
-                if re.search(pattern, text, re.IGNORECASE):
-                    match = True
-            except re.error:
-                # Log bad regex
-                pass 
-        elif text.lower().startswith(pattern.lower()):
+            match = regex_trigger_match(chat_id, row, text, deadline)
+        elif message_canonical(message).startswith(row['canonical']):
             match = True
             
         if match:
             bot.send_message(chat_id, reply)
-            log_action(chat_id, user_id, f"trigger_match:{pattern}")
+            log_action(chat_id, user_id, Action.TRIGGER_MATCH, pattern)
             return
 
 
 # ---------- Message Handler (All Content - for Locks/Forwards) ----------
-@bot.message_handler(content_types=['photo', 'video', 'sticker', 'document', 'forward', 'audio', 'voice', 'video_note', 'new_chat_members', 'left_chat_member', 'location', 'contact', 'animation', 'poll', 'game', 'dice'])
+# --- Bulk import: document sent in private after the Import button or /import ---
+@bot.message_handler(content_types=['document'], func=lambda message: message.chat.type == 'private')
+def handle_private_documents(message):
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    state_key = (chat_id, user_id)
+    state_data = STATE.get(state_key)
+    if not state_data or not state_data['action'].endswith('_wait_for_file'):
+        return
+    STATE.pop(state_key, None)
+    module = state_data['action'].split('_')[0] # 'note', 'trigger', 'blacklist' or 'config'
+    target_id = state_data['target_id']
+    
+    document = message.document
+    if (document.file_size or 0) > IMPORT_MAX_BYTES:
+        bot.send_message(chat_id, _(target_id, 'import_too_large', size=IMPORT_MAX_BYTES // 1024))
+        return
+    try:
+        file_info = bot.get_file(document.file_id)
+        data = bot.download_file(file_info.file_path)
+        counts = import_config_file(target_id, module, document.file_name, data)
+    except Exception as e:
+        logging.warning(f"Import into {target_id} failed: {e}")
+        bot.send_message(chat_id, _(target_id, 'import_failed', error=safe_html(e)))
+        return
+    
+    summary = ", ".join(f"{name}: {count}" for name, count in counts.items() if count)
+    log_action(target_id, user_id, Action.CONFIG_IMPORT, summary, sum(counts.values()))
+    bot.send_message(chat_id, _(target_id, 'import_done', summary=summary or '0'))
+
+@bot.message_handler(content_types=['photo', 'video', 'sticker', 'document', 'forward', 'audio', 'voice', 'video_note', 'location', 'contact', 'animation', 'poll', 'game', 'dice'])
 def handle_all_content(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
+    if message.chat.type in ['group', 'supergroup']:
+        touch_chat_activity(chat_id)
+        stats_incr(chat_id, 'message', message.from_user)
+        if enforce_fed_ban(chat_id, user_id):
+            try:
+                bot.delete_message(chat_id, message.message_id)
+            except Exception:
+                pass
+            return
     
-    # Ignore new/left members events for lock check
-    if message.content_type in ['new_chat_members', 'left_chat_member']:
+    # 1. Lock Check (for media/forwards) - skipped when the chat has no locks on
+    features = chat_features(chat_id)
+    record_fast_path(not (features & (FEAT_LOCK_MEDIA | FEAT_LOCK_URLS | FEAT_DUPES)))
+    if features & FEAT_DUPES and message.chat.type in ['group', 'supergroup'] and handle_duplicate(chat_id, message):
         return
-        
-    # 1. Lock Check (for media/forwards)
-    violations = check_locks(chat_id, message)
+    violations = check_locks(chat_id, message) if features & (FEAT_LOCK_MEDIA | FEAT_LOCK_URLS) else []
     
     if violations:
         # Delete message and notify (Point 14)
@@ -1822,7 +4785,7 @@ def handle_all_content(message):
                 f"❌ {_(chat_id, violation_key)} {_(chat_id, 'disabled')}",
                 parse_mode="HTML"
             )
-            log_action(chat_id, user_id, f"lock_violation:{violations[0]}")
+            log_action(chat_id, user_id, Action.LOCK_VIOLATION, violations[0])
             
         except telebot.apihelper.ApiTelegramException as e:
             # Bot might not have permission to delete
@@ -1835,7 +4798,7 @@ def handle_all_content(message):
         return
         
     # 2. XP Gain for all content types
-    if add_xp(chat_id, user_id, 1):
+    if features & FEAT_XP and add_xp(chat_id, user_id, 1):
         # XP gained
         pass
 
@@ -1844,11 +4807,23 @@ def handle_all_content(message):
 @bot.message_handler(content_types=['new_chat_members'])
 def handle_new_members(message):
     chat_id = message.chat.id
+    touch_chat_activity(chat_id)
     settings = get_settings(chat_id)
     
     for user in message.new_chat_members:
         if user.is_bot:
             continue
+        stats_incr(chat_id, 'join')
+        if enforce_fed_ban(chat_id, user.id, joined=True):
+            continue
+        
+        # Raid mode: queue the join for the next batched flush instead of handling it inline
+        if register_join(chat_id):
+            queue_raid_join(chat_id, user)
+            continue
+        
+        # Atomically check-and-record the user in the rejoin tracker
+        seen_before = remember_member(chat_id, user.id)
             
         # 1. Welcome Message
         if settings.get('welcome_enabled', 1):
@@ -1856,29 +4831,31 @@ def handle_new_members(message):
             welcome_text = _(chat_id, 'welcome_message', name=name)
             
             # 2. CAPTCHA Check (simple check for now, can be extended)
-            if user.id not in rejoin_tracker[chat_id]: # Simple check to avoid captcha on re-join
+            if not seen_before: # Simple check to avoid captcha on re-join
                 # Restrict user
                 restrict_new_user(chat_id, user.id)
                 
-                # Create captcha
-                q1, q2 = create_captcha(chat_id, user.id)
-                captcha_text = _(chat_id, 'captcha_verify', q1=q1, q2=q2)
-                
-                # Send combined message
-                bot.send_message(
-                    chat_id, 
-                    f"{welcome_text}\n\n{captcha_text}", 
-                    parse_mode="HTML"
-                )
-                log_action(chat_id, user.id, "welcome_captcha")
+                if captcha_mode(chat_id) == 'button':
+                    # Signed buttons verify the answer; the pending entry holds the question and attempts
+                    send_button_captcha(chat_id, user.id, welcome_text, create_captcha(chat_id, user.id))
+                else:
+                    # Create captcha
+                    q1, q2 = create_captcha(chat_id, user.id)
+                    captcha_text = _(chat_id, 'captcha_verify', q1=q1, q2=q2)
+                    
+                    # Send combined message
+                    bot.send_message(
+                        chat_id, 
+                        f"{welcome_text}\n\n{captcha_text}", 
+                        parse_mode="HTML"
+                    )
+                log_action(chat_id, user.id, Action.WELCOME_CAPTCHA)
             else:
                 # No captcha for assumed rejoiner
                 bot.send_message(chat_id, welcome_text, parse_mode="HTML")
                 unrestrict_user(chat_id, user.id) # Ensure they are unrestricted
-                log_action(chat_id, user.id, "welcome_rejoin")
+                log_action(chat_id, user.id, Action.WELCOME_REJOIN)
             
-        # Add user to rejoin tracker
-        rejoin_tracker[chat_id].add(user.id)
             
 @bot.message_handler(content_types=['left_chat_member'])
 def handle_left_members(message):
@@ -1888,18 +4865,62 @@ def handle_left_members(message):
     
     if user.is_bot:
         return
+    stats_incr(chat_id, 'left')
         
     # 1. Goodbye Message
     if settings.get('leave_enabled', 1):
         name = get_user_mention(user)
         goodbye_text = _(chat_id, 'goodbye_message', name=name)
         bot.send_message(chat_id, goodbye_text, parse_mode="HTML")
-        log_action(chat_id, user.id, "leave")
+        log_action(chat_id, user.id, Action.LEAVE)
         
     # Remove from pending captcha
-    if (chat_id, user.id) in pending_captcha:
-        del pending_captcha[(chat_id, user.id)]
-        
+    pending_captcha.pop((chat_id, user.id), None)
+
+# ---------- Chat Metadata Refresh (my_chat_member & service messages) ----------
+@bot.my_chat_member_handler()
+def handle_my_chat_member(update):
+    "Refresh cached chat metadata and bot permissions when the bot's status changes"
+    chat = update.chat
+    member = update.new_chat_member
+
+    if member.status in ['left', 'kicked']:
+        chat_track(chat.id, status=member.status, chat=chat)
+        invalidate_chat_cache(chat.id)
+        admin_index_drop_chat(chat.id)
+        return
+
+    permissions = _bot_permissions_from_member(member)
+    chat_track(chat.id, status=member.status, chat=chat, permissions=permissions)
+    update_chat_cache(
+        chat.id,
+        title=chat.title, type=chat.type, fetched_at=now_ts(),
+        permissions=permissions, perms_at=now_ts()
+    )
+
+@bot.chat_member_handler()
+def handle_chat_member(update):
+    "Maintain the managed-groups index from member status changes"
+    member = update.new_chat_member
+    if member.user.is_bot:
+        return
+    set_member_status(update.chat.id, member.user.id, member.status)
+    admin_index_set(update.chat.id, member.user.id, member.status)
+    if member.status == 'member':
+        enforce_fed_ban(update.chat.id, member.user.id, joined=True)
+
+@bot.message_handler(content_types=['new_chat_title', 'migrate_to_chat_id'])
+def handle_chat_service_updates(message):
+    "Keep cached chat title in sync with service messages"
+    if message.content_type == 'new_chat_title':
+        update_chat_cache(message.chat.id, title=message.new_chat_title, type=message.chat.type, fetched_at=now_ts())
+        chat_track(message.chat.id, chat=message.chat)
+    else:
+        # Group upgraded to supergroup: the old id is dead from now on
+        invalidate_chat_cache(message.chat.id)
+        chat_track(message.chat.id, status='migrated')
+        chat_track(message.migrate_to_chat_id, status='member')
+
 # ---------- Moderation Commands (Point 9, 14) ----------
 # All mod commands require a reply to a message and admin status
 @bot.message_handler(commands=['warn', 'mute', 'ban', 'kick', 'undo'])
@@ -1963,26 +4984,8 @@ def handle_moderation_commands(message):
              return
              
         # Extract duration: /mute 1h, /mute 30m etc. (default 1h)
-        duration_sec = 3600
-        duration_str = '1h'
-        try:
-            parts = message.text.split()
-            if len(parts) > 1:
-                match = re.match(r"(\d+)([mhd])", parts[1].lower())
-                if match:
-                    value, unit = match.groups()
-                    value = int(value)
-                    if unit == 'm':
-                        duration_sec = value * 60
-                        duration_str = f"{value}m"
-                    elif unit == 'h':
-                        duration_sec = value * 3600
-                        duration_str = f"{value}h"
-                    elif unit == 'd':
-                        duration_sec = value * 86400
-                        duration_str = f"{value}d"
-        except:
-            pass # Use default
+        parts = message.text.split()
+        duration_sec, duration_str = parse_duration(parts[1] if len(parts) > 1 else '')
             
         if mute_user(chat_id, target_id, duration_sec):
             bot.reply_to(message, _(chat_id, 'user_muted', user=user_mention, duration=duration_str))
@@ -2030,8 +5033,8 @@ def handle_private_messages(message):
     
     # Check if user is in a multi-step state
     state_key = (chat_id, user_id)
-    if state_key in STATE:
-        state_data = STATE[state_key]
+    state_data = STATE.get(state_key)
+    if state_data:
         action = state_data['action']
         target_id = state_data['target_id']
         text = message.text
@@ -2064,11 +5067,22 @@ def handle_private_messages(message):
                     c.execute("INSERT INTO blacklist (chat_id, word) VALUES (?,?)", (target_id, word))
                     conn.commit()
                     conn.close()
+                    invalidate_chat_config(target_id)
                     
                     bot.send_message(chat_id, _(target_id, 'note_added', key=word)) # Reusing note_added for confirmation
-                    log_action(target_id, user_id, f"blacklist_add:{word}")
+                    log_action(target_id, user_id, Action.BLACKLIST_ADD, word)
                     
                 else: # note or trigger
+                    # "re:<pattern>" makes a regex trigger; validated (once) before the state moves on,
+                    # so a rejected pattern leaves the flow waiting for a corrected one
+                    is_regex = 0
+                    if module == 'trigger' and key.startswith('re:'):
+                        key, is_regex = key[3:], 1
+                        error = validate_regex(key)
+                        if error:
+                            bot.send_message(chat_id, _(target_id, 'regex_invalid', error=safe_html(error)), parse_mode="HTML")
+                            return
+                    
                     # Save key and ask for content
                     STATE[state_key] = {'action': f'{module}_wait_for_content', 'target_id': target_id, 'key': key, 'content': content}
                     
@@ -2081,21 +5095,22 @@ def handle_private_messages(message):
                         conn.close()
                         
                         bot.send_message(chat_id, _(target_id, 'note_added', key=key))
-                        log_action(target_id, user_id, f"note_add:{key}")
+                        log_action(target_id, user_id, Action.NOTE_ADD, key)
                         
                     elif module == 'trigger':
-                         # Trigger: content is reply
+                         # Trigger: content is reply (regex key validated above)
                         conn = db()
                         c = conn.cursor()
-                        c.execute("INSERT INTO triggers (chat_id, pattern, reply, is_regex) VALUES (?,?,?,?)", (target_id, key, content, 0)) # Default to non-regex
+                        c.execute("INSERT INTO triggers (chat_id, pattern, reply, is_regex) VALUES (?,?,?,?)", (target_id, key, content, is_regex))
                         conn.commit()
                         conn.close()
+                        invalidate_chat_config(target_id)
                         
                         bot.send_message(chat_id, _(target_id, 'trigger_added'))
-                        log_action(target_id, user_id, f"trigger_add:{key}")
+                        log_action(target_id, user_id, Action.TRIGGER_ADD, key)
                         
                 # Clear state after completion
-                del STATE[state_key] 
+                STATE.pop(state_key, None)
                 
             elif module == 'poll':
                 # Poll creation: Question + options, one per line
@@ -2125,9 +5140,17 @@ def handle_private_messages(message):
                 )
                 
                 bot.send_message(chat_id, _(target_id, 'poll_created'))
-                log_action(target_id, user_id, f"poll_create:{question}")
-                del STATE[state_key]
+                log_action(target_id, user_id, Action.POLL_CREATE, question)
+                STATE.pop(state_key, None)
                 
+        # List prefix search: show the first matching page
+        elif action.endswith('_wait_for_search'):
+            module = action.split('_')[0]
+            STATE.pop(state_key, None)
+            prefix = (text or '').strip()
+            if module == 'blacklist':
+                prefix = prefix.lower() # Blacklist words are stored lowercase
+            _show_list_menu(chat_id, None, user_id, module, target_id, prefix=prefix)
         
         # Fallback for unknown state (should not happen)
         else:
@@ -2147,12 +5170,12 @@ def _build_custom_poll_keyboard(poll_id, chat_id, options):
     # For simplicity, we just add the vote options
     for i, option in enumerate(options):
         # Callback format: poll:vote:poll_id:option_index
-        keyboard.add(types.InlineKeyboardButton(f"🗳️ {safe_html(option)}", callback_data=f"poll:vote:{poll_id}:{i}"))
+        keyboard.add(types.InlineKeyboardButton(f"🗳️ {safe_html(option)}", callback_data=cb_pack('poll', None, 'vote', poll_id, i)))
 
     # Add refresh/close buttons
     keyboard.add(
-        types.InlineKeyboardButton(_(chat_id_str, 'active_polls'), callback_data=f"poll:{chat_id_str}:active"),
-        types.InlineKeyboardButton("❌ Close Poll", callback_data=f"poll:close:{poll_id}")
+        types.InlineKeyboardButton(_(chat_id_str, 'active_polls'), callback_data=cb_pack('poll', chat_id_str, 'active')),
+        types.InlineKeyboardButton("❌ Close Poll", callback_data=cb_pack('poll', None, 'close', poll_id))
     )
     return keyboard
 
@@ -2178,12 +5201,12 @@ def _build_custom_poll_keyboard(poll_id, target_id, options_data):
         button_text = f"🗳️ {safe_html(option['text'])} ({count}) [{percentage:.0f}%]"
         
         # Callback format: poll:vote:poll_id:option_index
-        keyboard.add(types.InlineKeyboardButton(button_text, callback_data=f"poll:vote:{poll_id}:{i}"))
+        keyboard.add(types.InlineKeyboardButton(button_text, callback_data=cb_pack('poll', None, 'vote', poll_id, i)))
 
     # Add refresh/close buttons
     keyboard.add(
-        types.InlineKeyboardButton("🔄 Refresh / My Vote", callback_data=f"poll:vote:{poll_id}:-1"),
-        types.InlineKeyboardButton("❌ Close Poll", callback_data=f"poll:close:{poll_id}")
+        types.InlineKeyboardButton("🔄 Refresh / My Vote", callback_data=cb_pack('poll', None, 'vote', poll_id, '-1')),
+        types.InlineKeyboardButton("❌ Close Poll", callback_data=cb_pack('poll', None, 'close', poll_id))
     )
     return keyboard
 
@@ -2220,25 +5243,19 @@ def update_poll_options(poll_id, options_data):
     conn.commit()
     conn.close()
     
-# --- Extend callback_inline for Poll Voting/Closing (Point 7) ---
-# NOTE: To fit within the continuous code structure, this function assumes the main 
-# callback_inline handler in Part 2 is modified to delegate poll actions here.
-@bot.callback_query_handler(func=lambda call: call.data.startswith('poll:vote:') or call.data.startswith('poll:close:'))
-def handle_poll_callbacks(call):
-    chat_id = call.message.chat.id
-    user_id = call.from_user.id
-    message_id = call.message.message_id
-    data = call.data
-    parts = data.split(':')
-    action = parts[1] # 'vote' or 'close'
-    poll_id = int(parts[2])
+# --- Poll Voting/Closing routes (Point 7) ---
+# Format: poll:vote:poll_id:option_index / poll:close:poll_id (admin check done by the router)
+@callback_route('poll', 'vote', auth='none')
+@callback_route('poll', 'close', auth='admin')
+def handle_poll_callbacks(call, cb):
+    chat_id = cb.chat_id
+    user_id = cb.user_id
+    message_id = cb.message_id
+    action = cb.args[0] # 'vote' or 'close'
+    poll_id = int(cb.args[1])
     
     # 1. Close Poll
     if action == 'close':
-        if not is_admin_member(chat_id, user_id):
-            bot.answer_callback_query(call.id, _(chat_id, 'admin_only'), show_alert=True)
-            return
-
         conn = db()
         c = conn.cursor()
         c.execute("UPDATE polls SET open=0 WHERE id=?", (poll_id,))
@@ -2266,7 +5283,7 @@ def handle_poll_callbacks(call):
 
     # 2. Vote
     elif action == 'vote':
-        vote_index = int(parts[3])
+        vote_index = int(cb.args[2])
         poll_row = get_poll_data(poll_id)
         
         if not poll_row or not poll_row['open']:
@@ -2317,36 +5334,76 @@ def handle_poll_callbacks(call):
             bot.answer_callback_query(call.id, _(chat_id, 'error_occurred'))
 
 # --- Helper function to render a list and allow deletion (for Note/Trigger/Blacklist) ---
-def _build_list_menu(chat_id, user_id, module, target_id):
+# module: (table, key column, content column, menu page)
+LIST_MODULES = {
+    'note': ('notes', 'key', 'content', 'notes'),
+    'trigger': ('triggers', 'pattern', 'reply', 'triggers'),
+    'blacklist': ('blacklist', 'word', 'word', 'blacklist'),
+}
+
+def list_page_size(chat_id):
+    "Items per list page for a chat (menu_json lists.page_size)"
+    size = menu_get(chat_id).get('lists', {}).get('page_size', LIST_PAGE_SIZE)
+    return max(LIST_PAGE_MIN, min(LIST_PAGE_MAX, int(size)))
+
+def _list_page(module, target_id, direction='n', cursor=0, prefix='', limit=LIST_PAGE_SIZE):
+    """
+    One keyset page of a list: rows after (direction 'n') or before ('p') item id cursor.
+    Returns (rows, has_prev, has_next). Without a prefix the (chat_id) index walks id order,
+    so cost depends on the page size; with one, the (chat_id, key) index limits the work
+    to the keys matching the prefix.
+    """
+    table, key_col, content_col, _menu = LIST_MODULES[module]
+    where = "chat_id=?"
+    params = [str(target_id)]
+    if prefix:
+        where += f" AND {key_col} >= ? AND {key_col} < ?"
+        params += [prefix, prefix + '\U0010ffff']
+    conn = db()
+    if direction == 'p':
+        rows = conn.execute(f"SELECT id, {key_col} AS key, {content_col} AS content FROM {table} WHERE {where} AND id<? ORDER BY id DESC LIMIT ?",
+                            params + [cursor, limit + 1]).fetchall()
+        rows = [dict(row) for row in rows[:limit]][::-1]
+    else:
+        rows = conn.execute(f"SELECT id, {key_col} AS key, {content_col} AS content FROM {table} WHERE {where} AND id>? ORDER BY id LIMIT ?",
+                            params + [cursor, limit + 1]).fetchall()
+        rows = [dict(row) for row in rows[:limit]]
+    has_prev = has_next = False
+    if rows:
+        has_prev = conn.execute(f"SELECT 1 FROM {table} WHERE {where} AND id<? LIMIT 1", params + [rows[0]['id']]).fetchone() is not None
+        has_next = conn.execute(f"SELECT 1 FROM {table} WHERE {where} AND id>? LIMIT 1", params + [rows[-1]['id']]).fetchone() is not None
+    conn.close()
+    return rows, has_prev, has_next
+
+def _build_list_menu(chat_id, user_id, module, target_id, direction='n', cursor=0, prefix=''):
     chat_id_str = str(chat_id)
     keyboard = types.InlineKeyboardMarkup()
     desc_lines = [f"📋 <b>{_(chat_id_str, module.capitalize())} List</b> (Click 🗑️ to Delete)"]
+    if prefix:
+        desc_lines.append(f"🔎 <code>{safe_html(prefix)}</code>")
     
-    conn = db()
-    c = conn.cursor()
-    
-    if module == 'note':
-        c.execute("SELECT id, key, content FROM notes WHERE chat_id=?", (target_id,))
-    elif module == 'trigger':
-        c.execute("SELECT id, pattern as key, reply FROM triggers WHERE chat_id=?", (target_id,))
-    elif module == 'blacklist':
-        c.execute("SELECT id, word as key, word as content FROM blacklist WHERE chat_id=?", (target_id,))
-    else:
-        conn.close()
+    if module not in LIST_MODULES:
         return "\n".join(desc_lines), keyboard
-
-    rows = c.fetchall()
-    conn.close()
+    
+    page_size = list_page_size(target_id)
+    rows, has_prev, has_next = _list_page(module, target_id, direction, cursor, prefix, page_size)
+    if not rows and cursor:
+        # Page emptied by deletions: start over from the first page
+        rows, has_prev, has_next = _list_page(module, target_id, 'n', 0, prefix, page_size)
     
     if not rows:
         desc_lines.append(f"<i>No active {module}s found.</i>")
     
+    # Deleting keeps the user on the same page
+    anchor = rows[0]['id'] - 1 if rows else 0
+    # The search prefix is free text: stored once in CB_PAYLOADS, buttons carry its '$' token
+    prefix_args = (cb_stash(target_id, prefix),) if prefix else ()
     for row in rows:
         key = row['key']
         item_id = row['id']
         
         # Display text: [Key] (Optional reply snippet)
-        content_snippet = row.get('content', row.get('reply', ''))
+        content_snippet = row['content'] if row['content'] != key else ''
         display_text = safe_html(key)
         if content_snippet:
              display_text += f" -> {safe_html(content_snippet[:20])}..."
@@ -2354,44 +5411,65 @@ def _build_list_menu(chat_id, user_id, module, target_id):
         # Button: [Key/Pattern] [Delete]
         keyboard.add(
             types.InlineKeyboardButton(display_text, callback_data="ignore_label"),
-            # Callback format: module:target_id:del:item_id
-            types.InlineKeyboardButton("🗑️", callback_data=f"{module}:{target_id}:del:{item_id}")
+            # Callback format: module:target_id:del:item_id:anchor:prefix
+            types.InlineKeyboardButton("🗑️", callback_data=cb_pack(module, target_id, 'del', item_id, anchor, *prefix_args))
         )
+    
+    # [◀️] [N / page] [▶️]
+    nav_row = []
+    if has_prev:
+        nav_row.append(types.InlineKeyboardButton("◀️", callback_data=cb_pack(module, target_id, 'page', 'p', rows[0]['id'], *prefix_args)))
+    # Page size button cycles 5 -> 10 -> ... -> 30 -> 5
+    nav_row.append(types.InlineKeyboardButton(_(chat_id_str, 'list_page_size', size=page_size),
+                                              callback_data=cb_pack(module, target_id, 'size', page_size % LIST_PAGE_MAX + LIST_PAGE_MIN)))
+    if has_next:
+        nav_row.append(types.InlineKeyboardButton("▶️", callback_data=cb_pack(module, target_id, 'page', 'n', rows[-1]['id'], *prefix_args)))
+    keyboard.row(*nav_row)
+    
+    # Prefix search reads the next private message, so it is offered in private only
+    if not chat_id_str.startswith('-'):
+        keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'list_search'), callback_data=cb_pack(module, target_id, 'search')))
         
     # Back button to the main menu of the module
-    keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=f"menu:{target_id}:{module}"))
+    keyboard.add(types.InlineKeyboardButton(_(chat_id_str, 'back'), callback_data=cb_pack('menu', target_id, LIST_MODULES[module][3])))
     
     return "\n".join(desc_lines), keyboard
 
-# --- Extend callback_inline for listing and deletion (Point 3, 5, 6, 8) ---
-# NOTE: This dedicated handler assumes the main callback_inline function (in Part 2) 
-# routes all 'list' and 'del' actions here.
-@bot.callback_query_handler(func=lambda call: call.data.endswith(':list') or call.data.endswith(':active') or 'del' in call.data.split(':'))
-def handle_list_delete_callbacks(call):
-    chat_id = call.message.chat.id
-    user_id = call.from_user.id
-    message_id = call.message.message_id
-    data = call.data
-    parts = data.split(':')
-    
-    module = parts[0]
-    action = parts[2] if len(parts) > 2 else parts[1] # Check for delete action
-    target_id = parts[1]
-    
-    # 1. Permission Check
-    if not str(chat_id).startswith('-') and target_id.startswith('-'):
-        is_allowed = is_creator_member(target_id, user_id)
+def _show_list_menu(chat_id, message_id, user_id, module, target_id, direction='n', cursor=0, prefix=''):
+    "Render a list page into an existing message (or a new one without message_id)"
+    desc, kb = _build_list_menu(chat_id, user_id, module, target_id, direction, cursor, prefix)
+    if message_id:
+        bot.edit_message_text(desc, chat_id, message_id, reply_markup=kb, parse_mode="HTML")
     else:
-        is_allowed = is_admin_member(chat_id, user_id)
-        
-    if not is_allowed:
-        bot.answer_callback_query(call.id, _(target_id, 'admin_only'), show_alert=True)
-        return
+        bot.send_message(chat_id, desc, reply_markup=kb, parse_mode="HTML")
+
+# --- List/Delete routes (Point 3, 5, 6, 8) ---
+# Format: module:target_id:list / module:target_id:page:n|p:item_id:prefix / module:target_id:del:item_id:anchor:prefix
+@callback_route('note', 'list')
+@callback_route('trigger', 'list')
+@callback_route('blacklist', 'list')
+@callback_route('note', 'page')
+@callback_route('trigger', 'page')
+@callback_route('blacklist', 'page')
+@callback_route('note', 'del')
+@callback_route('trigger', 'del')
+@callback_route('blacklist', 'del')
+def handle_list_delete_callbacks(call, cb):
+    chat_id = cb.chat_id
+    user_id = cb.user_id
+    message_id = cb.message_id
+    module = cb.action
+    action = cb.args[0]
+    target_id = cb.target_id
     
-    # 2. Listing Menu (list/active)
-    if action == 'list' or action == 'active':
+    # 1. Listing Menu (first page, or a keyset page)
+    if action in ('list', 'page'):
         
-        desc, kb = _build_list_menu(chat_id, user_id, module, target_id)
+        if action == 'page':
+            desc, kb = _build_list_menu(chat_id, user_id, module, target_id, cb.args[1], int(cb.args[2]),
+                                        cb.args[3] if len(cb.args) > 3 else '')
+        else:
+            desc, kb = _build_list_menu(chat_id, user_id, module, target_id)
         
         try:
              bot.edit_message_text(
@@ -2409,9 +5487,9 @@ def handle_list_delete_callbacks(call):
                  bot.answer_callback_query(call.id, _(target_id, 'error_occurred'), show_alert=True)
         return
         
-    # 3. Deletion (Format: module:target_id:del:item_id)
+    # 2. Deletion (Format: module:target_id:del:item_id)
     elif action == 'del':
-        item_id = int(parts[3])
+        item_id = int(cb.args[1])
         
         conn = db()
         c = conn.cursor()
@@ -2442,17 +5520,41 @@ def handle_list_delete_callbacks(call):
         conn.close()
         
         if deleted_key:
-            log_action(target_id, user_id, f"{module}_delete:{deleted_key}")
+            invalidate_chat_config(target_id)
+            log_action(target_id, user_id, Action[f"{module.upper()}_DELETE"], deleted_key)
             # Reusing 'note_deleted' for generic deletion confirmation
             bot.answer_callback_query(call.id, _(target_id, 'note_deleted', key=deleted_key)) 
             
-            # Re-render the list menu instantly
-            desc, kb = _build_list_menu(chat_id, user_id, module, target_id)
-            bot.edit_message_text(desc, chat_id, message_id, reply_markup=kb, parse_mode="HTML")
+            # Re-render the same page of the list instantly
+            anchor = int(cb.args[2]) if len(cb.args) > 2 else 0
+            prefix = cb.args[3] if len(cb.args) > 3 else ''
+            _show_list_menu(chat_id, message_id, user_id, module, target_id, 'n', anchor, prefix)
         else:
             bot.answer_callback_query(call.id, "⚠️ Item not found or already deleted.", show_alert=True)
         return
 
+@callback_route('note', 'size')
+@callback_route('trigger', 'size')
+@callback_route('blacklist', 'size')
+def _callback_list_page_size(call, cb):
+    target_id = cb.target_id
+    menu_data = menu_get(target_id)
+    lists = menu_data.get('lists', {})
+    lists['page_size'] = max(LIST_PAGE_MIN, min(LIST_PAGE_MAX, int(cb.args[1])))
+    menu_data['lists'] = lists
+    menu_set(target_id, menu_data)
+    _show_list_menu(cb.chat_id, cb.message_id, cb.user_id, cb.action, target_id)
+    bot.answer_callback_query(call.id, _(target_id, 'setting_updated'))
+
+@callback_route('note', 'search')
+@callback_route('trigger', 'search')
+@callback_route('blacklist', 'search')
+def _callback_list_search(call, cb):
+    # The next private message is the prefix (handled in handle_private_messages)
+    STATE[(cb.chat_id, cb.user_id)] = {'action': f'{cb.action}_wait_for_search', 'target_id': cb.target_id}
+    bot.send_message(cb.chat_id, _(cb.target_id, 'list_search_prompt'))
+    bot.answer_callback_query(call.id)
+
 
 # ----------------------------------------------------------------------
 # -------------------- BOT STARTUP & MAIN LOOP (Point 18, 20) ----------
@@ -2461,18 +5563,46 @@ def handle_list_delete_callbacks(call):
 # --- Auto Cleanup Thread ---
 def auto_cleanup_thread():
     """Periodically cleans up expired captcha attempts."""
+    last_reported = 0
+    last_pruned = 0
     while True:
         try:
             now = now_ts()
             
-            # 1. Cleanup expired captcha (5 mins expiry)
-            with CAPTCHA_LOCK:
-                # Remove restriction for users who timed out on captcha
-                expired_keys = [key for key, data in pending_captcha.items() if (now - data['created_at']) > 300] 
-                for chat_id, user_id in expired_keys:
+            active_chats = set(get_active_chat_ids())
+            
+            # 1. Cleanup expired captcha (CAPTCHA_TIMEOUT expiry, including ones persisted before a restart)
+            # Remove restriction for users who timed out on captcha (skip chats the bot has left)
+            expired = pending_captcha.pop_expired()
+            expired += pending_captcha.pop_where(lambda key, data: str(key[0]) not in active_chats)
+            for (chat_id, user_id), _data in expired:
+                if str(chat_id) in active_chats:
                     unrestrict_user(chat_id, user_id)
                     logging.info(f"Captcha expired/timed out for {user_id} in {chat_id}")
-                    del pending_captcha[(chat_id, user_id)]
+            
+            # Abandoned multi-step flows
+            STATE.pop_expired()
+            CB_PAYLOADS.pop_expired()
+            
+            # 2. Report message fast-path ratio
+            with FAST_PATH_LOCK:
+                total, fast = FAST_PATH_STATS['messages'], FAST_PATH_STATS['fast_path']
+            if total != last_reported:
+                last_reported = total
+                logging.info(f"⚡ Fast path: {fast}/{total} messages ({fast * 100 // total}%) skipped blacklist/locks/triggers")
+            
+            # 3. Rejoin tracker retention (hourly)
+            if now - last_pruned >= 3600:
+                last_pruned = now
+                pruned = prune_known_members()
+                if pruned:
+                    logging.info(f"Pruned {pruned} known members older than {REJOIN_RETENTION_DAYS} days")
+            
+            # 4. Drop in-memory tracking for dead chats and idle flood windows
+            user_messages.pop_where(lambda key, stamps: str(key[0]) not in active_chats or stamps[-1] < now - 3600)
+            join_rates.pop_where(lambda chat_id, stamps: stamps[-1] < now - RAID_WINDOW)
+            prune_dupe_index(now)
+            API_LIMITER.prune()
             
         except Exception as e:
             logging.error(f"Auto-cleanup error: {e}")
@@ -2483,18 +5613,18 @@ def auto_cleanup_thread():
 
 def main():
     "Main function to start the bot"
-    global BOT_USERNAME
     logging.info("🤖 Bot starting...")
     logging.info(f"📊 Database: {DB_PATH}")
     
     # 1. Initialize Database
     init_db() 
+    load_federations()
+    REGEX_SANDBOX.start()  # Fork the regex workers before any other thread exists
     
     # 2. Fetch Bot Info
     try:
-        bot_info = bot.get_me()
-        BOT_USERNAME = bot_info.username
-        logging.info(f"✅ Bot username: @{BOT_USERNAME}")
+        bot_info = get_bot_info()
+        logging.info(f"✅ Bot username: @{bot_info.username}")
         
     except Exception as e:
         logging.error(f"❌ Failed to fetch bot info: {e}")
@@ -2505,17 +5635,29 @@ def main():
     thread.daemon = True
     thread.start()
     logging.info("✅ Auto cleanup thread started.")
+    
+    # 4. Start Raid Flush Thread
+    Thread(target=raid_flush_thread, daemon=True).start()
+    logging.info("✅ Raid flush thread started.")
         
     logging.info("✅ All systems ready")
     logging.info("🚀 Starting infinite polling...")
     
-    # 4. Start Polling
+    # 5. Start Scheduler Thread
+    Thread(target=scheduler_thread, daemon=True).start()
+    logging.info("✅ Scheduler thread started.")
+    
+    # 6. Start Analytics Rollup/Retention Thread
+    Thread(target=analytics_maintenance_thread, daemon=True).start()
+    logging.info("✅ Analytics maintenance thread started.")
+    
+    # 7. Start Polling
     try:
         bot.infinity_polling(
             timeout=60,
             long_polling_timeout=60,
             logger_level=logging.INFO,
-            allowed_updates=['message', 'callback_query', 'chat_member']
+            allowed_updates=['message', 'callback_query', 'chat_member', 'my_chat_member']
         )
     except KeyboardInterrupt:
         logging.info("🛑 Bot stopped by user (Ctrl+C).")